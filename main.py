@@ -1,30 +1,70 @@
 # ==================== IMPORTS ====================
 import os, re, csv, io, requests, smtplib
+import time, threading, asyncio, socket, zlib, collections, random, contextvars, hmac
+import concurrent.futures
+import httpx
 import urllib.parse
 import unicodedata
 from email.mime.text import MIMEText
 from fastapi import FastAPI, Request
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import PlainTextResponse, JSONResponse
 from datetime import datetime
 from zoneinfo import ZoneInfo
 import anthropic
+import numpy as np
 # ==================== APP ====================
 app = FastAPI()
 # ==== SESSIONS (persistente con Redis + fallback en memoria) ====
 # ==== SESSIONS (persistente con Redis + fallback en memoria) ====
 import json, os
 REDIS_URL = os.getenv("REDIS_URL", "").strip()
+REDIS_POOL_SIZE            = int(os.getenv("REDIS_POOL_SIZE") or "50")
+REDIS_POOL_TIMEOUT_SECS    = float(os.getenv("REDIS_POOL_TIMEOUT_SECS") or "0.5")   # espera por una conexión libre
+REDIS_SOCKET_TIMEOUT_SECS  = float(os.getenv("REDIS_SOCKET_TIMEOUT_SECS") or "0.5")
+REDIS_CONNECT_TIMEOUT_SECS = float(os.getenv("REDIS_CONNECT_TIMEOUT_SECS") or "1")
+REDIS_HEALTH_SECS          = float(os.getenv("REDIS_HEALTH_SECS") or "5")
+REDIS_BREAKER_FAILS        = int(os.getenv("REDIS_BREAKER_FAILS") or "3")           # errores seguidos → modo local
+SESSION_LOCAL_MAX          = int(os.getenv("SESSION_LOCAL_MAX") or "5000")          # espejo local (LRU)
 _redis = None
+_rsess = None   # mismo Redis, sin decode: las sesiones se guardan en binario (ver encode_session)
 if REDIS_URL:
     try:
-        import redis
-        _redis = redis.from_url(REDIS_URL, decode_responses=True)
+        import redis.asyncio as aioredis
+        _redis = aioredis.from_url(REDIS_URL, decode_responses=True,
+                                   socket_connect_timeout=REDIS_CONNECT_TIMEOUT_SECS,
+                                   socket_keepalive=True, health_check_interval=30)
+        # Sesiones: pool acotado y timeouts cortos; si Redis se cuelga, el turno no se cuelga
+        _rsess = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool.from_url(
+            REDIS_URL, max_connections=REDIS_POOL_SIZE, timeout=REDIS_POOL_TIMEOUT_SECS,
+            socket_timeout=REDIS_SOCKET_TIMEOUT_SECS, socket_connect_timeout=REDIS_CONNECT_TIMEOUT_SECS,
+            socket_keepalive=True, health_check_interval=30))
         print("BOOT> Redis OK")
     except Exception as e:
         print("BOOT> Redis error:", e)
         _redis = None
+        _rsess = None
 
-SESSIONS = {}   # fallback en memoria (por si no hay Redis)
+try:
+    import msgpack
+except Exception:
+    msgpack = None
+
+# Formato de sesión versionado: b"S1" + msgpack. Sin msgpack (o sesiones viejas) → JSON.
+SESSION_FORMAT_V1 = b"S1"
+
+def encode_session(state: dict) -> bytes:
+    if msgpack:
+        return SESSION_FORMAT_V1 + msgpack.packb(state, use_bin_type=True)
+    return json.dumps(state, separators=(",", ":")).encode()
+
+def decode_session(raw) -> dict | None:
+    if not raw:
+        return None
+    if isinstance(raw, bytes) and raw[:2] == SESSION_FORMAT_V1:
+        return msgpack.unpackb(raw[2:], raw=False)
+    return json.loads(raw)
+
+SESSIONS = collections.OrderedDict()   # user -> sesión codificada; sin Redis es el store, con Redis el espejo local
 SESSION_TTL_SECS = 60 * 60  # 1 hora
 def deal_title_from_state(state: dict) -> str:
     name = (state.get("name") or "Guest").strip()
@@ -84,32 +124,267 @@ def _boat_kind(row: dict) -> str:
     return ""
 
 
-def get_session(user: str) -> dict | None:
-    if _redis:
-        try:
-            raw = _redis.get(_rkey(user))
-            return json.loads(raw) if raw else None
-        except Exception as e:
-            print("Redis get error:", e)
-    return SESSIONS.get(user)
-
-def set_session(user: str, state: dict):
-    state["last_activity"] = datetime.now(ZoneInfo("America/Bogota")).isoformat()
-    if _redis:
-        try:
-            _redis.setex(_rkey(user), SESSION_TTL_SECS, json.dumps(state))
+# ---- Unidad de trabajo por mensaje ----
+# Dentro de un turno (handle_message) get_session lee Redis una sola vez y set_session sólo
+# guarda el snapshot; al final del turno se escribe una vez. La escritura es optimista:
+# cada sesión lleva "_v"; si otro proceso escribió en el medio (WATCH), se mezclan campos:
+# lo que este turno cambió respecto de lo que leyó gana, el resto queda como está en Redis.
+_session_turn = contextvars.ContextVar("session_turn", default=None)
+SESSION_CAS_RETRIES = 5
+
+class SessionTurn:
+    def __init__(self, user: str):
+        self.user = user
+        self.loaded = False
+        self.base = None      # bytes leídos al inicio del turno (o del último flush)
+        self.pending = None   # bytes del último set_session (aún sin escribir)
+        self.closed = False
+        self.sent = False     # ya salió algo a WhatsApp en este turno (no se puede reintentar)
+        self.done = asyncio.Event()   # set cuando el turno ya escribió su sesión
+
+    def owns(self, user: str) -> bool:
+        return not self.closed and user == self.user
+
+    async def flush(self):
+        if self.pending is None:
             return
-        except Exception as e:
-            print("Redis set error:", e)
-    SESSIONS[user] = state
+        mine = decode_session(self.pending)
+        base = decode_session(self.base)
+        base_v = (base or {}).get("_v", 0)
+
+        def merge(cur):
+            if cur is None or cur.get("_v", 0) == base_v:
+                return mine
+            metric_inc("session.conflicts")
+            merged = dict(cur)
+            for k in set(mine) | set(base or {}):
+                if k == "_v":
+                    continue
+                if k not in mine:
+                    merged.pop(k, None)
+                elif (base or {}).get(k) != mine[k]:
+                    merged[k] = mine[k]
+            return merged
 
-def del_session(user: str):
-    if _redis:
+        written = await _cas_session(self.user, merge)
+        self.base = encode_session(written) if written is not None else self.pending
+        self.pending = None
+
+class SessionBackend:
+    """
+    Store de sesiones: Redis con espejo local y circuit breaker.
+    - Cada sesión leída/escrita en Redis queda también en SESSIONS (LRU acotado), así que
+      si Redis cae seguimos con el último estado conocido en vez de reiniciar conversaciones.
+    - Tras REDIS_BREAKER_FAILS errores seguidos pasamos a modo local (sin esperar timeouts);
+      el health check (PING) detecta la vuelta y reconcilia lo escrito en local.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.fails = 0
+        self.local_since = 0.0   # >0 mientras estamos en modo local (monotonic)
+        self.dirty = {}          # user -> sesión codificada escrita en modo local
+
+    @property
+    def local(self) -> bool:
+        return self.client is None or self.local_since > 0
+
+    def _ok(self):
+        self.fails = 0
+
+    def _error(self, op: str, e: Exception):
+        print(f"Redis {op} error:", e)
+        metric_inc("session.redis_errors")
+        self.fails += 1
+        if self.fails >= REDIS_BREAKER_FAILS and not self.local_since:
+            self.local_since = time.monotonic()
+            metric_set("session.local_mode", 1)
+            print("SESSIONS> Redis no responde: modo local")
+
+    def _mirror(self, user: str, raw):
+        if raw is None:
+            SESSIONS.pop(user, None)
+            return
+        SESSIONS[user] = raw
+        SESSIONS.move_to_end(user)
+        if self.client is not None:
+            while len(SESSIONS) > SESSION_LOCAL_MAX:
+                SESSIONS.popitem(last=False)
+
+    async def load(self, user: str):
+        if not self.local:
+            try:
+                raw = await self.client.get(_rkey(user))
+                self._ok()
+                self._mirror(user, raw)
+                return raw
+            except Exception as e:
+                self._error("get", e)
+        if self.client is not None:
+            metric_inc("session.local_ops")
+        return SESSIONS.get(user)
+
+    async def cas(self, user: str, fn) -> dict | None:
+        """Read-modify-write optimista: fn(actual) -> nuevo estado (o None para no escribir)."""
+        if not self.local:
+            key = _rkey(user)
+            try:
+                async with self.client.pipeline(transaction=True) as pipe:
+                    for _ in range(SESSION_CAS_RETRIES):
+                        try:
+                            await pipe.watch(key)
+                            cur = decode_session(await pipe.get(key))
+                            new = fn(cur)
+                            if new is None:
+                                await pipe.unwatch()
+                                self._ok()
+                                return None
+                            new["_v"] = (cur or {}).get("_v", 0) + 1
+                            raw = encode_session(new)
+                            pipe.multi()
+                            pipe.setex(key, SESSION_TTL_SECS, raw)
+                            pipe.zadd(ACTIVITY_KEY, {wa_click_number(user): _activity_ts(new)})
+                            await pipe.execute()
+                            self._ok()
+                            self._mirror(user, raw)
+                            metric_inc("session.writes")
+                            return new
+                        except aioredis.WatchError:
+                            metric_inc("session.cas_retries")
+                            continue
+                print(f"Redis set: too many concurrent writes for {user}")
+                return None
+            except Exception as e:
+                self._error("set", e)
+        cur = decode_session(SESSIONS.get(user))
+        new = fn(cur)
+        if new is None:
+            return None
+        new["_v"] = (cur or {}).get("_v", 0) + 1
+        raw = encode_session(new)
+        self._mirror(user, raw)
+        if self.client is not None:
+            self.dirty[user] = raw
+            metric_inc("session.local_ops")
+        return new
+
+    async def delete(self, user: str):
+        self.dirty.pop(user, None)
+        self._mirror(user, None)
+        if self.local:
+            return
         try:
-            _redis.delete(_rkey(user))
+            pipe = self.client.pipeline(transaction=True)
+            pipe.delete(_rkey(user))
+            pipe.zrem(ACTIVITY_KEY, wa_click_number(user))
+            await pipe.execute()
+            self._ok()
         except Exception as e:
-            print("Redis del error:", e)
-    SESSIONS.pop(user, None)
+            self._error("del", e)
+
+    async def reconcile(self) -> bool:
+        """Sube a Redis lo escrito en modo local (gana la sesión con actividad más reciente)."""
+        for user, raw in list(self.dirty.items()):
+            mine = decode_session(raw)
+            key = _rkey(user)
+            async with self.client.pipeline(transaction=True) as pipe:
+                await pipe.watch(key)
+                cur = decode_session(await pipe.get(key))
+                if cur is None or _activity_ts(mine) >= _activity_ts(cur):
+                    mine["_v"] = max((cur or {}).get("_v", 0), mine.get("_v", 0)) + 1
+                    pipe.multi()
+                    pipe.setex(key, SESSION_TTL_SECS, encode_session(mine))
+                    pipe.zadd(ACTIVITY_KEY, {wa_click_number(user): _activity_ts(mine)})
+                    await pipe.execute()
+                else:
+                    await pipe.unwatch()
+            # Si alguien la cambió en el medio (WatchError) se reintenta en el próximo health check
+            self.dirty.pop(user, None)
+        return not self.dirty
+
+    async def health_loop(self):
+        while True:
+            await asyncio.sleep(REDIS_HEALTH_SECS)
+            try:
+                await self.client.ping()
+            except Exception as e:
+                if not self.local:
+                    self._error("ping", e)
+                continue
+            self._ok()
+            if not self.local_since:
+                continue
+            try:
+                if not await self.reconcile():
+                    continue
+            except Exception as e:
+                print("Session reconcile error:", e)
+                continue
+            secs = time.monotonic() - self.local_since
+            self.local_since = 0.0
+            metric_set("session.local_mode", 0)
+            metric_inc("session.fallbacks")
+            metric_inc("session.fallback_secs", round(secs, 3))
+            metric_observe("session.fallback_ms", secs * 1000)
+            print(f"SESSIONS> Redis OK de nuevo tras {secs:.1f}s en modo local")
+
+_sessions_db = SessionBackend(_rsess)
+
+@app.on_event("startup")
+async def start_session_health():
+    if _sessions_db.client is not None:
+        asyncio.create_task(_sessions_db.health_loop())
+
+async def _cas_session(user: str, fn) -> dict | None:
+    return await _sessions_db.cas(user, fn)
+
+async def get_session(user: str) -> dict | None:
+    turn = _session_turn.get()
+    if turn and turn.owns(user):
+        if turn.pending is not None:
+            return decode_session(turn.pending)
+        if not turn.loaded:
+            turn.base = await _load_session_raw(user)
+            turn.loaded = True
+        return decode_session(turn.base)
+    return decode_session(await _load_session_raw(user))
+
+async def _load_session_raw(user: str):
+    return await _sessions_db.load(user)
+
+# Índice de inactividad: ZSET uid -> epoch de last_activity (para el cron de follow-up)
+ACTIVITY_KEY = "two_travel:wa:idx:activity"
+
+def _activity_ts(state: dict) -> float:
+    try:
+        return datetime.fromisoformat(state.get("last_activity") or "").timestamp()
+    except Exception:
+        return time.time()
+
+async def set_session(user: str, state: dict, touch: bool = True):
+    # touch=False: escrituras de fondo (p.ej. ids de HubSpot) que no son actividad del usuario
+    if touch or not state.get("last_activity"):
+        state["last_activity"] = datetime.now(ZoneInfo("America/Bogota")).isoformat()
+    turn = _session_turn.get()
+    if turn and turn.owns(user):
+        # Se escribe una sola vez al cerrar el turno
+        turn.pending = encode_session(state)
+        return
+    await _cas_session(user, lambda cur: dict(state))
+
+async def patch_session(user: str, patch: dict, match: dict | None = None):
+    """Actualiza sólo estos campos sobre lo que haya en Redis (no pisa el resto). No toca last_activity.
+    Con match, sólo si la sesión actual tiene esos valores (p.ej. la misma conversación)."""
+    def apply(cur):
+        if cur is None or all(cur.get(k) == v for k, v in patch.items()):
+            return None
+        if match and any(cur.get(k) != v for k, v in match.items()):
+            return None
+        cur.update(patch)
+        return cur
+    return await _cas_session(user, apply)
+
+async def del_session(user: str):
+    await _sessions_db.delete(user)
 
 
 # ==================== CONFIG (ENV) ====================
@@ -140,9 +415,88 @@ OWNER_ROSS_WA   = (os.getenv("OWNER_ROSS_WA") or "").strip()
 # Catálogo
 GOOGLE_SHEET_CSV_URL = (os.getenv("GOOGLE_SHEET_CSV_URL") or "").strip()
 TOP_K = int(os.getenv("TOP_K", "3"))
+CATALOG_REFRESH_SECS = int(os.getenv("CATALOG_REFRESH_SECS") or "300")  # refresco en background
+CATALOG_TTL_SECS     = int(os.getenv("CATALOG_TTL_SECS") or "900")      # snapshot "viejo" => revalida
+CATALOG_TIMEOUT_SECS = int(os.getenv("CATALOG_TIMEOUT_SECS") or "30")
+
+# Cola de mensajes del webhook
+WA_QUEUE_SHARDS   = int(os.getenv("WA_QUEUE_SHARDS") or "8")       # = workers; orden por usuario dentro del shard
+WA_QUEUE_BATCH    = int(os.getenv("WA_QUEUE_BATCH") or "10")
+WA_QUEUE_MAXLEN   = int(os.getenv("WA_QUEUE_MAXLEN") or "10000")   # por shard (aprox.)
+WA_MAX_RETRIES    = int(os.getenv("WA_MAX_RETRIES") or "3")
+WA_DLQ_MAX        = int(os.getenv("WA_DLQ_MAX") or "1000")
+WA_CLAIM_IDLE_MS  = int(os.getenv("WA_CLAIM_IDLE_MS") or "60000")  # reclamar pendientes de procesos caídos
+WA_SHARD_LEASE_SECS = int(os.getenv("WA_SHARD_LEASE_SECS") or "30")  # cada shard lo lee un solo proceso a la vez
+WA_MAX_CONCURRENCY   = int(os.getenv("WA_MAX_CONCURRENCY") or "32")    # conversaciones procesándose a la vez
+WA_SHARD_MAX_INFLIGHT = int(os.getenv("WA_SHARD_MAX_INFLIGHT") or "100")  # backpressure por shard
+
+# HTTP saliente (pools keep-alive por host + reintentos)
+GRAPH_POOL_SIZE        = int(os.getenv("GRAPH_POOL_SIZE") or "20")
+HUBSPOT_POOL_SIZE      = int(os.getenv("HUBSPOT_POOL_SIZE") or "10")
+GRAPH_TIMEOUT_SECS     = float(os.getenv("GRAPH_TIMEOUT_SECS") or "25")
+HUBSPOT_TIMEOUT_SECS   = float(os.getenv("HUBSPOT_TIMEOUT_SECS") or "20")
+HTTP_CONNECT_TIMEOUT_SECS = float(os.getenv("HTTP_CONNECT_TIMEOUT_SECS") or "5")
+HTTP_KEEPALIVE_SECS    = float(os.getenv("HTTP_KEEPALIVE_SECS") or "60")
+HTTP_MAX_RETRIES       = int(os.getenv("HTTP_MAX_RETRIES") or "3")
+HTTP_BACKOFF_BASE_SECS = float(os.getenv("HTTP_BACKOFF_BASE_SECS") or "0.5")
+HTTP_BACKOFF_MAX_SECS  = float(os.getenv("HTTP_BACKOFF_MAX_SECS") or "10")
+
+# WhatsApp saliente: throughput del número emisor y pair rate limit por destinatario
+WA_SEND_MPS          = float(os.getenv("WA_SEND_MPS") or "80")
+WA_SEND_BURST        = int(os.getenv("WA_SEND_BURST") or "80")
+WA_PAIR_MPS          = float(os.getenv("WA_PAIR_MPS") or "0.17")   # Meta: 1 msg / 6 s por usuario...
+WA_PAIR_BURST        = int(os.getenv("WA_PAIR_BURST") or "45")       # ...con ráfagas de hasta 45
+WA_PAIR_MAX          = int(os.getenv("WA_PAIR_MAX") or "10000")
+WA_SEND_MAX_ATTEMPTS = int(os.getenv("WA_SEND_MAX_ATTEMPTS") or "4")
+WA_RETRY_MIN_SECS    = float(os.getenv("WA_RETRY_MIN_SECS") or "1")
+# Códigos de error de Graph que garantizan que el mensaje no se aceptó (rate limits)
+WA_RETRY_CODES = {4, 80007, 130429, 131056}
+
+# HubSpot sync en batch
+HUBSPOT_FLUSH_SECS   = float(os.getenv("HUBSPOT_FLUSH_SECS") or "5")
+HUBSPOT_BATCH_SIZE   = int(os.getenv("HUBSPOT_BATCH_SIZE") or "50")
+HUBSPOT_MAX_ATTEMPTS = int(os.getenv("HUBSPOT_MAX_ATTEMPTS") or "5")
+
+CONTACT_CACHE_TTL_SECS = int(os.getenv("CONTACT_CACHE_TTL_SECS") or str(30 * 24 * 3600))
+CONTACT_CACHE_MAX      = int(os.getenv("CONTACT_CACHE_MAX") or "5000")
+HS_DEAL_IDS_TTL_SECS   = int(os.getenv("HS_DEAL_IDS_TTL_SECS") or str(24 * 3600))
+HS_DEAL_IDS_MAX        = int(os.getenv("HS_DEAL_IDS_MAX") or "5000")
+
+# Notificación de leads (debounce por usuario)
+LEAD_DEBOUNCE_SECS     = float(os.getenv("LEAD_DEBOUNCE_SECS") or "300")    # inactividad antes de notificar
+LEAD_DEBOUNCE_MAX_SECS = float(os.getenv("LEAD_DEBOUNCE_MAX_SECS") or "1800")  # tope desde el primer evento
+LEAD_POLL_SECS         = float(os.getenv("LEAD_POLL_SECS") or "2")
+
+# Follow-up
+FOLLOWUP_BATCH = int(os.getenv("FOLLOWUP_BATCH") or "200")   # sesiones por MGET/pipeline
+FOLLOWUP_CONCURRENCY = int(os.getenv("FOLLOWUP_CONCURRENCY") or "10")   # envíos en vuelo
+FOLLOWUP_MPS         = float(os.getenv("FOLLOWUP_MPS") or "20")       # tier Cloud API: 80 mps/número; dejamos margen al chat en vivo
+FOLLOWUP_BURST       = int(os.getenv("FOLLOWUP_BURST") or "20")
+FOLLOWUP_JOB_TTL_SECS = int(os.getenv("FOLLOWUP_JOB_TTL_SECS") or str(7 * 24 * 3600))
+
+# Admin
+ADMIN_TOKEN = (os.getenv("ADMIN_TOKEN") or "").strip()   # vacío => /admin/* deshabilitado (404)
 
 # Anthropic / Claude
 ANTHROPIC_API_KEY = (os.getenv("ANTHROPIC_API_KEY") or "").strip()
+CLAUDE_MODEL      = (os.getenv("CLAUDE_MODEL") or "claude-haiku-4-5-20251001").strip()
+CLAUDE_MAX_TOKENS = int(os.getenv("CLAUDE_MAX_TOKENS") or "300")
+CLAUDE_MAX_CONCURRENCY   = int(os.getenv("CLAUDE_MAX_CONCURRENCY") or "8")
+CLAUDE_QUEUE_TIMEOUT_SECS = float(os.getenv("CLAUDE_QUEUE_TIMEOUT_SECS") or "2")   # espera por un slot
+CLAUDE_TIMEOUT_SECS      = float(os.getenv("CLAUDE_TIMEOUT_SECS") or "8")          # presupuesto por llamada
+CLAUDE_BREAKER_FAILS     = int(os.getenv("CLAUDE_BREAKER_FAILS") or "5")           # fallos seguidos para abrir
+CLAUDE_BREAKER_COOLDOWN_SECS = float(os.getenv("CLAUDE_BREAKER_COOLDOWN_SECS") or "30")
+
+# Cache de respuestas de Luna (FAQs repetidas)
+LUNA_CACHE_TTL_SECS = int(os.getenv("LUNA_CACHE_TTL_SECS") or str(6 * 3600))
+LUNA_CACHE_MAX      = int(os.getenv("LUNA_CACHE_MAX") or "512")
+LUNA_CACHE_MIN_SIM  = float(os.getenv("LUNA_CACHE_MIN_SIM") or "0.9")   # coseno TF-IDF mínimo
+
+# Memoria de conversación de Luna
+LUNA_HISTORY_TOKENS = int(os.getenv("LUNA_HISTORY_TOKENS") or "800")   # presupuesto del transcript (aprox.)
+LUNA_HISTORY_KEEP   = int(os.getenv("LUNA_HISTORY_KEEP") or "4")       # turnos recientes que nunca se resumen
+LUNA_STREAM         = (os.getenv("LUNA_STREAM") or "1").strip() == "1"   # enviar la respuesta por frases
+LUNA_STREAM_MIN_CHARS = int(os.getenv("LUNA_STREAM_MIN_CHARS") or "200")  # tamaño mínimo de los mensajes siguientes
 
 # Correo ventas (SMTP)
 SMTP_HOST    = (os.getenv("SMTP_HOST") or "").strip()
@@ -150,10 +504,50 @@ SMTP_PORT    = int(os.getenv("SMTP_PORT") or "587")
 SMTP_USER    = (os.getenv("SMTP_USER") or "").strip()
 SMTP_PASS    = (os.getenv("SMTP_PASS") or "").strip()
 SALES_EMAILS = [e.strip() for e in (os.getenv("SALES_EMAILS") or "michel@two.travel").split(",") if e.strip()]
-
-# Estado en memoria
-
-LAST_MSGID = {}    # evitar reprocesar el mismo mensaje WA
+MAIL_FLUSH_SECS   = float(os.getenv("MAIL_FLUSH_SECS") or "5")      # reintentos / rezagados
+MAIL_BATCH_SIZE   = int(os.getenv("MAIL_BATCH_SIZE") or "20")
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS") or "5")
+MAIL_DIGEST_SECS  = float(os.getenv("MAIL_DIGEST_SECS") or "0")     # >0: un solo email con los eventos de cada ventana
+SMTP_IDLE_SECS    = float(os.getenv("SMTP_IDLE_SECS") or "60")      # tras esto se verifica la conexión (NOOP)
+
+# Dedup de mensajes WA (Meta reintenta y reentrega fuera de orden)
+MSG_DEDUP_TTL_SECS = int(os.getenv("MSG_DEDUP_TTL_SECS") or str(24 * 3600))
+MSG_DEDUP_MAX      = int(os.getenv("MSG_DEDUP_MAX") or "50000")   # fallback en memoria (LRU)
+
+# ==================== MÉTRICAS ====================
+# Métricas en proceso (contadores, gauges e histogramas simples); ver /admin/metrics
+METRICS = {"counters": {}, "gauges": {}, "hist": {}}
+HIST_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+def metric_inc(name: str, n: float = 1):
+    METRICS["counters"][name] = METRICS["counters"].get(name, 0) + n
+
+def metric_set(name: str, value: float):
+    METRICS["gauges"][name] = value
+
+def metric_observe(name: str, value_ms: float):
+    h = METRICS["hist"].get(name)
+    if h is None:
+        h = METRICS["hist"][name] = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * (len(HIST_BUCKETS_MS) + 1)}
+    h["count"] += 1
+    h["sum"] += value_ms
+    h["max"] = max(h["max"], value_ms)
+    i = 0
+    while i < len(HIST_BUCKETS_MS) and value_ms > HIST_BUCKETS_MS[i]:
+        i += 1
+    h["buckets"][i] += 1
+
+def metrics_snapshot() -> dict:
+    hist = {}
+    for name, h in METRICS["hist"].items():
+        hist[name] = {
+            "count": h["count"],
+            "avg_ms": round(h["sum"] / h["count"], 1) if h["count"] else 0,
+            "max_ms": round(h["max"], 1),
+            "buckets": {("le_" + str(b) if i < len(HIST_BUCKETS_MS) else "inf"): n
+                        for i, (b, n) in enumerate(zip(list(HIST_BUCKETS_MS) + [None], h["buckets"]))},
+        }
+    return {"counters": dict(METRICS["counters"]), "gauges": dict(METRICS["gauges"]), "hist": hist}
 
 # ==================== Regex / Normalización robusta ====================
 # Email laxo (tolerante a mayúsculas/minúsculas)
@@ -231,7 +625,7 @@ def pick_description(row: dict, user_lang: str) -> str:
         desc = desc[:357].rstrip() + "…"
     return desc
 
-def reset_to_menu(state, user):
+async def reset_to_menu(state, user):
     # Limpiar cualquier rastro del flujo anterior
     state["step"] = "menu"
     state["service_type"] = None
@@ -239,7 +633,7 @@ def reset_to_menu(state, user):
     state["category_tag"] = None
     state["pax"] = None
     state["date"] = None
-    set_session(user, state)
+    await set_session(user, state)
 
 def human_pref_label(service: str, lang: str, category_tag: str) -> str:
     es = is_es(lang)
@@ -352,11 +746,364 @@ STRICT RULES — never break these:
 - When in doubt, or for any price/availability/booking question, offer to connect the user with the team: Ross handles Cartagena, Ray handles everything else (Medellín, Tulum, Mexico City)
 """
 
-def luna_ai_reply(user_message: str, state: dict) -> str:
-    if not ANTHROPIC_API_KEY:
+# Cliente async de larga vida (pool de conexiones reutilizado entre mensajes).
+# Sin reintentos del SDK: el presupuesto por llamada lo controla el gateway.
+_claude = anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY, timeout=CLAUDE_TIMEOUT_SECS, max_retries=0) if ANTHROPIC_API_KEY else None
+_claude_sem = asyncio.Semaphore(CLAUDE_MAX_CONCURRENCY)
+_claude_bg_sem = asyncio.Semaphore(max(1, CLAUDE_MAX_CONCURRENCY // 4))   # resúmenes: no quitan slots al chat
+_claude_breaker = {"fails": 0, "open_until": 0.0}
+
+def _claude_breaker_allow() -> bool:
+    if _claude_breaker["fails"] < CLAUDE_BREAKER_FAILS:
+        return True
+    now = time.monotonic()
+    if now < _claude_breaker["open_until"]:
+        return False
+    # Semi-abierto: deja pasar una sola prueba por ventana de cooldown
+    _claude_breaker["open_until"] = now + CLAUDE_BREAKER_COOLDOWN_SECS
+    return True
+
+def _claude_breaker_record(ok: bool):
+    if ok:
+        _claude_breaker["fails"] = 0
+        metric_set("claude.breaker_open", 0)
+        return
+    _claude_breaker["fails"] += 1
+    if _claude_breaker["fails"] >= CLAUDE_BREAKER_FAILS:
+        _claude_breaker["open_until"] = time.monotonic() + CLAUDE_BREAKER_COOLDOWN_SECS
+        metric_set("claude.breaker_open", 1)
+        print(f"CLAUDE> breaker open for {CLAUDE_BREAKER_COOLDOWN_SECS:.0f}s")
+
+WA_TEXT_MAX = 4096
+_SENTENCE_END = re.compile(r"[.!?…](?=\s|$)|\n")
+
+def _stream_cut(buf: str, first: bool) -> int:
+    """Hasta dónde enviar del buffer: la primera frase completa sale ya; las siguientes se
+    agrupan hasta LUNA_STREAM_MIN_CHARS para no mandar una burbuja por frase."""
+    ends = [m.end() for m in _SENTENCE_END.finditer(buf)]
+    if ends and (first or ends[-1] >= LUNA_STREAM_MIN_CHARS):
+        return ends[-1]
+    if len(buf) >= WA_TEXT_MAX:
+        sp = buf.rfind(" ", 0, WA_TEXT_MAX)
+        return sp if sp > 0 else WA_TEXT_MAX
+    return 0
+
+async def _claude_stream(system, messages: list, max_tokens: int, deliver, sent: list):
+    """`deliver(chunk)` no espera el envío: el tiempo de WhatsApp no cuenta contra el timeout."""
+    t0 = time.monotonic()
+    buf = ""
+    async with _claude.messages.stream(model=CLAUDE_MODEL, max_tokens=max_tokens, system=system, messages=messages) as stream:
+        async for delta in stream.text_stream:
+            buf += delta
+            cut = _stream_cut(buf, first=not sent)
+            if not cut:
+                continue
+            chunk, buf = buf[:cut].strip(), buf[cut:]
+            if chunk:
+                if not sent:
+                    metric_observe("claude.first_chunk_ms", (time.monotonic() - t0) * 1000)
+                sent.append(chunk)
+                deliver(chunk)
+        msg = await stream.get_final_message()
+    while buf.strip():
+        cut = _stream_cut(buf, first=False) if len(buf) >= WA_TEXT_MAX else len(buf)
+        chunk, buf = buf[:cut].strip(), buf[cut:]
+        if chunk:
+            sent.append(chunk)
+            deliver(chunk)
+    return msg
+
+class PartialReply(str):
+    """Texto entregado antes de que el streaming se cortara (no se cachea)."""
+
+async def claude_complete(system, messages: list, max_tokens: int = CLAUDE_MAX_TOKENS, usage: dict = None, on_text=None,
+                          background: bool = False) -> str:
+    """Gateway a Claude: límite de concurrencia, timeout por llamada y circuit breaker.
+    Devuelve "" si no hay respuesta a tiempo (el caller cae al flujo con botones).
+    Si se pasa `usage`, acumula ahí los tokens de la llamada. Con `on_text` (async) la
+    respuesta llega en streaming y se entrega por trozos de frases completas; si la
+    llamada se corta a mitad, se devuelve lo que ya se entregó.
+    background=True (trabajo que nadie espera): semáforo propio y fuera del breaker; con el
+    breaker abierto ni se intenta."""
+    if not _claude:
+        return ""
+    if background:
+        if _claude_breaker["fails"] >= CLAUDE_BREAKER_FAILS:
+            metric_inc("claude.short_circuit")
+            return ""
+    elif not _claude_breaker_allow():
+        metric_inc("claude.short_circuit")
+        return ""
+    sem = _claude_bg_sem if background else _claude_sem
+    try:
+        await asyncio.wait_for(sem.acquire(), CLAUDE_QUEUE_TIMEOUT_SECS)
+    except asyncio.TimeoutError:
+        metric_inc("claude.shed")
         return ""
+    t0 = time.monotonic()
+    sent = []
+    tail = None   # último envío de trozos: salen en orden, fuera del tiempo medido
+
+    def deliver(chunk: str):
+        nonlocal tail
+        prev = tail
+
+        async def _send():
+            if prev:
+                await prev
+            try:
+                await on_text(chunk)
+            except Exception as e:
+                print("Claude stream send error:", e)
+        tail = asyncio.create_task(_send())
+
+    try:
+        metric_inc("claude.calls")
+        if on_text:
+            call = _claude_stream(system, messages, max_tokens, deliver, sent)
+        else:
+            call = _claude.messages.create(model=CLAUDE_MODEL, max_tokens=max_tokens, system=system, messages=messages)
+        msg = await asyncio.wait_for(call, CLAUDE_TIMEOUT_SECS)
+    except asyncio.TimeoutError:
+        metric_inc("claude.timeouts")
+        if not background:
+            _claude_breaker_record(False)
+        print(f"Claude timeout after {CLAUDE_TIMEOUT_SECS:.0f}s")
+        return PartialReply("\n".join(sent))
+    except Exception as e:
+        metric_inc("claude.errors")
+        if not background:
+            _claude_breaker_record(False)
+        print("Claude error:", e)
+        return PartialReply("\n".join(sent))
+    finally:
+        sem.release()
+        elapsed_ms = (time.monotonic() - t0) * 1000
+        if tail:
+            # Los envíos se esperan recién aquí: un WhatsApp lento no es una falla de Claude
+            await tail
+    if not background:
+        _claude_breaker_record(True)
+    metric_observe("claude.latency_ms", elapsed_ms)
+    u = getattr(msg, "usage", None)
+    tokens = {
+        "in": getattr(u, "input_tokens", 0) or 0,
+        "out": getattr(u, "output_tokens", 0) or 0,
+        "cache_read": getattr(u, "cache_read_input_tokens", 0) or 0,
+        "cache_write": getattr(u, "cache_creation_input_tokens", 0) or 0,
+    }
+    for k, n in tokens.items():
+        metric_inc(f"claude.{k}_tokens", n)
+        if usage is not None:
+            usage[k] = usage.get(k, 0) + n
+    if usage is not None:
+        usage["calls"] = usage.get("calls", 0) + 1
+    print(f"CLAUDE> {elapsed_ms:.0f}ms in={tokens['in']} out={tokens['out']} cache_read={tokens['cache_read']}")
+    return "".join(getattr(b, "text", "") for b in (msg.content or [])).strip()
+
+# ---- Cache de respuestas (exacto por norm() + similitud TF-IDF de n-gramas de caracteres) ----
+# Slots fijos en arrays NumPy: memoria acotada y una sola multiplicación matriz-vector por consulta.
+LUNA_CACHE_DIM = 2048   # hashing trick para los n-gramas
+_lc_tf   = np.zeros((LUNA_CACHE_MAX, LUNA_CACHE_DIM), dtype=np.float32)
+_lc_tf2  = np.zeros((LUNA_CACHE_MAX, LUNA_CACHE_DIM), dtype=np.float32)   # tf², para las normas con IDF
+_lc_ctx  = np.full(LUNA_CACHE_MAX, -1, dtype=np.int32)      # -1 = slot libre
+_lc_exp  = np.zeros(LUNA_CACHE_MAX, dtype=np.float64)
+_lc_used = np.zeros(LUNA_CACHE_MAX, dtype=np.float64)       # último uso (LRU)
+_lc_df   = np.zeros(LUNA_CACHE_DIM, dtype=np.float32)       # document frequency (para IDF), incremental
+_lc_reply = [""] * LUNA_CACHE_MAX
+_lc_keys  = [None] * LUNA_CACHE_MAX
+_lc_exact = {}      # (ctx_id, texto normalizado) -> slot
+_lc_ctx_ids = {}    # (lang, city, service) -> int
+
+def _luna_cache_key(text: str) -> str:
+    # norm() + sin puntuación: "Do you have villas?" == "do you have villas"
+    return " ".join(re.findall(r"\w+", norm(text)))
+
+# Palabras que cambian el sentido aunque el texto se parezca ("isn't" => "isn", "t")
+LUNA_NEGATIONS = {"no", "not", "sin", "without", "never", "nunca", "ni", "nor", "t"}
+
+def _luna_cache_compatible(q: str, cached: str) -> bool:
+    """Un hit por similitud exige los mismos números, las mismas negaciones y el mismo
+    singular/plural: "10 people" != "20 people", "dog" != "dogs"."""
+    a, b = q.split(), cached.split()
+    if sorted(w for w in a if any(c.isdigit() for c in w)) != sorted(w for w in b if any(c.isdigit() for c in w)):
+        return False
+    if {w for w in a if w in LUNA_NEGATIONS} != {w for w in b if w in LUNA_NEGATIONS}:
+        return False
+    only_a, only_b = set(a) - set(b), set(b) - set(a)
+    return not any(x in (w + "s", w + "es") or w in (x + "s", x + "es") for w in only_a for x in only_b)
+
+def _ngram_tf(text: str) -> np.ndarray:
+    """Vector TF (log) de trigramas de caracteres por palabra, con hashing a LUNA_CACHE_DIM."""
+    v = np.zeros(LUNA_CACHE_DIM, dtype=np.float32)
+    for w in re.findall(r"\w+", text):
+        w = f" {w} "
+        for i in range(len(w) - 2):
+            v[zlib.crc32(w[i:i + 3].encode()) % LUNA_CACHE_DIM] += 1
+    np.log1p(v, out=v)
+    return v
+
+def _luna_cache_ctx(state: dict) -> int:
+    key = ((state.get("lang") or "EN").upper(), state.get("city") or "", state.get("service_type") or "")
+    ctx = _lc_ctx_ids.get(key)
+    if ctx is None:
+        ctx = _lc_ctx_ids[key] = len(_lc_ctx_ids)
+    return ctx
+
+def _luna_cache_hit_rate(kind: str):
+    metric_inc(f"luna_cache.{kind}")
+    c = METRICS["counters"]
+    hits = c.get("luna_cache.hit_exact", 0) + c.get("luna_cache.hit_similar", 0)
+    total = hits + c.get("luna_cache.miss", 0)
+    metric_set("luna_cache.hit_rate", round(hits / total, 4) if total else 0.0)
+
+def luna_cache_get(text: str, state: dict) -> str:
+    q = _luna_cache_key(text)
+    if not q:
+        return ""
+    ctx = _luna_cache_ctx(state)
+    now = time.time()
+
+    slot = _lc_exact.get((ctx, q))
+    if slot is not None and _lc_exp[slot] > now:
+        _lc_used[slot] = now
+        _luna_cache_hit_rate("hit_exact")
+        return _lc_reply[slot]
+
+    cand = np.flatnonzero((_lc_ctx == ctx) & (_lc_exp > now))
+    if cand.size:
+        # IDF sobre lo cacheado: los n-gramas comunes ("tienen", "the") pesan menos
+        n = int(np.count_nonzero(_lc_ctx >= 0))
+        idf = np.log((1 + n) / (1 + _lc_df)) + 1
+        w = idf * idf
+        qtf = _ngram_tf(q)
+        qn = float(np.sqrt((qtf * qtf) @ w))
+        if qn:
+            # coseno de (tf·idf): sin materializar la matriz ponderada
+            num = (_lc_tf @ (qtf * w))[cand]
+            den = np.sqrt((_lc_tf2 @ w)[cand]) * qn
+            sims = num / (den + 1e-9)
+            for best in np.argsort(-sims):
+                if sims[best] < LUNA_CACHE_MIN_SIM:
+                    break
+                slot = int(cand[best])
+                if not _luna_cache_compatible(q, _lc_keys[slot][1]):
+                    continue
+                _lc_used[slot] = now
+                _luna_cache_hit_rate("hit_similar")
+                return _lc_reply[slot]
+
+    _luna_cache_hit_rate("miss")
+    return ""
+
+def luna_cache_put(text: str, state: dict, reply: str):
+    q = _luna_cache_key(text)
+    if not q or not reply:
+        return
+    # Respuestas personalizadas (con el nombre del cliente) no se comparten
+    name = (state.get("name") or "").split()
+    if name and norm(name[0]) in norm(reply):
+        return
+    ctx = _luna_cache_ctx(state)
+    now = time.time()
+    slot = _lc_exact.get((ctx, q))
+    if slot is None:
+        free = np.flatnonzero((_lc_ctx < 0) | (_lc_exp <= now))
+        slot = int(free[0]) if free.size else int(np.argmin(_lc_used))
+        old = _lc_keys[slot]
+        if old is not None:
+            _lc_exact.pop(old, None)
+    if _lc_ctx[slot] >= 0:
+        _lc_df[:] -= _lc_tf[slot] > 0
+    _lc_tf[slot] = _ngram_tf(q)
+    _lc_tf2[slot] = _lc_tf[slot] * _lc_tf[slot]
+    _lc_df[:] += _lc_tf[slot] > 0
+    _lc_ctx[slot] = ctx
+    _lc_exp[slot] = now + LUNA_CACHE_TTL_SECS
+    _lc_used[slot] = now
+    _lc_reply[slot] = reply
+    _lc_keys[slot] = (ctx, q)
+    _lc_exact[(ctx, q)] = slot
+    metric_set("luna_cache.size", int(np.count_nonzero(_lc_ctx >= 0)))
+
+# ---- Memoria de conversación (transcript compacto en la sesión) ----
+# El bloque estático LUNA_SYSTEM lleva cache_control (prompt caching); el contexto del
+# cliente y el resumen van en un bloque aparte para no invalidar el prefijo cacheado.
+# Nota: Anthropic sólo cachea prefijos por encima de un mínimo de tokens por modelo;
+# por debajo la llamada funciona igual, sin descuento.
+LUNA_SUMMARY_SYSTEM = ("Summarize this WhatsApp conversation between a client and Luna (Two Travel sales assistant) "
+                       "in at most 3 short sentences. Keep the client's needs, dates, group size and open questions. "
+                       "Write in the client's language.")
+
+def _approx_tokens(text: str) -> int:
+    return len(text or "") // 4 + 1
+
+def _history_tokens(state: dict) -> int:
+    return _approx_tokens(state.get("luna_summary")) + sum(_approx_tokens(t.get("content")) for t in state.get("luna_history") or [])
+
+def _compaction_cut(state: dict) -> list:
+    """Turnos viejos a resumir si el transcript pasa el presupuesto ([] si no hace falta)."""
+    history = state.get("luna_history") or []
+    if _history_tokens(state) <= LUNA_HISTORY_TOKENS or len(history) <= LUNA_HISTORY_KEEP:
+        return []
+    cut = len(history) - LUNA_HISTORY_KEEP
+    cut -= cut % 2   # pares user/assistant: el transcript siempre arranca con "user"
+    return history[:cut]
+
+async def _compact_history(user: str):
+    """Resume los turnos viejos y deja los últimos LUNA_HISTORY_KEEP. Corre fuera del turno
+    (no demora los botones siguientes) y escribe con CAS sobre la sesión actual."""
+    turn = _session_turn.get()
+    if turn:
+        await turn.done.wait()   # si no, el flush del turno pisaría el transcript recortado
+    state = await get_session(user) or {}
+    old = _compaction_cut(state)
+    if not old:
+        return
+    lines = []
+    if state.get("luna_summary"):
+        lines.append(f"Earlier summary: {state['luna_summary']}")
+    lines += [f"{'Client' if t['role'] == 'user' else 'Luna'}: {t['content']}" for t in old]
+    usage = {}
+    summary = await claude_complete(LUNA_SUMMARY_SYSTEM, [{"role": "user", "content": "\n".join(lines)}],
+                                    max_tokens=150, usage=usage, background=True)
+
+    def apply(cur):
+        history = (cur or {}).get("luna_history") or []
+        if history[:len(old)] != old:
+            return None   # el transcript cambió en el medio (reinicio u otra compactación)
+        # Si el resumen falla, igual se recorta: el presupuesto manda
+        cur["luna_summary"] = summary or cur.get("luna_summary") or ""
+        cur["luna_history"] = history[len(old):]
+        tokens = cur.setdefault("luna_tokens", {})
+        for k, n in usage.items():
+            tokens[k] = tokens.get(k, 0) + n
+        return cur
+    await _cas_session(user, apply)
+
+_compactions = {}   # user -> Task (una compactación en vuelo por usuario)
+
+def schedule_compaction(user: str, state: dict):
+    if not _compaction_cut(state) or user in _compactions:
+        return
+    task = asyncio.create_task(_compact_history(user), name=f"luna-compact-{user}")
+    _compactions[user] = task
+    task.add_done_callback(lambda t: _compactions.pop(user, None))
+
+async def luna_ai_reply(user_message: str, state: dict, on_text=None) -> str:
+    """Respuesta de Luna ("" si no hay). Con `on_text` (async) el texto se va entregando
+    en streaming y el caller no debe reenviarlo."""
+    if not _claude:
+        return ""
+    # El cache sólo aplica sin historia: con transcript la respuesta depende de la conversación
+    fresh = not state.get("luna_history") and not state.get("luna_summary")
+    cached = luna_cache_get(user_message, state) if fresh else ""
+    if cached:
+        state["luna_history"] = [{"role": "user", "content": user_message}, {"role": "assistant", "content": cached}]
+        if on_text:
+            await on_text(cached)
+        return cached
     try:
-        client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
         context_bits = []
         if state.get("name"):
             context_bits.append(f"Client name: {state['name']}")
@@ -366,68 +1113,282 @@ def luna_ai_reply(user_message: str, state: dict) -> str:
             context_bits.append(f"Service interest: {state['service_type']}")
         if state.get("lang"):
             context_bits.append(f"Language preference: {state['lang']}")
-        system = LUNA_SYSTEM
+        if state.get("luna_summary"):
+            context_bits.append(f"Conversation so far: {state['luna_summary']}")
+        system = [{"type": "text", "text": LUNA_SYSTEM, "cache_control": {"type": "ephemeral"}}]
         if context_bits:
-            system += "\n\nCurrent client context:\n" + "\n".join(context_bits)
-        msg = client.messages.create(
-            model="claude-haiku-4-5-20251001",
-            max_tokens=300,
-            system=system,
-            messages=[{"role": "user", "content": user_message}],
-        )
-        return (msg.content[0].text or "").strip()
+            system.append({"type": "text", "text": "Current client context:\n" + "\n".join(context_bits)})
+        history = list(state.get("luna_history") or [])
+        reply = await claude_complete(system, history + [{"role": "user", "content": user_message}],
+                                      usage=state.setdefault("luna_tokens", {}), on_text=on_text)
+        if not reply:
+            return ""
+        if fresh and not isinstance(reply, PartialReply):
+            luna_cache_put(user_message, state, reply)
+        state["luna_history"] = history + [{"role": "user", "content": user_message},
+                                           {"role": "assistant", "content": reply}]
+        return reply
     except Exception as e:
         print("Claude error:", e)
         return ""
 
+async def luna_reply_to(user: str, user_message: str, state: dict) -> str:
+    """Responde al usuario por WhatsApp con Luna (en streaming si LUNA_STREAM)."""
+    if LUNA_STREAM:
+        reply = await luna_ai_reply(user_message, state, on_text=lambda chunk: wa_send_text(user, chunk))
+    else:
+        reply = await luna_ai_reply(user_message, state)
+        if reply:
+            await wa_send_text(user, reply)
+    if reply:
+        schedule_compaction(user, state)
+    return reply
+
+# ==================== HTTP (async) ====================
+# Un cliente async con pool keep-alive por host (Graph / HubSpot): sin handshake
+# TCP+TLS en cada llamada. 429/5xx se reintentan con backoff exponencial + jitter
+# respetando Retry-After.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+SAFE_RETRY_STATUSES = {429, 503}   # para POST no idempotentes (crear contacto/deal/mensaje)
+
+def _http_client(pool_size: int, timeout_secs: float) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=HTTP_KEEPALIVE_SECS),
+        timeout=httpx.Timeout(timeout_secs, connect=HTTP_CONNECT_TIMEOUT_SECS),
+    )
+
+_graph_http   = _http_client(GRAPH_POOL_SIZE, GRAPH_TIMEOUT_SECS)
+_hubspot_http = _http_client(HUBSPOT_POOL_SIZE, HUBSPOT_TIMEOUT_SECS)
+
+def _retry_after_secs(r) -> float | None:
+    raw = (r.headers.get("Retry-After") or "").strip()
+    if not raw:
+        return None
+    try:
+        return max(0.0, float(raw))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(0.0, (parsedate_to_datetime(raw) - datetime.now(ZoneInfo("UTC"))).total_seconds())
+    except Exception:
+        return None
+
+def _backoff_secs(attempt: int) -> float:
+    # "Full jitter": uniforme entre 0 y base*2^n (con tope)
+    return random.uniform(0, min(HTTP_BACKOFF_MAX_SECS, HTTP_BACKOFF_BASE_SECS * (2 ** attempt)))
+
+async def http_request(client: httpx.AsyncClient, method: str, url: str, idempotent: bool | None = None,
+                       retries: int = HTTP_MAX_RETRIES, **kw) -> httpx.Response:
+    """
+    Request con reintentos. idempotent=None => GET/PUT/PATCH/DELETE sí, POST no.
+    En no idempotentes sólo se reintenta lo que seguro no se procesó (429/503, fallo al conectar).
+    Lanza la última excepción de red si se agotan los intentos. retries=0 => un solo intento
+    (cuando el caller tiene su propia política, p.ej. el carril de WhatsApp).
+    """
+    if idempotent is None:
+        idempotent = method.upper() != "POST"
+    statuses = RETRY_STATUSES if idempotent else SAFE_RETRY_STATUSES
+    for attempt in range(retries + 1):
+        last = attempt >= retries
+        try:
+            r = await client.request(method, url, **kw)
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+            if last:
+                raise
+            await asyncio.sleep(_backoff_secs(attempt))
+            continue
+        except httpx.TransportError:
+            if last or not idempotent:
+                raise
+            await asyncio.sleep(_backoff_secs(attempt))
+            continue
+        if r.status_code not in statuses or last:
+            return r
+        wait = _retry_after_secs(r)
+        wait = min(HTTP_BACKOFF_MAX_SECS, wait) if wait is not None else _backoff_secs(attempt)
+        print(f"HTTP {r.status_code} {method} {url[:80]} → retry en {wait:.1f}s")
+        await asyncio.sleep(wait)
+    return r
+
+@app.on_event("shutdown")
+async def close_clients():
+    # Lo que ya estaba encolado para WhatsApp sale antes de cerrar el pool
+    if _wa_out_tasks:
+        await asyncio.wait(list(_wa_out_tasks.values()), timeout=5)
+    await _graph_http.aclose()
+    await _hubspot_http.aclose()
+    if _claude:
+        await _claude.close()
+    if _redis:
+        await _redis.aclose()
+    if _rsess:
+        await _rsess.aclose()
+
 # ==================== WHATSAPP HELPERS ====================
-def _post_graph(path: str, payload: dict):
+class TokenBucket:
+    """Rate limit async: `rate` tokens/seg con ráfagas de hasta `burst`."""
+    def __init__(self, rate: float, burst: int):
+        self.rate = max(rate, 0.001)
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def drain(self):
+        """Vacía el bucket (p.ej. cuando el servidor avisa que vamos muy rápido)."""
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+def _wa_json(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+async def _post_graph(path: str, payload: dict | bytes):
+    """payload: dict, o el cuerpo JSON ya serializado (plantillas de UI).
+    Un solo intento: los reintentos los decide _wa_deliver."""
     url = f"https://graph.facebook.com/v23.0/{path}"
     headers = {"Authorization": f"Bearer {WA_TOKEN}", "Content-Type":"application/json"}
     try:
-        r = requests.post(url, headers=headers, json=payload, timeout=25)
+        body = payload if isinstance(payload, bytes) else _wa_json(payload)
+        r = await http_request(_graph_http, "POST", url, headers=headers, content=body, retries=0)
         print(f"WA -> {r.status_code} {r.text[:240]}")
         return r
     except Exception as e:
         print("WA POST error:", e)
-        class Dummy: status_code=599; text=str(e)
+        # Sin conexión el request no llegó a Graph: se puede reintentar sin duplicar
+        not_sent = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+        class Dummy: status_code=599; text=str(e); headers={}
+        Dummy.not_sent = not_sent
         return Dummy()
 
-def wa_send_text(to: str, body: str):
+# ---- Envío saliente: carril por destinatario + rate limit global y por número ----
+# Los envíos a un mismo número salen en el orden en que se pidieron aunque vengan de
+# tareas concurrentes. Sólo se reintenta lo que Graph seguro no aceptó (rate limits,
+# 429/503, fallo al conectar): reintentar otra cosa puede duplicar el mensaje.
+_wa_bucket = TokenBucket(WA_SEND_MPS, WA_SEND_BURST)
+_wa_pair_buckets = collections.OrderedDict()   # to -> TokenBucket (LRU)
+_wa_out_lanes = {}   # to -> deque[(payload, future, t0)]
+_wa_out_tasks = {}   # to -> Task
+
+def _wa_pair_bucket(to: str) -> TokenBucket:
+    b = _wa_pair_buckets.pop(to, None) or TokenBucket(WA_PAIR_MPS, WA_PAIR_BURST)
+    _wa_pair_buckets[to] = b
+    while len(_wa_pair_buckets) > WA_PAIR_MAX:
+        _wa_pair_buckets.popitem(last=False)
+    return b
+
+def _wa_error_code(r) -> int | None:
+    if r.status_code < 400:
+        return None
+    try:
+        return int(r.json()["error"]["code"])
+    except Exception:
+        return None
+
+async def _wa_deliver(to: str, payload: dict | bytes):
+    pair = _wa_pair_bucket(to)
+    for attempt in range(1, WA_SEND_MAX_ATTEMPTS + 1):
+        await pair.acquire()
+        await _wa_bucket.acquire()
+        r = await _post_graph(f"{WA_PHONE_ID}/messages", payload)
+        code = _wa_error_code(r)
+        retry = (code in WA_RETRY_CODES or r.status_code in SAFE_RETRY_STATUSES
+                 or getattr(r, "not_sent", False))
+        if not retry or attempt == WA_SEND_MAX_ATTEMPTS:
+            return r
+        if code == 130429:
+            _wa_bucket.drain()
+        wait = _retry_after_secs(r)
+        wait = min(HTTP_BACKOFF_MAX_SECS, wait) if wait is not None else max(WA_RETRY_MIN_SECS, _backoff_secs(attempt))
+        metric_inc("wa.send_retries")
+        print(f"WA {code or r.status_code} → reintento {attempt}/{WA_SEND_MAX_ATTEMPTS - 1} a {to} en {wait:.1f}s")
+        await asyncio.sleep(wait)
+    return r
+
+async def _wa_out_lane(to: str):
+    lane = _wa_out_lanes[to]
+    try:
+        while lane:
+            payload, fut, t0 = lane[0]
+            try:
+                if fut.done():
+                    continue   # quien lo pidió ya no espera (cancelado)
+                r = await _wa_deliver(to, payload)
+                ms = (time.perf_counter() - t0) * 1000
+                metric_observe("wa.send_ms", ms)
+                if r.status_code >= 400:
+                    metric_inc(f"wa.send_failed.{_wa_error_code(r) or r.status_code}")
+                    metric_observe("wa.send_failed_ms", ms)
+                else:
+                    metric_inc("wa.sent")
+                if not fut.done():
+                    fut.set_result(r)
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            finally:
+                lane.popleft()
+    finally:
+        for _, fut, _ in lane:
+            fut.cancel()
+        _wa_out_lanes.pop(to, None)
+        _wa_out_tasks.pop(to, None)
+        metric_set("wa.out_lanes", len(_wa_out_tasks))
+
+async def wa_send(to: str, payload: dict | bytes):
+    """Encola el mensaje en el carril del destinatario y espera la respuesta de Graph."""
+    turn = _session_turn.get()
+    if turn:
+        turn.sent = True
+    fut = asyncio.get_running_loop().create_future()
+    _wa_out_lanes.setdefault(to, collections.deque()).append((payload, fut, time.perf_counter()))
+    if to not in _wa_out_tasks:
+        _wa_out_tasks[to] = asyncio.create_task(_wa_out_lane(to), name=f"wa-out-{to}")
+        metric_set("wa.out_lanes", len(_wa_out_tasks))
+    return await fut
+
+async def wa_send_text(to: str, body: str):
     payload = {"messaging_product":"whatsapp","to":to,"type":"text","text":{"body":body[:4096]}}
-    return _post_graph(f"{WA_PHONE_ID}/messages", payload)
-
-def wa_send_buttons(to: str, body_text: str, buttons: list):
-    payload = {
-        "messaging_product":"whatsapp",
-        "to":to,
-        "type":"interactive",
-        "interactive":{
-            "type":"button",
-            "body":{"text": body_text[:1024]},
-            "action":{"buttons":[{"type":"reply","reply":b} for b in buttons[:3]]}
-        }
+    return await wa_send(to, payload)
+
+def _buttons_interactive(body_text: str, buttons: list) -> dict:
+    return {
+        "type":"button",
+        "body":{"text": body_text[:1024]},
+        "action":{"buttons":[{"type":"reply","reply":b} for b in buttons[:3]]}
     }
-    return _post_graph(f"{WA_PHONE_ID}/messages", payload)
 
-def wa_send_list(to: str, header_text: str, body_text: str, button_text: str, rows: list):
+def _list_interactive(header_text: str, body_text: str, button_text: str, rows: list) -> dict:
     # Librería WA limita longitudes
-    payload = {
-        "messaging_product":"whatsapp",
-        "to":to,
-        "type":"interactive",
-        "interactive":{
-            "type":"list",
-            "header":{"type":"text","text": header_text[:60]},
-            "body":{"text": body_text[:1024]},
-            "footer":{"text":"Two Travel"},
-            "action":{
-                "button": button_text[:20],
-                "sections":[{"title":"Select one","rows": rows[:10]}]
-            }
+    return {
+        "type":"list",
+        "header":{"type":"text","text": header_text[:60]},
+        "body":{"text": body_text[:1024]},
+        "footer":{"text":"Two Travel"},
+        "action":{
+            "button": button_text[:20],
+            "sections":[{"title":"Select one","rows": rows[:10]}]
         }
     }
-    return _post_graph(f"{WA_PHONE_ID}/messages", payload)
+
+async def wa_send_buttons(to: str, body_text: str, buttons: list):
+    payload = {"messaging_product":"whatsapp","to":to,"type":"interactive","interactive":_buttons_interactive(body_text, buttons)}
+    return await wa_send(to, payload)
+
+async def wa_send_list(to: str, header_text: str, body_text: str, button_text: str, rows: list):
+    payload = {"messaging_product":"whatsapp","to":to,"type":"interactive","interactive":_list_interactive(header_text, body_text, button_text, rows)}
+    return await wa_send(to, payload)
 
 def extract_text_or_reply(m: dict):
     t = (m.get("type") or "").lower()
@@ -451,26 +1412,200 @@ def wa_click_number(num: str) -> str:
     return re.sub(r"\D", "", num or "")
 
 # ==================== EMAIL (VENTAS) ====================
+# Una conexión SMTP autenticada y persistente, usada siempre desde el mismo hilo
+# (smtplib es bloqueante y no es thread-safe). Si el server la cerró, se reconecta.
+_smtp_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="smtp")
+_smtp = {"conn": None, "used_at": 0.0}
+
+def _smtp_close():
+    conn, _smtp["conn"] = _smtp["conn"], None
+    if conn:
+        try:
+            conn.quit()
+        except Exception:
+            pass
+
+def _smtp_conn():
+    conn = _smtp["conn"]
+    if conn is not None and time.time() - _smtp["used_at"] > SMTP_IDLE_SECS:
+        try:
+            if conn.noop()[0] != 250:
+                raise smtplib.SMTPServerDisconnected("noop failed")
+        except Exception:
+            _smtp_close()
+            conn = None
+    if conn is None:
+        conn = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=25)
+        conn.starttls()
+        conn.login(SMTP_USER, SMTP_PASS)
+        _smtp["conn"] = conn
+        metric_inc("mail.connects")
+    return conn
+
 def send_sales_email(subject: str, body: str):
     if not (SMTP_HOST and SMTP_USER and SMTP_PASS and SALES_EMAILS):
         print("EMAIL [noop]>", subject, "\n", body[:600])
-        return False
+        return True
     msg = MIMEText(body, "plain", "utf-8")
     msg["Subject"] = subject[:200]
     msg["From"] = SMTP_USER
     msg["To"] = ", ".join(SALES_EMAILS)
+    for attempt in (1, 2):   # un reintento inmediato si la conexión guardada estaba muerta
+        try:
+            _smtp_conn().sendmail(SMTP_USER, SALES_EMAILS, msg.as_string())
+            _smtp["used_at"] = time.time()
+            print("EMAIL sent to:", SALES_EMAILS)
+            return True
+        except (smtplib.SMTPServerDisconnected, OSError) as e:
+            _smtp_close()
+            if attempt == 2:
+                print("EMAIL error:", e)
+        except Exception as e:
+            _smtp_close()
+            print("EMAIL error:", e)
+            break
+    return False
+
+# ---- Cola de emails (Redis + fallback en memoria), vaciada en background ----
+MAIL_PENDING_KEY = "two_travel:mail:pending"
+MAIL_RETRY_KEY   = "two_travel:mail:retry"     # zset email fallido -> epoch del próximo intento
+_mail_pending = []
+_mail_retry = []    # fallback en memoria de MAIL_RETRY_KEY
+_mail_wakeup = asyncio.Event()
+_mail_sender = None
+
+async def mail_enqueue(item: dict):
+    item.setdefault("attempts", 0)
+    item.setdefault("queued_at", time.time())
+    if _redis:
+        try:
+            await _redis.rpush(MAIL_PENDING_KEY, json.dumps(item))
+            if not MAIL_DIGEST_SECS:
+                _mail_wakeup.set()
+            return
+        except Exception as e:
+            print("Redis mail enqueue error:", e)
+    _mail_pending.append(item)
+    if not MAIL_DIGEST_SECS:
+        _mail_wakeup.set()
+
+async def mail_retry_later(item: dict):
+    """Vuelve a la cola con backoff exponencial (sin despertar al sender: un SMTP caído no se
+    reintenta en ráfaga)."""
+    item["next_at"] = time.time() + MAIL_FLUSH_SECS * 2 ** item.get("attempts", 0)
+    if _redis:
+        try:
+            await _redis.zadd(MAIL_RETRY_KEY, {json.dumps(item): item["next_at"]})
+            return
+        except Exception as e:
+            print("Redis mail retry error:", e)
+    _mail_retry.append(item)
+
+async def _mail_take(n: int) -> list:
+    """Primero los reintentos que ya vencieron, luego lo nuevo."""
+    items = []
+    now = time.time()
+    if _redis:
+        try:
+            due = await _redis.zrangebyscore(MAIL_RETRY_KEY, "-inf", now, start=0, num=n)
+            if due:
+                pipe = _redis.pipeline(transaction=False)
+                for raw in due:
+                    pipe.zrem(MAIL_RETRY_KEY, raw)
+                # ZREM == 0: lo tomó otro proceso
+                items = [json.loads(raw) for raw, took in zip(due, await pipe.execute()) if took]
+            if len(items) < n:
+                raw = await _redis.lpop(MAIL_PENDING_KEY, n - len(items)) or []
+                items.extend(json.loads(x) for x in raw)
+        except Exception as e:
+            print("Redis mail take error:", e)
+    if len(items) < n and _mail_retry:
+        due = [it for it in _mail_retry if it["next_at"] <= now][:n - len(items)]
+        for it in due:
+            _mail_retry.remove(it)
+        items.extend(due)
+    if len(items) < n and _mail_pending:
+        k = n - len(items)
+        items.extend(_mail_pending[:k])
+        del _mail_pending[:k]
+    return items
+
+def _mail_digest(items: list) -> tuple:
+    subject = f"[Two Travel WA] {len(items)} lead events"
+    sep = "\n\n" + "-" * 40 + "\n\n"
+    body = sep.join(f"{it['subject']}\n\n{it['body']}" for it in items)
+    return subject, body
+
+async def mail_flush() -> int:
+    """Envía hasta MAIL_BATCH_SIZE emails pendientes (uno solo en modo digest). Devuelve cuántos salieron."""
+    items = await _mail_take(MAIL_BATCH_SIZE)
+    if not items:
+        return 0
+    loop = asyncio.get_running_loop()
+    if MAIL_DIGEST_SECS and len(items) > 1:
+        groups = [(items, *_mail_digest(items))]
+    else:
+        groups = [([it], it["subject"], it["body"]) for it in items]
+    sent = 0
+    for i, (group, subject, body) in enumerate(groups):
+        ok = await loop.run_in_executor(_smtp_executor, send_sales_email, subject, body)
+        if ok:
+            sent += len(group)
+            metric_inc("mail.sent", len(group))
+            continue
+        # Falló: éste y los que quedan vuelven a la cola (el server probablemente está caído)
+        metric_inc("mail.errors")
+        for it in [it for g in groups[i:] for it in g[0]]:
+            it["attempts"] = it.get("attempts", 0) + 1
+            if it["attempts"] < MAIL_MAX_ATTEMPTS:
+                await mail_retry_later(it)
+            else:
+                print("❌ Email descartado tras reintentos:", it.get("subject"))
+                metric_inc("mail.dropped")
+        break
+    return sent
+
+async def _mail_sender_loop():
+    while True:
+        if MAIL_DIGEST_SECS:
+            await asyncio.sleep(MAIL_DIGEST_SECS)
+        else:
+            try:
+                await asyncio.wait_for(_mail_wakeup.wait(), timeout=MAIL_FLUSH_SECS)
+            except asyncio.TimeoutError:
+                pass
+        _mail_wakeup.clear()
+        try:
+            # Si algo falla, mail_flush devuelve < batch y esperamos a la próxima vuelta
+            while await mail_flush() >= MAIL_BATCH_SIZE:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("Mail sender error:", e)
+
+@app.on_event("startup")
+async def start_mail_sender():
+    global _mail_sender
+    if not _mail_sender:
+        _mail_sender = asyncio.create_task(_mail_sender_loop(), name="mail-sender")
+
+@app.on_event("shutdown")
+async def stop_mail_sender():
+    global _mail_sender
+    if _mail_sender:
+        _mail_sender.cancel()
+        await asyncio.gather(_mail_sender, return_exceptions=True)
+        _mail_sender = None
+    # Último intento (lo que no salga queda en Redis para el próximo arranque)
     try:
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=25) as s:
-            s.starttls()
-            s.login(SMTP_USER, SMTP_PASS)
-            s.sendmail(SMTP_USER, SALES_EMAILS, msg.as_string())
-        print("EMAIL sent to:", SALES_EMAILS)
-        return True
+        while await mail_flush():
+            pass
     except Exception as e:
-        print("EMAIL error:", e)
-        return False
+        print("Mail final flush error:", e)
+    await asyncio.get_running_loop().run_in_executor(_smtp_executor, _smtp_close)
 
-def notify_sales(event: str, state: dict, phone: str, extra: str = "", cal_url: str = "", owner_name: str = "", pretty_city: str = ""):
+async def notify_sales(event: str, state: dict, phone: str, extra: str = "", cal_url: str = "", owner_name: str = "", pretty_city: str = ""):
     name  = state.get("name") or "-"
     email = state.get("email") or "-"
     lang  = state.get("lang") or "-"
@@ -478,7 +1613,7 @@ def notify_sales(event: str, state: dict, phone: str, extra: str = "", cal_url:
     city  = pretty_city or (state.get("city") or "-")
     date  = state.get("date") or "-"
     pax   = state.get("pax") or state.get("wed_guests") or "-"
-    top   = state.get("last_top") or []
+    top   = await asyncio.to_thread(resolve_top, state.get("last_top"))   # en frío puede cargar el sheet
     tops  = "\n".join([f"- {r.get('name')} → {r.get('url_page')}" for r in top[:TOP_K]]) if top else "-"
     lines = [
         f"Event: {event}",
@@ -498,54 +1633,28 @@ def notify_sales(event: str, state: dict, phone: str, extra: str = "", cal_url:
         lines.append(f"Extra: {extra}")
     subject = f"[Two Travel WA] {svc.title()} – {city} – {name}"
     body = "\n".join(lines)
-    send_sales_email(subject, body)
+    # Lo envía el mail sender en background (conexión SMTP persistente)
+    await mail_enqueue({"subject": subject, "body": body})
 
 # ==================== HUBSPOT HELPERS ====================
-def hubspot_find_or_create_contact(name: str, email: str, phone: str, lang: str):
-    if not HUBSPOT_TOKEN:
-        print("WARN: HUBSPOT_TOKEN missing")
-        return None
+def _hubspot_headers() -> dict:
+    return {"Authorization": f"Bearer {HUBSPOT_TOKEN}", "Content-Type": "application/json"}
 
-    base = "https://api.hubapi.com/crm/v3/objects/contacts"
-    headers = {"Authorization": f"Bearer {HUBSPOT_TOKEN}", "Content-Type": "application/json"}
-
-    # === 1) Validación previa del email ===
-    if email:
-        clean_email = sanitize_email_input(email)
-        if not EMAIL_RE.match(clean_email):
-            print(f"⚠️ Email inválido o incompleto: {clean_email}. Se omitirá y no se usará en HubSpot.")
-            clean_email = None
-        elif "." not in clean_email.split("@")[-1]:
-            print(f"⚠️ Email sin dominio completo: {clean_email}. Se omitirá.")
-            clean_email = None
-        email = clean_email or None
-    else:
-        email = None
-
-    cid = None
-
-    # === 2) Buscar contacto existente por email (si es válido) ===
-    if email:
-        try:
-            s = requests.post(
-                f"{base}/search",
-                headers=headers,
-                json={
-                    "filterGroups": [
-                        {"filters": [{"propertyName": "email", "operator": "EQ", "value": email}]}
-                    ],
-                    "properties": ["email"]
-                },
-                timeout=20
-            )
-            if s.ok and s.json().get("results"):
-                cid = s.json()["results"][0]["id"]
-                print(f"ℹ️ Contacto existente encontrado: {cid}")
-        except Exception as e:
-            print("❌ HubSpot search error:", e)
+def _hubspot_email(email: str):
+    """Email apto para HubSpot o None (inválido / sin dominio completo)."""
+    if not email:
+        return None
+    clean_email = sanitize_email_input(email)
+    if not EMAIL_RE.match(clean_email):
+        print(f"⚠️ Email inválido o incompleto: {clean_email}. Se omitirá y no se usará en HubSpot.")
+        return None
+    if "." not in clean_email.split("@")[-1]:
+        print(f"⚠️ Email sin dominio completo: {clean_email}. Se omitirá.")
+        return None
+    return clean_email
 
-    # === 3) Propiedades del contacto ===
-    props = {
+def _contact_props(name: str, email: str, phone: str, lang: str) -> dict:
+    return {
         "email": email or None,
         "firstname": (name.split()[0] if name else None),
         "lastname": (" ".join(name.split()[1:]) if name and len(name.split()) > 1 else None),
@@ -555,49 +1664,6 @@ def hubspot_find_or_create_contact(name: str, email: str, phone: str, lang: str)
         "hs_language": ("es" if (lang or "").upper().startswith("ES") else "en"),
     }
 
-    # === 4) Actualizar si ya existía ===
-    if cid:
-        try:
-            up = requests.patch(f"{base}/{cid}", headers=headers, json={"properties": props}, timeout=20)
-            print("HubSpot contact update:", up.status_code, up.text[:150])
-            return cid if up.ok else None
-        except Exception as e:
-            print("❌ HubSpot contact update error:", e)
-            return None
-
-    # === 5) Crear nuevo contacto ===
-    try:
-        r = requests.post(base, headers=headers, json={"properties": props}, timeout=20)
-        if r.status_code == 201:
-            cid = r.json().get("id")
-            print("✅ HubSpot contact created:", cid)
-            return cid
-        print("❌ HubSpot contact error:", r.status_code, r.text[:200])
-    except Exception as e:
-        print("❌ HubSpot contact create error:", e)
-
-    return None
-
-def hubspot_log_note(contact_id: str, deal_id: str, note: str):
-    if not HUBSPOT_TOKEN or not note:
-        return
-    headers = {"Authorization": f"Bearer {HUBSPOT_TOKEN}", "Content-Type": "application/json"}
-    try:
-        r = requests.post(
-            "https://api.hubapi.com/crm/v3/objects/notes",
-            headers=headers,
-            json={"properties": {"hs_note_body": note, "hs_timestamp": datetime.now(ZoneInfo("America/Bogota")).isoformat()}},
-            timeout=20
-        )
-        note_id = r.json().get("id")
-        if note_id and contact_id:
-            requests.put(f"https://api.hubapi.com/crm/v3/objects/notes/{note_id}/associations/contacts/{contact_id}/note_to_contact", headers=headers, json={}, timeout=10)
-        if note_id and deal_id:
-            requests.put(f"https://api.hubapi.com/crm/v3/objects/notes/{note_id}/associations/deals/{deal_id}/note_to_deal", headers=headers, json={}, timeout=10)
-        print(f"✅ Nota logueada en HubSpot: {note_id}")
-    except Exception as e:
-        print("HubSpot note error:", e)
-
 def build_wa_note(state: dict, phone: str) -> str:
     """Construye nota legible con todo lo que Luna capturó del cliente."""
     lines = ["📱 *Lead capturado por Luna (WhatsApp)*", ""]
@@ -621,99 +1687,691 @@ def build_wa_note(state: dict, phone: str) -> str:
         lines.append(f"⚠️ Cliente abandonó en el paso: {step}")
     return "\n".join(lines)
 
-def hubspot_upsert_deal(state: dict, title: str, desc: str, phone: str = ""):
-    """Actualiza el early deal si existe, si no crea uno nuevo. Siempre loguea nota."""
-    early_id = state.get("early_deal_id")
-    contact_id = state.get("contact_id")
-    deal_id = None
-
-    if early_id:
-        hubspot_update_deal(early_id, title, desc)
-        print(f"✅ Early deal actualizado: {early_id}")
-        deal_id = early_id
-    elif contact_id:
-        deal_id = hubspot_create_deal(contact_id, HUBSPOT_OWNER_RAY, title, desc)
-        print(f"✅ Deal creado: {deal_id}")
-
-    # Log nota con todo el contexto de WhatsApp
-    if deal_id and phone:
-        note = build_wa_note(state, phone)
-        hubspot_log_note(contact_id, deal_id, note)
-
-    return deal_id
-
-def hubspot_update_deal(deal_id, title, desc):
-    if not HUBSPOT_TOKEN or not deal_id:
-        return False
-    headers = {"Authorization": f"Bearer {HUBSPOT_TOKEN}", "Content-Type": "application/json"}
-    props = {"dealname": title[:250], "description": desc[:65530]}
-    try:
-        r = requests.patch(f"https://api.hubapi.com/crm/v3/objects/deals/{deal_id}", headers=headers, json={"properties": props}, timeout=20)
-        print(f"Deal updated {deal_id}:", r.status_code)
-        return r.ok
-    except Exception as e:
-        print("HubSpot deal update error:", e)
-        return False
 
-def hubspot_create_deal(contact_id, owner_id, title, desc):
+# ==================== HUBSPOT SYNC (batch, en background) ====================
+# Los turnos no llaman a HubSpot: encolan operaciones (contacto / deal+nota) y
+# un flusher las agrupa por usuario cada HUBSPOT_FLUSH_SECS (o al llegar a
+# HUBSPOT_BATCH_SIZE) y las manda por los endpoints batch de CRM v3/v4.
+# Un reintento nunca duplica: los contactos creados quedan en el cache de contactos y
+# los deals en HS_DEAL_IDS, por conversación (un deal nuevo por sesión, como siempre).
+HS_PENDING_KEY     = "two_travel:hs:pending"
+HS_DEAL_IDS_PREFIX = "two_travel:hs:deal"   # string por conversación -> deal_id, con TTL
+HS_API         = "https://api.hubapi.com"
+HS_BATCH_MAX   = 100          # límite de inputs por llamada batch de HubSpot
+ASSOC_DEAL_TO_CONTACT = 3
+ASSOC_NOTE_TO_CONTACT = 202
+ASSOC_NOTE_TO_DEAL    = 214
+
+_hs_pending = []              # fallback en memoria de la cola de operaciones
+HS_DEAL_IDS = collections.OrderedDict()   # fallback en memoria (LRU): conv -> (deal_id, expira)
+_hs_wakeup = asyncio.Event()
+_hs_flusher = None
+
+async def hubspot_enqueue(op: dict):
+    op.setdefault("attempts", 0)
     if not HUBSPOT_TOKEN:
         print("WARN: HUBSPOT_TOKEN missing")
-        return None
-    headers = {"Authorization": f"Bearer {HUBSPOT_TOKEN}", "Content-Type": "application/json"}
-    base = "https://api.hubapi.com/crm/v3/objects/deals"
-    props = {"dealname": title[:250], "description": desc[:65530]}
-    if HUBSPOT_PIPELINE_ID:  props["pipeline"]  = HUBSPOT_PIPELINE_ID
-    if HUBSPOT_DEALSTAGE_ID: props["dealstage"] = HUBSPOT_DEALSTAGE_ID
-    if owner_id:             props["hubspot_owner_id"] = owner_id
+        return
+    if _redis:
+        try:
+            size = await _redis.rpush(HS_PENDING_KEY, json.dumps(op))
+            if size >= HUBSPOT_BATCH_SIZE:
+                _hs_wakeup.set()
+            return
+        except Exception as e:
+            print("Redis hs enqueue error:", e)
+    _hs_pending.append(op)
+    if len(_hs_pending) >= HUBSPOT_BATCH_SIZE:
+        _hs_wakeup.set()
+
+# ---- Cache teléfono/email -> contact_id (+ últimas propiedades enviadas) ----
+# Redis: un hash por clave ("id", "props") con TTL; sin Redis, LRU en memoria.
+# Sirve para no volver a buscar/upsertear el contacto y para sólo hacer PATCH
+# cuando cambió algo relevante (nombre, email, idioma).
+CONTACT_CACHE_PREFIX = "two_travel:hs:cc"
+CONTACT_DIFF_FIELDS  = ("email", "firstname", "lastname", "phone", "hs_language")
+_contact_cache = collections.OrderedDict()   # clave -> {"id": ..., "props": {...}}
+
+def _cc_keys(phone: str, email: str) -> list:
+    keys = []
+    if phone: keys.append(f"{CONTACT_CACHE_PREFIX}:p:{wa_click_number(phone)}")
+    if email: keys.append(f"{CONTACT_CACHE_PREFIX}:e:{email.lower()}")
+    return keys
+
+async def contact_cache_get(phone: str, email: str = "") -> dict:
+    """{"id": ..., "props": {...}} del primer hit (teléfono, luego email) o {}."""
+    for key in _cc_keys(phone, email):
+        hit = _contact_cache.get(key)
+        if hit:
+            _contact_cache.move_to_end(key)
+            metric_inc("hubspot.contact_cache.hit")
+            return hit
+        if _redis:
+            try:
+                raw = await _redis.hgetall(key)
+                if raw and raw.get("id"):
+                    hit = {"id": raw["id"], "props": json.loads(raw.get("props") or "{}")}
+                    _cc_remember(key, hit)
+                    metric_inc("hubspot.contact_cache.hit")
+                    return hit
+            except Exception as e:
+                print("Redis contact cache get error:", e)
+    metric_inc("hubspot.contact_cache.miss")
+    return {}
+
+def _cc_remember(key: str, entry: dict):
+    _contact_cache[key] = entry
+    _contact_cache.move_to_end(key)
+    while len(_contact_cache) > CONTACT_CACHE_MAX:
+        _contact_cache.popitem(last=False)
+
+async def contact_cache_put(cid: str, phone: str, email: str, props: dict):
+    entry = {"id": cid, "props": {k: props.get(k) for k in CONTACT_DIFF_FIELDS}}
+    keys = _cc_keys(phone, email)
+    for key in keys:
+        _cc_remember(key, entry)
+    if _redis and keys:
+        try:
+            pipe = _redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.hset(key, mapping={"id": cid, "props": json.dumps(entry["props"])})
+                pipe.expire(key, CONTACT_CACHE_TTL_SECS)
+            await pipe.execute()
+        except Exception as e:
+            print("Redis contact cache set error:", e)
+
+def _contact_dirty(cached_props: dict, props: dict) -> bool:
+    if not cached_props:
+        return True
+    return any((cached_props.get(k) or None) != (props.get(k) or None) for k in CONTACT_DIFF_FIELDS)
+
+async def hubspot_sync_contact(state: dict, phone: str):
+    """Encola crear/actualizar el contacto del usuario; no hace nada si ya está al día en HubSpot."""
+    name  = state.get("name") or ""
+    email = _hubspot_email(state.get("email") or "") or ""
+    lang  = state.get("lang") or ""
+    cached = await contact_cache_get(phone, email)
+    if cached and not _contact_dirty(cached.get("props"), _contact_props(name, email, phone, lang)):
+        metric_inc("hubspot.contact_patch_skipped")
+        return
+    await hubspot_enqueue({
+        "kind": "contact",
+        "uid": wa_click_number(phone),
+        "phone": phone,
+        "name": name,
+        "email": email,
+        "lang": lang,
+        "contact_id": state.get("contact_id") or cached.get("id") or "",
+    })
+
+async def hubspot_upsert_deal(state: dict, title: str, desc: str, phone: str, with_note: bool = True, owner_id: str = ""):
+    """Encola: actualiza el deal del usuario si existe, si no lo crea. Con with_note, loguea nota."""
+    await hubspot_enqueue({
+        "kind": "deal",
+        "uid": wa_click_number(phone),
+        "phone": phone,
+        "title": title[:250],
+        "desc": desc[:65530],
+        "owner_id": owner_id or HUBSPOT_OWNER_RAY,
+        "note": build_wa_note(state, phone) if with_note else "",
+        "contact_id": state.get("contact_id") or "",
+        "deal_id": state.get("early_deal_id") or "",
+        "conv": state.get("conv") or "",
+    })
+
+async def _hs_deal_ids_get(convs: list) -> dict:
+    """conv -> (deal_id, contact_id con asociación pendiente o "")."""
+    convs = [c for c in convs if c]
+    if not convs:
+        return {}
+    if _redis:
+        try:
+            vals = await _redis.mget([f"{HS_DEAL_IDS_PREFIX}:{c}" for c in convs])
+            return {c: tuple((v.split("|", 1) + [""])[:2]) for c, v in zip(convs, vals) if v}
+        except Exception as e:
+            print("Redis hs deal ids get error:", e)
+    now = time.time()
+    return {c: HS_DEAL_IDS[c][0] for c in convs if c in HS_DEAL_IDS and HS_DEAL_IDS[c][1] > now}
+
+async def _hs_deal_ids_set(mapping: dict):
+    """mapping: conv -> (deal_id, contact_id pendiente de asociar o "")."""
+    mapping = {c: rec for c, rec in mapping.items() if c}
+    if not mapping:
+        return
+    expires = time.time() + HS_DEAL_IDS_TTL_SECS
+    for conv, rec in mapping.items():
+        HS_DEAL_IDS[conv] = (rec, expires)
+        HS_DEAL_IDS.move_to_end(conv)
+    while len(HS_DEAL_IDS) > HS_DEAL_IDS_MAX:
+        HS_DEAL_IDS.popitem(last=False)
+    if _redis:
+        try:
+            pipe = _redis.pipeline(transaction=False)
+            for conv, (did, cid) in mapping.items():
+                pipe.set(f"{HS_DEAL_IDS_PREFIX}:{conv}", f"{did}|{cid}" if cid else did, ex=HS_DEAL_IDS_TTL_SECS)
+            await pipe.execute()
+        except Exception as e:
+            print("Redis hs deal ids set error:", e)
+
+async def _hs_take(n: int) -> list:
+    ops = []
+    if _redis:
+        try:
+            raw = await _redis.lpop(HS_PENDING_KEY, n) or []
+            ops = [json.loads(x) for x in raw]
+        except Exception as e:
+            print("Redis hs take error:", e)
+    if len(ops) < n and _hs_pending:
+        k = n - len(ops)
+        ops.extend(_hs_pending[:k])
+        del _hs_pending[:k]
+    return ops
+
+async def _hs_pending_len() -> int:
+    n = len(_hs_pending)
+    if _redis:
+        try:
+            n += await _redis.llen(HS_PENDING_KEY)
+        except Exception as e:
+            print("Redis hs llen error:", e)
+    return n
+
+def _chunks(items: list, size: int = HS_BATCH_MAX):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _match_results(uids: list, results: list, prop: str = "", values: dict = None) -> dict:
+    """
+    Empareja resultados batch con nuestros uids: HubSpot no garantiza orden.
+    Primero objectWriteTraceId (= uid); sólo para resultados que vinieron sin trace, una
+    propiedad única (`values`: uid -> valor). Lo que no se puede emparejar queda afuera
+    (el caller lo reintenta): un id asignado al cliente equivocado es peor que esperar.
+    """
+    out = {}
+    pending = set(uids)
+    untraced = []
+    for res in results:
+        trace = res.get("objectWriteTraceId")
+        if trace in pending:
+            out[trace] = res.get("id"); pending.discard(trace)
+        elif not trace:
+            untraced.append(res)
+    if pending and untraced and prop:
+        by_prop = {}
+        for res in untraced:
+            v = ((res.get("properties") or {}).get(prop) or "").lower()
+            by_prop.setdefault(v, []).append(res.get("id"))
+        wanted = collections.Counter((values.get(u) or "").lower() for u in pending)
+        for u in list(pending):
+            v = (values.get(u) or "").lower()
+            ids = by_prop.get(v) or []
+            if v and len(ids) == 1 and wanted[v] == 1:
+                out[u] = ids[0]; pending.discard(u)
+    return out
+
+async def _hs_batch(path: str, inputs: list, **extra) -> list:
+    """POST batch en trozos de HS_BATCH_MAX. Devuelve todos los results; lanza si falla una llamada."""
+    results = []
+    for chunk in _chunks(inputs):
+        r = await http_request(_hubspot_http, "POST", f"{HS_API}{path}", idempotent=path.endswith(("/update", "/upsert")),
+                               headers=_hubspot_headers(), json={"inputs": chunk, **extra})
+        if not r.is_success:
+            raise RuntimeError(f"HubSpot {path} -> {r.status_code} {r.text[:200]}")
+        data = r.json() if r.content else {}
+        for err in data.get("errors") or []:
+            print(f"HubSpot {path} error:", str(err)[:200])
+        results.extend(data.get("results") or [])
+    return results
+
+def _coalesce_ops(ops: list) -> dict:
+    """uid -> {"contact": op|None, "deal": op|None}; la última operación gana, sin perder datos no vacíos."""
+    by_uid = {}
+    for op in ops:
+        slot = by_uid.setdefault(op.get("uid") or "", {"contact": None, "deal": None, "ops": []})
+        slot["ops"].append(op)
+        prev = slot[op["kind"]]
+        if prev is None:
+            slot[op["kind"]] = dict(op)
+            continue
+        merged = dict(prev)
+        for k, v in op.items():
+            if v or k not in merged:
+                merged[k] = v
+        slot[op["kind"]] = merged
+    by_uid.pop("", None)
+    return by_uid
+
+async def _hs_resolve_contacts(by_uid: dict) -> dict:
+    """Crea/actualiza contactos en batch. Devuelve uid -> contact_id (incluye los ya conocidos)."""
+    cids, cached = {}, {}
+    for uid, slot in by_uid.items():
+        c = slot["contact"] or {}
+        cached[uid] = await contact_cache_get(uid, c.get("email") or "")
+        op_cid = c.get("contact_id") or (slot["deal"] or {}).get("contact_id")
+        cid = op_cid or cached[uid].get("id")
+        if cid:
+            cids[uid] = cid
+
+    updates, upserts, creates, fresh = [], [], [], {}
+    for uid, slot in by_uid.items():
+        c = slot["contact"]
+        if not c:
+            continue
+        props = _contact_props(c.get("name"), c.get("email"), c.get("phone"), c.get("lang"))
+        fresh[uid] = (c.get("phone") or uid, c.get("email") or "", props)
+        if uid in cids:
+            hit = cached[uid]
+            if hit.get("id") == cids[uid] and not _contact_dirty(hit.get("props"), props):
+                metric_inc("hubspot.contact_patch_skipped")
+                continue
+            updates.append({"id": cids[uid], "properties": props})
+        elif c.get("email"):
+            upserts.append((uid, {"idProperty": "email", "id": c["email"], "properties": props, "objectWriteTraceId": uid}))
+        else:
+            creates.append((uid, {"properties": props, "objectWriteTraceId": uid}))
+
+    if updates:
+        await _hs_batch("/crm/v3/objects/contacts/batch/update", updates)
+        print(f"HubSpot contacts updated: {len(updates)}")
+    new_ids = {}
+    for path, items, prop in (("upsert", upserts, "email"), ("create", creates, "phone")):
+        if not items:
+            continue
+        res = await _hs_batch(f"/crm/v3/objects/contacts/batch/{path}", [i for _, i in items])
+        matched = _match_results([u for u, _ in items], res, prop=prop,
+                                 values={u: i["properties"].get(prop) for u, i in items})
+        new_ids.update(matched)
+        for uid, _ in items:
+            if uid not in matched:
+                print(f"⚠️ HubSpot contact {path} sin emparejar para {uid}; se reintenta")
+                by_uid[uid]["retry"] = True
+    if new_ids:
+        print(f"✅ HubSpot contacts created/upserted: {len(new_ids)}")
+        cids.update(new_ids)
+    # Lo que quedó en HubSpot = lo que recordamos (próximos turnos no repiten PATCH)
+    sent = {u["id"] for u in updates}
+    for uid, (phone, email, props) in fresh.items():
+        cid = cids.get(uid)
+        if cid and (uid in new_ids or cid in sent):
+            await contact_cache_put(cid, phone, email, props)
+    return cids
+
+async def _hs_sync_deals(by_uid: dict, cids: dict) -> dict:
+    """Crea/actualiza deals en batch (+ asociación v4 a contacto). Devuelve uid -> deal_id."""
+    known = await _hs_deal_ids_get([(slot["deal"] or {}).get("conv") for slot in by_uid.values()])
+    dids, updates, creates = {}, [], []
+    assoc = {}   # uid -> (deal_id, contact_id) a asociar en este flush
+    for uid, slot in by_uid.items():
+        d = slot["deal"]
+        if not d or slot.get("retry"):
+            continue
+        # El de la sesión; si el write-back aún no llegó, el creado en esta conversación
+        rec_did, rec_cid = known.get(d.get("conv")) or ("", "")
+        did = d.get("deal_id") or rec_did
+        props = {"dealname": d["title"], "description": d["desc"]}
+        if did:
+            dids[uid] = did
+            updates.append({"id": did, "properties": props})
+            if rec_cid and did == rec_did:
+                assoc[uid] = (did, rec_cid)   # creado en un flush cuya asociación falló
+        elif cids.get(uid):
+            if HUBSPOT_PIPELINE_ID:  props["pipeline"]  = HUBSPOT_PIPELINE_ID
+            if HUBSPOT_DEALSTAGE_ID: props["dealstage"] = HUBSPOT_DEALSTAGE_ID
+            if d.get("owner_id"):    props["hubspot_owner_id"] = d["owner_id"]
+            creates.append((uid, {"properties": props, "objectWriteTraceId": uid}))
+        else:
+            print(f"⚠️ No hay contact_id para {uid}; se omite creación de Deal")
+
+    if updates:
+        await _hs_batch("/crm/v3/objects/deals/batch/update", updates)
+        print(f"✅ HubSpot deals updated: {len(updates)}")
+    if creates:
+        res = await _hs_batch("/crm/v3/objects/deals/batch/create", [i for _, i in creates])
+        new_ids = _match_results([u for u, _ in creates], res, prop="dealname",
+                                 values={u: i["properties"]["dealname"] for u, i in creates})
+        for uid, _ in creates:
+            if uid not in new_ids:
+                print(f"⚠️ HubSpot deal create sin emparejar para {uid}; se reintenta")
+                by_uid[uid]["retry"] = True
+        if new_ids:
+            # Registrar antes de asociar, con la asociación pendiente: si algo falla después,
+            # el reintento actualiza en vez de duplicar y vuelve a pedir la asociación
+            await _hs_deal_ids_set({by_uid[u]["deal"].get("conv"): (did, cids[u]) for u, did in new_ids.items()})
+            print(f"✅ HubSpot deals created: {len(new_ids)}")
+            dids.update(new_ids)
+            assoc.update({u: (did, cids[u]) for u, did in new_ids.items()})
+    if assoc:
+        await _hs_batch("/crm/v4/associations/deals/contacts/batch/create", [
+            {"from": {"id": did}, "to": {"id": cid},
+             "types": [{"associationCategory": "HUBSPOT_DEFINED", "associationTypeId": ASSOC_DEAL_TO_CONTACT}]}
+            for did, cid in assoc.values()
+        ])
+        await _hs_deal_ids_set({by_uid[u]["deal"].get("conv"): (did, "") for u, (did, _) in assoc.items()})
+    return dids
+
+async def _hs_log_notes(by_uid: dict, cids: dict, dids: dict):
+    inputs = []
+    ts = datetime.now(ZoneInfo("America/Bogota")).isoformat()
+    for uid, slot in by_uid.items():
+        d = slot["deal"]
+        if not d or not d.get("note") or not dids.get(uid):
+            continue
+        assoc = [{"to": {"id": dids[uid]}, "types": [{"associationCategory": "HUBSPOT_DEFINED", "associationTypeId": ASSOC_NOTE_TO_DEAL}]}]
+        if cids.get(uid):
+            assoc.append({"to": {"id": cids[uid]}, "types": [{"associationCategory": "HUBSPOT_DEFINED", "associationTypeId": ASSOC_NOTE_TO_CONTACT}]})
+        inputs.append({"properties": {"hs_note_body": d["note"], "hs_timestamp": ts}, "associations": assoc})
+    if inputs:
+        await _hs_batch("/crm/v3/objects/notes/batch/create", inputs)
+        print(f"✅ Notas logueadas en HubSpot: {len(inputs)}")
+
+async def _hs_write_back(by_uid: dict, cids: dict, dids: dict):
+    # Dejar los ids en la sesión para que los turnos siguientes los vean
+    for uid, slot in by_uid.items():
+        phone = next((op.get("phone") for op in slot["ops"] if op.get("phone")), uid)
+        if cids.get(uid):
+            await patch_session(phone, {"contact_id": cids[uid]})
+        if dids.get(uid):
+            # Sólo en la conversación del deal: una sesión nueva abre su propio deal
+            conv = (slot["deal"] or {}).get("conv")
+            await patch_session(phone, {"early_deal_id": dids[uid]}, match={"conv": conv} if conv else None)
+
+async def _hs_requeue(ops: list):
+    for op in ops:
+        op["attempts"] = op.get("attempts", 0) + 1
+        if op["attempts"] < HUBSPOT_MAX_ATTEMPTS:
+            await hubspot_enqueue(op)
+        else:
+            print("❌ HubSpot op descartada tras reintentos:", op.get("kind"), op.get("uid"))
+
+async def hubspot_flush() -> int:
+    """Procesa hasta HUBSPOT_BATCH_SIZE operaciones pendientes. Devuelve cuántas tomó."""
+    ops = await _hs_take(HUBSPOT_BATCH_SIZE)
+    if not ops:
+        return 0
+    by_uid = _coalesce_ops(ops)
+    t0 = time.perf_counter()
     try:
-        r = requests.post(base, headers=headers, json={"properties": props}, timeout=20)
-        if not r.ok:
-            print("HubSpot deal error:", r.status_code, r.text[:200])
-            return None
-        deal_id = r.json().get("id")
+        cids = await _hs_resolve_contacts(by_uid)
+        dids = await _hs_sync_deals(by_uid, cids)
+        await _hs_log_notes(by_uid, cids, dids)
+        await _hs_write_back(by_uid, cids, dids)
+        # Resultados que no se pudieron emparejar: sólo esos usuarios vuelven a la cola
+        retry = [op for slot in by_uid.values() if slot.get("retry") for op in slot["ops"]]
+        await _hs_requeue(retry)
+        metric_inc("hubspot.ops_flushed", len(ops) - len(retry))
+    except Exception as e:
+        print("❌ HubSpot flush error:", e)
+        metric_inc("hubspot.flush_errors")
+        # Reencolar (los ids ya creados quedaron registrados => sin duplicados)
+        await _hs_requeue(ops)
+    finally:
+        metric_observe("hubspot.flush_ms", (time.perf_counter() - t0) * 1000)
+    return len(ops)
+
+async def _hubspot_flusher_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_hs_wakeup.wait(), timeout=HUBSPOT_FLUSH_SECS)
+        except asyncio.TimeoutError:
+            pass
+        _hs_wakeup.clear()
         try:
-            assoc_url = f"https://api.hubapi.com/crm/v4/objects/deals/{deal_id}/associations/contacts/{contact_id}"
-            a = requests.put(assoc_url, headers=headers, json=[{"associationCategory":"HUBSPOT_DEFINED","associationTypeId": 3}], timeout=20)
-            print("Deal association:", a.status_code, a.text[:120])
+            while await hubspot_flush() >= HUBSPOT_BATCH_SIZE:
+                pass
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            print("Deal association error:", e)
-        print("Deal created:", deal_id)
-        return deal_id
+            print("HubSpot flusher error:", e)
+
+@app.on_event("startup")
+async def start_hubspot_flusher():
+    global _hs_flusher
+    if HUBSPOT_TOKEN and not _hs_flusher:
+        _hs_flusher = asyncio.create_task(_hubspot_flusher_loop(), name="hubspot-flusher")
+
+@app.on_event("shutdown")
+async def stop_hubspot_flusher():
+    global _hs_flusher
+    if _hs_flusher:
+        _hs_flusher.cancel()
+        await asyncio.gather(_hs_flusher, return_exceptions=True)
+        _hs_flusher = None
+    # Último vaciado (lo que no alcance queda en Redis para el próximo arranque)
+    try:
+        while await hubspot_flush():
+            pass
     except Exception as e:
-        print("HubSpot deal exception:", e)
-        return None
+        print("HubSpot final flush error:", e)
 
 def owner_for_city(city: str):
     pretty = city or "—"
     return (OWNER_RAY_NAME, HUBSPOT_OWNER_RAY or None, CAL_RAY or "", pretty, OWNER_RAY_WA)
 
+# ==================== LEADS (notificación consolidada) ====================
+# Cada resultado / handoff registra un evento; por usuario se manda UN email a ventas y
+# UN upsert del deal cuando el usuario deja de navegar LEAD_DEBOUNCE_SECS (o ya, si pidió
+# hablar con el equipo). El detalle combinado sale de build_history_lines.
+LEAD_KEY_PREFIX = "two_travel:lead:u:"       # hash por uid {first_at, phone, handoff, cal_url, ...}; lista {key}:snaps
+LEAD_DUE_KEY    = "two_travel:lead:due"       # zset uid -> epoch de envío
+_lead_pending = {}                            # fallback en memoria
+_lead_wakeup = asyncio.Event()
+_lead_flusher = None
+
+def _lead_snapshot(state: dict) -> dict:
+    """Copia del estado al momento del evento (sin la memoria de Luna, que no va al email)."""
+    return json.loads(json.dumps({k: v for k, v in state.items() if not k.startswith("luna_")}, default=str))
+
+def _lead_events(snaps: list) -> list:
+    events = []
+    for snap in snaps:
+        if snap["event"] not in events:
+            events.append(snap["event"])
+    return events
+
+async def lead_event(event: str, state: dict, phone: str, handoff: bool = False,
+                     cal_url: str = "", owner_name: str = "", pretty_city: str = ""):
+    """Registra un evento de lead; el envío (email + deal) lo hace el flusher."""
+    uid = wa_click_number(phone)
+    now = time.time()
+    snap = {"event": event, "state": _lead_snapshot(state)}
+    meta = {"cal_url": cal_url, "owner_name": owner_name, "pretty_city": pretty_city}
+    if _redis:
+        key = LEAD_KEY_PREFIX + uid
+        try:
+            # Todo en un MULTI: nada de leer-modificar-escribir, así un flush en paralelo
+            # se lleva el evento entero o no se lo lleva
+            pipe = _redis.pipeline(transaction=True)
+            pipe.hsetnx(key, "first_at", now)
+            pipe.hsetnx(key, "phone", phone)
+            pipe.hset(key, mapping=meta)
+            if handoff:
+                pipe.hset(key, "handoff", 1)
+            pipe.rpush(f"{key}:snaps", json.dumps(snap))
+            pipe.zadd(LEAD_DUE_KEY, {uid: now if handoff else now + LEAD_DEBOUNCE_SECS})
+            pipe.hmget(key, "first_at", "handoff")
+            first_at, flagged = (await pipe.execute())[-1]
+            # Ventana deslizante con tope desde el primer evento; un handoff previo manda ya.
+            # LT: solo adelanta el envío, nunca pisa un due menor puesto por otro evento
+            due = now if flagged else float(first_at) + LEAD_DEBOUNCE_MAX_SECS
+            if due < now + LEAD_DEBOUNCE_SECS:
+                await _redis.zadd(LEAD_DUE_KEY, {uid: due}, lt=True)
+            metric_inc("leads.events")
+            if handoff or flagged:
+                _lead_wakeup.set()
+            return
+        except Exception as e:
+            print("Redis lead event error:", e)
+    lead = _lead_pending.get(uid) or {"snapshots": [], "first_at": now, "phone": phone}
+    lead["snapshots"].append(snap)
+    lead.update(meta)
+    lead["handoff"] = lead.get("handoff") or handoff
+    lead["due"] = now if lead["handoff"] else min(now + LEAD_DEBOUNCE_SECS, lead["first_at"] + LEAD_DEBOUNCE_MAX_SECS)
+    _lead_pending[uid] = lead
+    metric_inc("leads.events")
+    if handoff:
+        _lead_wakeup.set()
+
+async def lead_handoff(phone: str):
+    """El usuario pidió hablar con el equipo: lo pendiente se notifica ya."""
+    uid = wa_click_number(phone)
+    if _redis:
+        key = LEAD_KEY_PREFIX + uid
+        try:
+            if not await _redis.exists(key):
+                return
+            pipe = _redis.pipeline(transaction=True)
+            pipe.hset(key, "handoff", 1)
+            pipe.zadd(LEAD_DUE_KEY, {uid: time.time()})
+            await pipe.execute()
+            # Si el flusher lo tomó entre EXISTS y MULTI queda un hash sin eventos: lo descarta
+            _lead_wakeup.set()
+            return
+        except Exception as e:
+            print("Redis lead handoff error:", e)
+    lead = _lead_pending.get(uid)
+    if lead:
+        lead["due"] = time.time()
+        lead["handoff"] = True
+        _lead_wakeup.set()
+
+async def _lead_take_due(now: float) -> list:
+    leads = []
+    if _redis:
+        try:
+            for uid in await _redis.zrangebyscore(LEAD_DUE_KEY, "-inf", now, start=0, num=50):
+                key = LEAD_KEY_PREFIX + uid
+                # Leer y borrar en el mismo MULTI: un evento entra antes (y sale en este
+                # envío) o después (y abre un lead nuevo). Otro proceso recibe listas vacías.
+                pipe = _redis.pipeline(transaction=True)
+                pipe.hgetall(key)
+                pipe.lrange(f"{key}:snaps", 0, -1)
+                pipe.delete(key, f"{key}:snaps")
+                pipe.zrem(LEAD_DUE_KEY, uid)
+                meta, snaps, _, _ = await pipe.execute()
+                if not snaps:
+                    continue
+                lead = dict(meta)
+                lead["snapshots"] = [json.loads(x) for x in snaps]
+                lead["phone"] = lead.get("phone") or uid
+                leads.append(lead)
+        except Exception as e:
+            print("Redis lead take error:", e)
+    for uid in [u for u, l in _lead_pending.items() if l["due"] <= now]:
+        leads.append(_lead_pending.pop(uid))
+    return leads
+
+def _lead_state(lead: dict) -> dict:
+    """Estado del lead a partir de los snapshots de sus eventos: el más reciente manda,
+    la historia es la unión de todas."""
+    snaps = [s["state"] for s in lead["snapshots"]]
+    state, history = {}, []
+    for snap in snaps:
+        state.update(snap)
+        for h in snap.get("history") or []:
+            if h not in history:
+                history.append(h)
+    state["history"] = history
+    return state
+
+async def _lead_send(lead: dict):
+    phone = lead["phone"]
+    state = _lead_state(lead)
+    # Los ids de HubSpot llegan por write-back después del evento: esos sí, de la sesión actual
+    current = await get_session(phone) or {}
+    if current.get("contact_id"):
+        state["contact_id"] = current["contact_id"]
+    if current.get("early_deal_id") and current.get("conv") == state.get("conv"):
+        state["early_deal_id"] = current["early_deal_id"]
+    events = _lead_events(lead["snapshots"])
+    hist = build_history_lines(state)
+    await notify_sales(" + ".join(events), state, phone,
+                       extra=(f"History:\n{hist}" if hist else ""),
+                       cal_url=lead.get("cal_url", ""), owner_name=lead.get("owner_name", ""),
+                       pretty_city=lead.get("pretty_city", ""))
+    desc = hist or f"{events[-1]} from WhatsApp. Lang: {state.get('lang','-')}"
+    await hubspot_upsert_deal(state, deal_title_from_state(state), desc, phone=phone)
+    metric_inc("leads.sent")
+    metric_inc("leads.events_coalesced", len(events) - 1)
+    print(f"✅ Lead notificado ({len(events)} eventos) para {phone}")
+
+async def lead_flush(now: float = None) -> int:
+    leads = await _lead_take_due(time.time() if now is None else now)
+    for lead in leads:
+        try:
+            await _lead_send(lead)
+        except Exception as e:
+            print("❌ Error notificando lead:", e)
+    return len(leads)
+
+async def _lead_flusher_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_lead_wakeup.wait(), timeout=LEAD_POLL_SECS)
+        except asyncio.TimeoutError:
+            pass
+        _lead_wakeup.clear()
+        try:
+            await lead_flush()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("Lead flusher error:", e)
+
+@app.on_event("startup")
+async def start_lead_flusher():
+    global _lead_flusher
+    if not _lead_flusher:
+        _lead_flusher = asyncio.create_task(_lead_flusher_loop(), name="lead-flusher")
+
+@app.on_event("shutdown")
+async def stop_lead_flusher():
+    global _lead_flusher
+    if _lead_flusher:
+        _lead_flusher.cancel()
+        await asyncio.gather(_lead_flusher, return_exceptions=True)
+        _lead_flusher = None
+    # Los de memoria se perderían: se mandan ya (los de Redis esperan al próximo arranque)
+    if _lead_pending:
+        try:
+            await lead_flush(now=float("inf"))
+        except Exception as e:
+            print("Lead final flush error:", e)
+
 # ==================== CATÁLOGO ====================
-def load_catalog():
-    if not GOOGLE_SHEET_CSV_URL:
-        print("WARN: GOOGLE_SHEET_CSV_URL missing")
-        return []
-    try:
-        r = requests.get(GOOGLE_SHEET_CSV_URL, timeout=30)
-        if not r.ok:
-            print("Catalog download error:", r.status_code, r.text[:200])
-            return []
-        rows = []
-        content = r.content.decode("utf-8", errors="ignore")
-        reader = csv.DictReader(io.StringIO(content))
-        for row in reader:
-            clean = {(k or "").strip(): (v or "").strip() for k, v in row.items()}
-            rows.append(clean)
-        print("Catalog rows:", len(rows))
-        return rows
-    except Exception as e:
-        print("Catalog fetch exception:", e)
-        return []
+# Cache en memoria del Google Sheet: el webhook nunca espera la descarga.
+# Un hilo en background revalida con GET condicional (ETag / Last-Modified)
+# y, si el sheet falla o tarda, seguimos sirviendo el último snapshot bueno.
+CATALOG = {
+    "rows": [],           # último snapshot bueno (lista de dicts)
+    "index": {},          # (service, city) -> pool en columnas, ver build_catalog_index
+    "by_id": {},          # catalog_row_id -> fila (para resolver last_top de las sesiones)
+    "version": 0,         # sube cada vez que cambia el contenido
+    "digest": "",         # crc32 del contenido: versión estable entre procesos
+    "etag": "",
+    "last_modified": "",
+    "fetched_at": 0.0,    # última descarga con contenido nuevo (epoch)
+    "checked_at": 0.0,    # última revalidación exitosa (200 o 304)
+    "attempted_at": 0.0,  # último intento (exitoso o no)
+    "error": "",          # último error (vacío si la última revalidación fue OK)
+}
+_catalog_lock = threading.Lock()        # protege el swap del snapshot
+_catalog_fetch_lock = threading.Lock()  # una sola descarga a la vez
+_catalog_thread = None
+_catalog_session = requests.Session()  # keep-alive entre revalidaciones
 
-def _tag_hit(pref_tags: str, required_tag: str) -> bool:
-    if not required_tag:
-        return True
-    tags = [t.strip().lower() for t in (pref_tags or "").split(",") if t.strip()]
-    return required_tag.lower() in tags
+def _parse_catalog_csv(content: bytes) -> list:
+    rows = []
+    reader = csv.DictReader(io.StringIO(content.decode("utf-8", errors="ignore")))
+    for row in reader:
+        clean = {(k or "").strip(): (v or "").strip() for k, v in row.items()}
+        rows.append(clean)
+    return rows
+
+def _safe_int(x, default=0):
+    try:
+        return int(float(x))
+    except:
+        return default
 
 def _price_val(r):
     try:
@@ -721,105 +2379,270 @@ def _price_val(r):
     except:
         return 999999.0
 
-def filter_catalog(service, city, pax=0, category_tag=None, top_k=TOP_K):
-    rows = load_catalog()
-    if not rows:
+BOAT_KINDS = ("speedboat", "catamaran", "yacht")   # código en la columna "kind": posición + 1 (0 = sin tipo)
+_CAP_LIMIT = 2 ** 62   # capacidades absurdas del sheet no desbordan int64
+
+def _catalog_pool_columns(service: str, rows: list) -> dict:
+    """Pool en columnas: arrays NumPy alineados con rows + máscara booleana por tag."""
+    n = len(rows)
+    tag_rows = {}
+    for i, r in enumerate(rows):
+        for t in {t.strip().lower() for t in (r.get("preference_tags") or "").split(",") if t.strip()}:
+            tag_rows.setdefault(t, []).append(i)
+    tags = {}
+    for t, idx in tag_rows.items():
+        mask = np.zeros(n, dtype=bool)
+        mask[idx] = True
+        tags[t] = mask
+    kinds = [_boat_kind(r) for r in rows] if service == "boats" else []
+    return {
+        "rows": rows,
+        "cap": np.array([max(-_CAP_LIMIT, min(_CAP_LIMIT, _safe_int(r.get("capacity_max"), 0))) for r in rows], dtype=np.int64),
+        "price": np.array([_price_val(r) for r in rows], dtype=np.float64),
+        "kind": np.array([BOAT_KINDS.index(k) + 1 if k in BOAT_KINDS else 0 for k in kinds] or [0] * n, dtype=np.int8),
+        "tags": tags,
+    }
+
+def build_catalog_index(rows: list) -> dict:
+    """
+    Índice (service, city) -> pool en columnas (ver _catalog_pool_columns), en el orden
+    del sheet. Se construye una sola vez por snapshot para que filter_catalog no repita
+    norm()/regex ni parseos por fila y pueda rankear con operaciones vectorizadas.
+    """
+    groups = {}
+    for r in rows:
+        key = (canonical_service(r.get("service_type","")), canonical_city(r.get("city","")))
+        groups.setdefault(key, []).append(r)
+    return {key: _catalog_pool_columns(key[0], g) for key, g in groups.items()}
+
+def catalog_row_id(r: dict) -> str:
+    """Id estable de una fila (el sheet no trae id): columna id si existe, si no crc32 de sus campos clave."""
+    rid = (r.get("id") or "").strip()
+    if rid:
+        return rid
+    key = "|".join((r.get(k) or "") for k in ("service_type", "city", "name", "url_page"))
+    return f"{zlib.crc32(key.encode()):08x}"
+
+def top_ref(rows: list) -> dict:
+    """Lo que se guarda en la sesión en vez de las filas: ids + versión del snapshot."""
+    return {"v": CATALOG["digest"], "ids": [catalog_row_id(r) for r in rows]}
+
+def resolve_top(ref) -> list:
+    """Filas de un top_ref contra el snapshot actual (las que ya no existen se omiten)."""
+    if not ref:
         return []
+    if isinstance(ref, list):
+        return ref   # sesiones viejas con filas completas
+    load_catalog()
+    by_id = CATALOG["by_id"]
+    rows = [by_id[i] for i in ref.get("ids") or [] if i in by_id]
+    if len(rows) < len(ref.get("ids") or []):
+        print(f"Catalog {ref.get('v')} → {CATALOG['digest']}: {len(ref['ids']) - len(rows)} rows no longer in sheet")
+    return rows
+
+def catalog_pool(service: str, city: str) -> dict | None:
+    """Pool en columnas del índice para (service, city); None si no hay."""
+    load_catalog()
+    return CATALOG["index"].get((canonical_service(service), canonical_city(city)))
+
+def refresh_catalog(force: bool = False) -> dict:
+    """
+    Revalida el catálogo contra el sheet. Devuelve un resumen del estado.
+    force=True ignora ETag/Last-Modified y descarga todo.
+    """
+    if not GOOGLE_SHEET_CSV_URL:
+        print("WARN: GOOGLE_SHEET_CSV_URL missing")
+        return catalog_status()
+
+    with _catalog_fetch_lock:
+        CATALOG["attempted_at"] = time.time()
+        headers = {}
+        if not force:
+            if CATALOG["etag"]:          headers["If-None-Match"] = CATALOG["etag"]
+            if CATALOG["last_modified"]: headers["If-Modified-Since"] = CATALOG["last_modified"]
+        try:
+            r = _catalog_session.get(GOOGLE_SHEET_CSV_URL, headers=headers, timeout=CATALOG_TIMEOUT_SECS)
+            if r.status_code == 304:
+                CATALOG["checked_at"] = time.time()
+                CATALOG["error"] = ""
+                return catalog_status()
+            if not r.ok:
+                print("Catalog download error:", r.status_code, r.text[:200])
+                CATALOG["error"] = f"HTTP {r.status_code}"
+                return catalog_status()
+            rows = _parse_catalog_csv(r.content)
+            if not rows and CATALOG["rows"]:
+                # Un CSV vacío casi siempre es un error del sheet: no pisamos el snapshot bueno
+                print("Catalog empty response; keeping last good snapshot")
+                CATALOG["error"] = "empty"
+                return catalog_status()
+            now = time.time()
+            changed = rows != CATALOG["rows"]
+            index = build_catalog_index(rows) if changed else CATALOG["index"]
+            by_id = {catalog_row_id(x): x for x in rows} if changed else CATALOG["by_id"]
+            with _catalog_lock:
+                CATALOG["rows"] = rows
+                CATALOG["index"] = index
+                CATALOG["by_id"] = by_id
+                if changed:
+                    CATALOG["version"] += 1
+                    CATALOG["digest"] = f"{zlib.crc32(r.content):08x}"
+                CATALOG["etag"] = r.headers.get("ETag", "") or ""
+                CATALOG["last_modified"] = r.headers.get("Last-Modified", "") or ""
+                CATALOG["fetched_at"] = now
+                CATALOG["checked_at"] = now
+                CATALOG["error"] = ""
+            print("Catalog rows:", len(rows), "version:", CATALOG["version"])
+        except Exception as e:
+            print("Catalog fetch exception:", e)
+            CATALOG["error"] = str(e)[:200]
+    return catalog_status()
+
+def catalog_status() -> dict:
+    now = time.time()
+    return {
+        "rows": len(CATALOG["rows"]),
+        "version": CATALOG["version"],
+        "digest": CATALOG["digest"],
+        "pools": len(CATALOG["index"]),
+        "etag": CATALOG["etag"],
+        "last_modified": CATALOG["last_modified"],
+        "age_secs": round(now - CATALOG["checked_at"], 1) if CATALOG["checked_at"] else None,
+        "error": CATALOG["error"],
+    }
+
+def _refresh_catalog_async():
+    # Revalidación "stale-while-revalidate": no bloquea a quien consulta
+    if _catalog_fetch_lock.locked():
+        return
+    threading.Thread(target=refresh_catalog, name="catalog-refresh-once", daemon=True).start()
 
+def _catalog_refresher_loop():
+    while True:
+        try:
+            refresh_catalog()
+        except Exception as e:
+            print("Catalog refresher error:", e)
+        time.sleep(max(5, CATALOG_REFRESH_SECS))
+
+def start_catalog_refresher():
+    global _catalog_thread
+    if _catalog_thread and _catalog_thread.is_alive():
+        return
+    if not GOOGLE_SHEET_CSV_URL:
+        print("WARN: GOOGLE_SHEET_CSV_URL missing")
+        return
+    _catalog_thread = threading.Thread(target=_catalog_refresher_loop, name="catalog-refresher", daemon=True)
+    _catalog_thread.start()
+
+def load_catalog():
+    """Snapshot actual del catálogo (en memoria). Sólo descarga en frío si aún no hay nada."""
+    if not CATALOG["attempted_at"]:
+        refresh_catalog()
+    elif time.time() - (CATALOG["checked_at"] or CATALOG["attempted_at"]) > CATALOG_TTL_SECS:
+        _refresh_catalog_async()
+    return CATALOG["rows"]
+
+@app.on_event("startup")
+async def boot_catalog():
+    start_catalog_refresher()
+
+def admin_denied(request: Request) -> JSONResponse | None:
+    """None si el request trae el ADMIN_TOKEN; si no hay token configurado, los endpoints no existen."""
+    if not ADMIN_TOKEN:
+        return JSONResponse({"error": "not found"}, status_code=404)
+    token = request.query_params.get("token", "")
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return JSONResponse({"error": "unauthorized"}, status_code=403)
+    return None
+
+@app.post("/admin/catalog/refresh")
+def admin_catalog_refresh(request: Request):
+    denied = admin_denied(request)
+    if denied:
+        return denied
+    force = request.query_params.get("force", "") in ("1", "true", "yes")
+    return refresh_catalog(force=force)
+
+@app.get("/admin/catalog")
+def admin_catalog_status(request: Request):
+    denied = admin_denied(request)
+    if denied:
+        return denied
+    return catalog_status()
+
+def _rank(key: np.ndarray, price: np.ndarray, k: int) -> np.ndarray:
+    """
+    Índices de los k mejores por (key, price, orden del sheet), ya ordenados: lo mismo que
+    un sort() estable por (key, price), pero con argpartition → O(n) + O(k log k).
+    """
+    n = len(key)
+    if k < n:
+        kth = key[np.argpartition(key, k - 1)[k - 1]]
+        less = np.flatnonzero(key < kth)
+        ties = np.flatnonzero(key == kth)
+        need = k - len(less)
+        if len(ties) > need:
+            # Desempate por precio; a igual precio ganan las primeras filas del sheet
+            p = price[ties]
+            pk = p[np.argpartition(p, need - 1)[need - 1]]
+            below = ties[p < pk]
+            ties = np.concatenate((below, ties[p == pk][:need - len(below)]))
+        cand = np.concatenate((less, ties))
+    else:
+        cand = np.arange(n)
+    return cand[np.lexsort((cand, price[cand], key[cand]))]
+
+def filter_catalog(service, city, pax=0, category_tag=None, top_k=TOP_K):
     svc_norm = canonical_service(service)
-    city_norm = canonical_city(city)
 
     # --- Normaliza category_tag para activar diversificación en "ALL/UNSURE" ---
     cat_norm = (str(category_tag).strip().lower() if category_tag is not None else None)
     if cat_norm in ("", "all", "unsure", "none", "null"):
         cat_norm = None
 
-    # Pool por servicio+ciudad
-    pool = []
-    for r in rows:
-        r_svc = canonical_service(r.get("service_type",""))
-        r_city = canonical_city(r.get("city",""))
-        if r_svc == svc_norm and r_city == city_norm:
-            pool.append(r)
-
+    # Pool por servicio+ciudad (pre-indexado por snapshot, en columnas)
+    pool = catalog_pool(service, city)
     if not pool:
         return []
+    rows, cap, price = pool["rows"], pool["cap"], pool["price"]
+    target = max(1, int(top_k or 1))
+
+    # Penalización por capacidad: holgura sobre pax, o 9999 si no alcanza
+    if pax:
+        gap = cap - pax
+        penalty = np.where(cap != 0, np.where(gap < 0, 9999, gap), 0)
+    else:
+        penalty = np.zeros(len(rows), dtype=np.int64)
 
     # --- Diversificar BOATS cuando NO hay categoría (ALL/UNSURE) ---
     # 1 speedboat + 1 catamaran + 1 yacht (si existen), y rellenar hasta top_k
     if svc_norm == "boats" and cat_norm is None:
-        def safe_int(x, default=0):
-            try:
-                return int(float(x))
-            except:
-                return default
-
-        scored = []
-        for r in pool:
-            cap = safe_int(r.get("capacity_max"), 0)
-            price = _price_val(r)
-
-            if pax and cap:
-                gap = cap - pax
-                cap_penalty = 9999 if gap < 0 else gap
-            else:
-                cap_penalty = 0
-
-            kind = _boat_kind(r)  # speedboat/catamaran/yacht/'' (robusto)
-            scored.append((cap_penalty, price, kind, r))
+        selected = []
+        for code in range(1, len(BOAT_KINDS) + 1):
+            idx = np.flatnonzero(pool["kind"] == code)
+            if len(idx):
+                selected.append(int(idx[_rank(penalty[idx], price[idx], 1)[0]]))
 
-        scored.sort(key=lambda t: (t[0], t[1]))
-
-        best_by_kind = {}
-        for s in scored:
-            _, _, kind, _r = s
-            if not kind:
-                continue
-            if kind not in best_by_kind:
-                best_by_kind[kind] = s
-
-        selected = [best_by_kind[k] for k in ("speedboat","catamaran","yacht") if k in best_by_kind]
-
-        target = max(1, int(top_k or 1))
         if len(selected) < target:
-            used_ids = {id(t[-1]) for t in selected}
-            for s in scored:
-                if id(s[-1]) in used_ids:
+            used = set(selected)
+            for i in _rank(penalty, price, target + len(selected)):
+                i = int(i)
+                if i in used:
                     continue
-                selected.append(s)
-                used_ids.add(id(s[-1]))
+                selected.append(i)
+                used.add(i)
                 if len(selected) >= target:
                     break
 
-        return [t[-1] for t in selected[:target]]
+        return [rows[i] for i in selected[:target]]
 
     # --- Resto de servicios o cuando SÍ hay categoría ---
-    def safe_int(x, default=0):
-        try:
-            return int(float(x))
-        except:
-            return default
-
-    scored = []
-    for r in pool:
-        cap = safe_int(r.get("capacity_max"), 0)
-        price = _price_val(r)
-
-        if pax and cap:
-            gap = cap - pax
-            cap_penalty = 9999 if gap < 0 else gap
-        else:
-            cap_penalty = 0
-
-        bonus = 0
-        if cat_norm and _tag_hit(r.get("preference_tags",""), cat_norm):
-            bonus = -10
-
-        scored.append((cap_penalty + bonus, price, r))
-
-    scored.sort(key=lambda t: (t[0], t[1]))
-    top_n = [r for _,__,r in scored[:max(1,int(top_k or 1))]]
-    return top_n
+    key = penalty
+    mask = pool["tags"].get(cat_norm) if cat_norm else None
+    if mask is not None:
+        key = penalty - 10 * mask
+    return [rows[i] for i in _rank(key, price, target)]
 
 
 # ==================== TEXTOS / UI ====================
@@ -1132,15 +2955,6 @@ def build_msg_to_ray(state: dict, owner_name="Ray", city_fallback="Cartagena"):
         return (f"Hi {owner_name}, I’m {name}. "
                 f"As I mentioned to Luna, I’m interested in {svc} in {city}{pref_txt}{date_txt}.")
 
-def get_session(user: str) -> dict | None:
-    if _redis:
-        try:
-            raw = _redis.get(_rkey(user))
-            return json.loads(raw) if raw else None
-        except Exception as e:
-            print("Redis get error:", e)
-    return SESSIONS.get(user)
-
 # ==================== Handoff: mensaje combinado ====================
 def handoff_full_message(state, owner_name, wa_num, cal_url, pretty_city):
     # Mensaje compacto con link directo y texto prellenado para Ray
@@ -1242,6 +3056,240 @@ def followup_message(state: dict) -> str:
                 "We got cut off — can I help you find what you're looking for?\n"
                 "I can also connect you directly with one of our team members if you prefer 😊")
 
+FOLLOWUP_JOB_KEY    = "two_travel:wa:followup:job"      # hash por job: {id}; set de enviados: {id}:sent
+FOLLOWUP_ACTIVE_KEY = "two_travel:wa:followup:active"   # job en curso (uno a la vez entre procesos)
+FOLLOWUP_LEASE_KEY  = "two_travel:wa:followup:lease"    # proceso que lo está ejecutando
+FOLLOWUP_LEASE_SECS = max(60, int(3 * FOLLOWUP_BATCH / max(FOLLOWUP_MPS, 0.001)))
+_followup_tasks = {}
+
+def _followup_job_key(job_id: str) -> str:
+    return f"{FOLLOWUP_JOB_KEY}:{job_id}"
+
+async def followup_job_status(job_id: str) -> dict:
+    job = await _redis.hgetall(_followup_job_key(job_id))
+    if not job:
+        return {}
+    out = {"job_id": job_id}
+    for k, v in job.items():
+        out[k] = int(v) if k in ("sent", "skipped", "failed", "offset", "total") else v
+    return out
+
+async def _replace_active(old: str | None, job_id: str) -> bool:
+    """Apunta ACTIVE al job nuevo sólo si sigue apuntando a `old` (otro cron pudo ganarnos)."""
+    async with _redis.pipeline(transaction=True) as pipe:
+        try:
+            await pipe.watch(FOLLOWUP_ACTIVE_KEY)
+            if await pipe.get(FOLLOWUP_ACTIVE_KEY) != old:
+                await pipe.unwatch()
+                return False
+            pipe.multi()
+            pipe.set(FOLLOWUP_ACTIVE_KEY, job_id, ex=FOLLOWUP_JOB_TTL_SECS)
+            await pipe.execute()
+            return True
+        except aioredis.WatchError:
+            return False
+
+async def start_followup_job(now: datetime) -> dict:
+    """Crea el job (o devuelve el que ya corre) y lo lanza en background."""
+    job_id = f"{int(now.timestamp())}-{random.randrange(16 ** 6):06x}"
+    # NX: si otro proceso ya tiene un job activo, devolvemos ese
+    if not await _redis.set(FOLLOWUP_ACTIVE_KEY, job_id, nx=True, ex=FOLLOWUP_JOB_TTL_SECS):
+        active = await _redis.get(FOLLOWUP_ACTIVE_KEY)
+        status = await followup_job_status(active) if active else {}
+        if status.get("status") == "running":
+            local = _followup_tasks.get(active)
+            if (local and not local.done()) or (await _redis.get(FOLLOWUP_LEASE_KEY) or "").endswith(f":{active}"):
+                status["already_running"] = True
+                return status
+            # El proceso dueño murió (lease vencido): se retoma desde su checkpoint
+            _spawn_followup(active)
+            status["resumed"] = True
+            return status
+        # Puntero viejo (job terminado, con error o vencido): lo reemplaza el job nuevo
+        if not await _replace_active(active, job_id):
+            active = await _redis.get(FOLLOWUP_ACTIVE_KEY)
+            status = await followup_job_status(active) if active else {}
+            status["already_running"] = True
+            return status
+
+    # Cutoff fijo al crear el job: al reanudar se usa el mismo criterio
+    cutoff = now.timestamp() - 24 * 3600
+    total = await _redis.zcount(ACTIVITY_KEY, "-inf", cutoff)
+    key = _followup_job_key(job_id)
+    await _redis.hset(key, mapping={
+        "status": "running", "cutoff": cutoff, "offset": 0, "total": total,
+        "sent": 0, "skipped": 0, "failed": 0, "created_at": now.isoformat(),
+    })
+    await _redis.expire(key, FOLLOWUP_JOB_TTL_SECS)
+    _spawn_followup(job_id)
+    return await followup_job_status(job_id)
+
+def _spawn_followup(job_id: str):
+    task = _followup_tasks.get(job_id)
+    if task and not task.done():
+        return
+    _followup_tasks[job_id] = asyncio.create_task(run_followup_job(job_id))
+
+async def _followup_one(phone: str, state: dict, now: datetime, bucket: TokenBucket,
+                        sem: asyncio.Semaphore, sent_key: str) -> str:
+    """Decide y envía un follow-up. Devuelve sent / skipped / failed / drop (sacar del índice) / keep."""
+    # Ya completó el flujo o ya se mandó follow-up → skip
+    if state.get("follow_up_sent"):
+        return "skipped"
+    # Solo leads que dieron al menos su nombre
+    if not state.get("name"):
+        return "skipped"
+
+    # Verificar inactividad de 24h (el score puede ir un poco desfasado)
+    last_str = state.get("last_activity")
+    if not last_str:
+        return "keep"
+    try:
+        last_dt = datetime.fromisoformat(last_str)
+        if last_dt.tzinfo is None:
+            last_dt = last_dt.replace(tzinfo=ZoneInfo("America/Bogota"))
+    except:
+        return "keep"
+    if (now - last_dt).total_seconds() / 3600 < 24:
+        return "keep"
+
+    async with sem:
+        await bucket.acquire()
+        r = await wa_send_text(phone, followup_message(state))
+    if r.status_code >= 400:
+        print(f"❌ Follow-up failed for {phone}: {r.status_code}")
+        return "failed"
+    # Checkpoint por envío: si caemos antes del write-back no se reenvía
+    await _redis.sadd(sent_key, phone)
+    print(f"✅ Follow-up sent to {phone}")
+    return "sent"
+
+async def run_followup_job(job_id: str):
+    """Recorre el índice de actividad por páginas, envía en paralelo con rate limit y
+    guarda checkpoint por página (offset + contadores + set de enviados)."""
+    key = _followup_job_key(job_id)
+    sent_key = f"{key}:sent"
+    lease = f"{WA_CONSUMER}:{job_id}"
+    if not await _redis.set(FOLLOWUP_LEASE_KEY, lease, nx=True, ex=FOLLOWUP_LEASE_SECS):
+        _followup_tasks.pop(job_id, None)
+        return  # otro proceso lo está corriendo
+    bucket = TokenBucket(FOLLOWUP_MPS, FOLLOWUP_BURST)
+    sem = asyncio.Semaphore(FOLLOWUP_CONCURRENCY)
+    finished = True   # False sólo si nos cancelan: el job sigue activo y se reanuda al arrancar
+    try:
+        job = await _redis.hgetall(key)
+        if not job or job.get("status") != "running":
+            return
+        cutoff = float(job["cutoff"])
+        offset = int(job.get("offset") or 0)
+        print(f"FOLLOWUP> job {job_id} running from offset {offset}")
+        now = datetime.now(ZoneInfo("America/Bogota"))
+
+        while True:
+            # Lo procesado sale del índice; `offset` sólo salta lo que se queda (keep/failed)
+            batch = await _redis.zrangebyscore(ACTIVITY_KEY, "-inf", cutoff, start=offset, num=FOLLOWUP_BATCH)
+            if not batch:
+                break
+            raws = await _rsess.mget([_rkey(uid) for uid in batch])
+            already = await _redis.smismember(sent_key, batch)
+
+            jobs = []
+            for phone, raw, was_sent in zip(batch, raws, already):
+                if not raw:
+                    # La sesión expiró: limpiar el índice
+                    jobs.append((phone, None, None))
+                    continue
+                state = decode_session(raw)
+                if was_sent:
+                    # Enviado antes de un reinicio, falta el write-back
+                    jobs.append((phone, state, None))
+                    continue
+                jobs.append((phone, state, asyncio.create_task(_followup_one(phone, state, now, bucket, sem, sent_key))))
+
+            counts = {"sent": 0, "skipped": 0, "failed": 0}
+            done = []      # uids que ya no necesitan estar en el índice
+            flagged = []   # enviados: marcar follow_up_sent en la sesión
+            pending = [t for _, _, t in jobs if t]
+            try:
+                if pending:
+                    await asyncio.wait(pending)
+            except asyncio.CancelledError:
+                for t in pending:
+                    t.cancel()
+                raise
+            for phone, state, task in jobs:
+                if state is None:
+                    done.append(phone)
+                    continue
+                if task is None:
+                    flagged.append(phone)
+                    done.append(phone)
+                    counts["sent"] += 1   # no llegó a contarse antes del reinicio
+                    continue
+                try:
+                    result = await task
+                except Exception as e:
+                    print(f"Follow-up error for {phone}:", e)
+                    result = "failed"
+                if result == "sent":
+                    flagged.append(phone)
+                    done.append(phone)
+                elif result == "skipped":
+                    done.append(phone)
+                if result in counts:
+                    counts[result] += 1
+                elif result == "keep":
+                    counts["skipped"] += 1
+            offset += len(batch) - len(done)
+
+            # Sólo el flag, sobre la versión actual: no pisa lo que el usuario haya hecho mientras tanto
+            await asyncio.gather(*(patch_session(phone, {"follow_up_sent": True}) for phone in flagged))
+            pipe = _redis.pipeline(transaction=False)
+            pipe.expire(sent_key, FOLLOWUP_JOB_TTL_SECS)
+            if done:
+                # Vuelven al índice solos en el próximo set_session
+                pipe.zrem(ACTIVITY_KEY, *done)
+            for field, n in counts.items():
+                if n:
+                    pipe.hincrby(key, field, n)
+            pipe.hset(key, "offset", offset)
+            pipe.expire(FOLLOWUP_LEASE_KEY, FOLLOWUP_LEASE_SECS)
+            await pipe.execute()
+            metric_inc("followup.sent", counts["sent"])
+            metric_inc("followup.failed", counts["failed"])
+
+        await _redis.hset(key, mapping={"status": "done", "finished_at": datetime.now(ZoneInfo("America/Bogota")).isoformat()})
+        print(f"FOLLOWUP> job {job_id} done")
+    except asyncio.CancelledError:
+        # Apagado: el job queda "running" y se reanuda al arrancar (liberamos el lease)
+        finished = False
+        raise
+    except Exception as e:
+        print("Follow-up job error:", e)
+        await _redis.hset(key, mapping={"status": "error", "error": str(e)[:300]})
+    finally:
+        _followup_tasks.pop(job_id, None)
+        # En todas las salidas (también si el job ya no estaba "running"): lease y ACTIVE
+        # se sueltan sólo si siguen siendo de este job
+        try:
+            await _followup_release(job_id, lease, clear_active=finished)
+        except Exception as e:
+            print("Follow-up release error:", e)
+
+async def _followup_release(job_id: str, lease: str, clear_active: bool):
+    keys = [FOLLOWUP_LEASE_KEY, FOLLOWUP_ACTIVE_KEY] if clear_active else [FOLLOWUP_LEASE_KEY]
+    mine = {FOLLOWUP_LEASE_KEY: lease, FOLLOWUP_ACTIVE_KEY: job_id}
+    async with _redis.pipeline(transaction=True) as pipe:
+        try:
+            await pipe.watch(*keys)
+            owned = [k for k, v in zip(keys, await pipe.mget(keys)) if v == mine[k]]
+            pipe.multi()
+            if owned:
+                pipe.delete(*owned)
+            await pipe.execute()
+        except aioredis.WatchError:
+            pass   # alguien los cambió en el medio: ya no son nuestros
+
 @app.get("/cron/followup")
 async def cron_followup(request: Request):
     token = request.query_params.get("token", "")
@@ -1256,62 +3304,79 @@ async def cron_followup(request: Request):
     if not _redis:
         return {"skipped": "no redis"}
 
-    sent = 0
-    skipped = 0
     try:
-        keys = _redis.keys("two_travel:wa:s:*")
-        for key in keys:
-            raw = _redis.get(key)
-            if not raw:
-                continue
-            state = json.loads(raw)
-
-            # Ya completó el flujo o ya se mandó follow-up → skip
-            if state.get("follow_up_sent"):
-                skipped += 1
-                continue
-
-            # Solo leads que dieron al menos su nombre
-            if not state.get("name"):
-                skipped += 1
-                continue
-
-            # Verificar inactividad de 24h
-            last_str = state.get("last_activity")
-            if not last_str:
-                skipped += 1
-                continue
-            try:
-                last_dt = datetime.fromisoformat(last_str)
-                if last_dt.tzinfo is None:
-                    last_dt = last_dt.replace(tzinfo=ZoneInfo("America/Bogota"))
-            except:
-                skipped += 1
-                continue
+        return await start_followup_job(now)
+    except Exception as e:
+        print("Follow-up cron error:", e)
+        return {"error": str(e)}
 
-            hours_inactive = (now - last_dt).total_seconds() / 3600
-            if hours_inactive < 24:
-                skipped += 1
-                continue
+@app.get("/cron/followup/status")
+async def cron_followup_status(request: Request):
+    token = request.query_params.get("token", "")
+    if token != FOLLOWUP_TOKEN:
+        return JSONResponse({"error": "unauthorized"}, status_code=403)
+    if not _redis:
+        return {"skipped": "no redis"}
+    job_id = request.query_params.get("job") or await _redis.get(FOLLOWUP_ACTIVE_KEY)
+    if not job_id:
+        return {"status": "idle"}
+    status = await followup_job_status(job_id)
+    if not status:
+        return JSONResponse({"error": "job not found"}, status_code=404)
+    return status
 
-            # Extraer número de teléfono desde la key
-            phone = key.split("two_travel:wa:s:")[-1]
-            if not phone:
-                skipped += 1
-                continue
+@app.on_event("startup")
+async def resume_followup_job():
+    """Si el proceso cayó a mitad de un job, retomarlo desde su checkpoint."""
+    if not _redis:
+        return
+    try:
+        job_id = await _redis.get(FOLLOWUP_ACTIVE_KEY)
+        if job_id:
+            _spawn_followup(job_id)
+    except Exception as e:
+        print("Follow-up resume error:", e)
 
-            msg = followup_message(state)
-            wa_send_text(phone, msg)
-            state["follow_up_sent"] = True
-            _redis.setex(key, SESSION_TTL_SECS, json.dumps(state))
-            print(f"✅ Follow-up sent to {phone}")
-            sent += 1
+@app.on_event("shutdown")
+async def stop_followup_jobs():
+    tasks = list(_followup_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
 
+async def backfill_activity_index():
+    """Sesiones creadas antes del índice: se agregan una vez con SCAN (no bloquea Redis como KEYS)."""
+    if not _redis:
+        return
+    try:
+        if await _redis.exists(ACTIVITY_KEY):
+            return
+        added = 0
+        batch = []
+        async for key in _redis.scan_iter(match="two_travel:wa:s:*", count=500):
+            batch.append(key)
+            if len(batch) >= FOLLOWUP_BATCH:
+                added += await _index_sessions(batch)
+                batch = []
+        if batch:
+            added += await _index_sessions(batch)
+        print(f"BOOT> Activity index backfill: {added} sessions")
     except Exception as e:
-        print("Follow-up cron error:", e)
-        return {"error": str(e)}
+        print("Activity index backfill error:", e)
+
+async def _index_sessions(keys: list) -> int:
+    raws = await _rsess.mget(keys)
+    scores = {}
+    for key, raw in zip(keys, raws):
+        if raw:
+            scores[key.split("two_travel:wa:s:")[-1]] = _activity_ts(decode_session(raw))
+    if scores:
+        await _redis.zadd(ACTIVITY_KEY, scores)
+    return len(scores)
 
-    return {"sent": sent, "skipped": skipped}
+@app.on_event("startup")
+async def boot_activity_index():
+    asyncio.create_task(backfill_activity_index())
 
 # ==================== WEBHOOK VERIFICATION (GET) ====================
 @app.get("/wa-webhook")
@@ -1327,610 +3392,1035 @@ async def verify_webhook(request: Request):
     return PlainTextResponse("Forbidden", status_code=403)
 
 
-# ==================== WEBHOOK RECEIVER (POST) ====================
-@app.post("/wa-webhook")
-async def incoming(req: Request):
-    data = await req.json()
-    print("Incoming:", data)
-
-    # helper local para volver al menú limpio
-    def reset_to_menu(state, user):
-        state["step"] = "menu"
-        state["service_type"] = None
-        state["pending_service"] = None
-        state["category_tag"] = None
-        state["pax"] = None
-        state["date"] = None
-        set_session(user, state)
+# ==================== COLA DE MENSAJES (webhook → workers) ====================
+# El webhook sólo valida y encola; la máquina de estados corre en workers.
+# Cada usuario cae siempre en el mismo shard (crc32 del número); el consumidor
+# del shard reparte a carriles por usuario (ver dispatch) => orden estricto por
+# usuario y usuarios distintos en paralelo.
+# Redis Streams (consumer group) si hay Redis; si no, colas en memoria (como SESSIONS).
+# Con varios procesos, cada shard lo lee uno solo a la vez (lease en Redis, renovado en
+# background); los shards se reparten en partes iguales entre los procesos vivos.
+WA_QUEUE_KEY = "two_travel:wa:q"
+WA_DLQ_KEY   = "two_travel:wa:dlq"
+WA_LEASE_KEY = "two_travel:wa:lease"      # :<shard> -> consumer dueño (con TTL)
+WA_WORKERS_KEY = "two_travel:wa:workers"  # zset consumer -> último latido
+WA_QUEUE_GROUP = "wa-workers"
+WA_CONSUMER  = (os.getenv("WA_CONSUMER_NAME") or f"{socket.gethostname()}-{os.getpid()}").strip()
+
+_mem_queues = [asyncio.Queue() for _ in range(WA_QUEUE_SHARDS)]
+DLQ_MEM = []        # dead letters en memoria (acotado a WA_DLQ_MAX)
+_queue_workers = []
+_shards_owned = set()      # shards cuyo lease tenemos y leemos
+_shards_releasing = set()  # cedidos a otro proceso: no se lee más; el lease se suelta al vaciarse
+_redis_inflight = set()    # (stream, id) despachados y aún sin ACK
+
+def _shard_for(user: str) -> int:
+    return zlib.crc32(wa_click_number(user).encode()) % WA_QUEUE_SHARDS
+
+def _qkey(shard: int) -> str:
+    return f"{WA_QUEUE_KEY}:{shard}"
+
+async def enqueue_message(m: dict):
+    shard = _shard_for(m.get("from"))
+    if _redis:
+        try:
+            await _redis.xadd(_qkey(shard), {"m": json.dumps(m)}, maxlen=WA_QUEUE_MAXLEN, approximate=True)
+            return
+        except Exception as e:
+            print("Redis xadd error:", e)
+    _mem_queues[shard].put_nowait(m)
 
-    for entry in data.get("entry", []):
-        for change in entry.get("changes", []):
-            value = change.get("value", {})
+async def dead_letter(m: dict, error: str):
+    item = {"m": m, "error": error[:500], "at": datetime.now(ZoneInfo("America/Bogota")).isoformat()}
+    print("DLQ>", item["error"], m.get("id"))
+    if _redis:
+        try:
+            await _redis.lpush(WA_DLQ_KEY, json.dumps(item))
+            await _redis.ltrim(WA_DLQ_KEY, 0, WA_DLQ_MAX - 1)
+            return
+        except Exception as e:
+            print("Redis DLQ error:", e)
+    DLQ_MEM.insert(0, item)
+    del DLQ_MEM[WA_DLQ_MAX:]
+
+# Fallas de red/Redis antes de mandar nada: el turno se puede repetir entero.
+# Si ya salió algún mensaje (TurnAlreadySent) o es un bug, va directo al DLQ.
+TRANSIENT_ERRORS = (httpx.TransportError, OSError, asyncio.TimeoutError) + (
+    (aioredis.ConnectionError, aioredis.TimeoutError) if _redis else ())
+
+async def process_with_retries(m: dict):
+    last_err = ""
+    for attempt in range(1, WA_MAX_RETRIES + 1):
+        try:
+            await handle_message(m)
+            return True
+        except Exception as e:
+            last_err = f"{type(e).__name__}: {e}"
+            print(f"Worker error (intento {attempt}/{WA_MAX_RETRIES}):", last_err)
+            if attempt == WA_MAX_RETRIES or not isinstance(e, TRANSIENT_ERRORS):
+                break
+            await asyncio.sleep(min(8.0, 0.5 * (2 ** (attempt - 1))))
+    await dead_letter(m, last_err)
+    return False
+
+# ---- Dispatcher: orden estricto por usuario, usuarios distintos en paralelo ----
+# Cada usuario tiene su "carril" (deque); un solo task lo drena en orden.
+# WA_MAX_CONCURRENCY limita cuántos mensajes se procesan a la vez en todo el proceso.
+_dispatch_sem = asyncio.Semaphore(WA_MAX_CONCURRENCY)
+_shard_slots = [asyncio.Semaphore(WA_SHARD_MAX_INFLIGHT) for _ in range(WA_QUEUE_SHARDS)]
+_user_lanes = {}    # uid -> deque[(m, on_done)]
+_lane_tasks = {}    # uid -> Task
+SHARD_DEPTH = [0] * WA_QUEUE_SHARDS  # mensajes despachados y aún no terminados, por shard
+
+def _set_depth(shard: int, delta: int):
+    SHARD_DEPTH[shard] += delta
+    metric_set(f"wa.queue_depth.shard_{shard}", SHARD_DEPTH[shard])
+    metric_set("wa.lanes_active", len(_lane_tasks))
+
+async def dispatch(m: dict, on_done=None):
+    """Encola m en el carril de su usuario. Espera si el shard está saturado (backpressure)."""
+    uid = wa_click_number(m.get("from"))
+    shard = _shard_for(uid)
+    await _shard_slots[shard].acquire()
+    _user_lanes.setdefault(uid, collections.deque()).append((m, on_done))
+    if uid not in _lane_tasks:
+        _lane_tasks[uid] = asyncio.create_task(_run_lane(uid, shard), name=f"wa-lane-{uid}")
+    _set_depth(shard, +1)
+
+async def _run_lane(uid: str, shard: int):
+    lane = _user_lanes[uid]
+    try:
+        while lane:
+            m, on_done = lane[0]
+            t0 = time.perf_counter()
+            try:
+                async with _dispatch_sem:
+                    await process_with_retries(m)
+                if on_done:
+                    await on_done()
+            except Exception as e:
+                print("Dispatcher error:", e)
+            finally:
+                lane.popleft()
+                _shard_slots[shard].release()
+                _set_depth(shard, -1)
+                metric_observe("wa.message_ms", (time.perf_counter() - t0) * 1000)
+    finally:
+        _lane_tasks.pop(uid, None)
+        if not lane:
+            _user_lanes.pop(uid, None)
+        metric_set("wa.lanes_active", len(_lane_tasks))
+
+async def _redis_entries(key: str, start: str):
+    """Entradas de nuestro consumer group: id concreto = pendientes propios desde ahí, '>' = nuevas."""
+    res = await _redis.xreadgroup(WA_QUEUE_GROUP, WA_CONSUMER, {key: start}, count=WA_QUEUE_BATCH,
+                                  block=(None if start != ">" else 5000))
+    return [e for _, entries in (res or []) for e in entries]
+
+async def _drain_mem_queue(shard: int):
+    # Mensajes que cayeron a memoria porque Redis falló al encolar
+    q = _mem_queues[shard]
+    while not q.empty():
+        m = q.get_nowait()
+        q.task_done()
+        await dispatch(m)
+
+def _redis_acker(key: str, entry_id: str):
+    async def ack():
+        _redis_inflight.discard((key, entry_id))
+        try:
+            await _redis.xack(key, WA_QUEUE_GROUP, entry_id)
+            await _redis.xdel(key, entry_id)
+        except Exception as e:
+            print("Redis xack error:", e)
+    return ack
 
-            # Ignorar callbacks de estado (delivered/read/etc.)
-            if value.get("statuses"):
-                continue
+async def _dispatch_entries(key: str, entries: list):
+    for entry_id, fields in entries:
+        if (key, entry_id) in _redis_inflight:
+            continue   # releído tras un error del loop: ya está en su carril
+        try:
+            m = json.loads(fields.get("m") or "{}")
+        except Exception:
+            m = {}
+        if m:
+            _redis_inflight.add((key, entry_id))
+            await dispatch(m, on_done=_redis_acker(key, entry_id))
+        else:
+            await _redis_acker(key, entry_id)()
 
-            for m in value.get("messages", []):
-                user = m.get("from")
-                if not user:
-                    continue
+async def _claim_orphans(key: str, min_idle_ms: int) -> list:
+    """Pendientes de otros consumers (proceso caído o que perdió el lease) pasan a ser nuestros."""
+    pending = await _redis.xpending_range(key, WA_QUEUE_GROUP, min="-", max="+", count=1000, idle=min_idle_ms)
+    ids = [p["message_id"] for p in pending if p["consumer"] != WA_CONSUMER]
+    if not ids:
+        return []
+    return await _redis.xclaim(key, WA_QUEUE_GROUP, WA_CONSUMER, min_idle_time=min_idle_ms, message_ids=ids)
 
-                # Normalizar id del usuario (solo dígitos)
-                uid = wa_click_number(user)
+def _lease_key(shard: int) -> str:
+    return f"{WA_LEASE_KEY}:{shard}"
 
-                # Evitar reprocesar mensajes duplicados
-                msg_id = m.get("id")
-                if msg_id and LAST_MSGID.get(uid) == msg_id:
-                    continue
-                if msg_id:
-                    LAST_MSGID[uid] = msg_id
-
-                # Texto / respuesta
-                text, reply_id = extract_text_or_reply(m)
-                txt_raw = (text or "").strip()
-                low_txt = txt_raw.lower()
-                rid = (reply_id or "").upper()
-
-                # ===== INICIO / RESTART =====
-                if low_txt in ("hola","hello","/start","start","inicio","menu"):
-                    state = get_session(user) or {}
-                    if not state.get("welcomed"):
-                        state.update({
-                            "step": "lang",
-                            "lang": "EN",
-                            "attempts_email": 0,
-                            "welcomed": True
-                        })
-                        set_session(user, state)
-                        wa_send_buttons(user, welcome_text(), opener_buttons())
-                    continue
+async def _lease_cas(shard: int, renew: bool) -> bool:
+    """Renueva (o suelta) el lease sólo si sigue siendo nuestro."""
+    key = _lease_key(shard)
+    async with _redis.pipeline(transaction=True) as pipe:
+        try:
+            await pipe.watch(key)
+            if await pipe.get(key) != WA_CONSUMER:
+                await pipe.unwatch()
+                return False
+            pipe.multi()
+            if renew:
+                pipe.expire(key, WA_SHARD_LEASE_SECS)
+            else:
+                pipe.delete(key)
+            await pipe.execute()
+            return True
+        except aioredis.WatchError:
+            return False
+
+async def _release_shard(shard: int):
+    _shards_owned.discard(shard)
+    _shards_releasing.discard(shard)
+    try:
+        await _lease_cas(shard, renew=False)
+    except Exception as e:
+        print("Redis lease release error:", e)
+    metric_set("wa.shards_owned", len(_shards_owned))
 
-                # ===== CARGAR SESIÓN =====
-                state = get_session(user)
-                if not state:
-                    # Primera vez sin /start: mostramos opener una sola vez
-                    state = {"step":"lang","lang":"EN","attempts_email":0,"welcomed":True}
-                    set_session(user, state)
-                    wa_send_buttons(user, welcome_text(), opener_buttons())
+async def _shard_leases():
+    """Latido + renovación de leases; toma shards libres hasta su parte y cede lo que sobra."""
+    offset = zlib.crc32(WA_CONSUMER.encode())
+    while True:
+        try:
+            now = time.time()
+            async with _redis.pipeline(transaction=False) as pipe:
+                pipe.zadd(WA_WORKERS_KEY, {WA_CONSUMER: now})
+                pipe.zremrangebyscore(WA_WORKERS_KEY, "-inf", now - WA_SHARD_LEASE_SECS)
+                pipe.zcard(WA_WORKERS_KEY)
+                *_, workers = await pipe.execute()
+            fair = -(-WA_QUEUE_SHARDS // max(1, workers))
+            for shard in sorted(_shards_owned | _shards_releasing):
+                if not await _lease_cas(shard, renew=True):
+                    print(f"QUEUE> lease del shard {shard} perdido")
+                    _shards_owned.discard(shard)
+                    _shards_releasing.discard(shard)
+            for shard in sorted(_shards_owned)[fair:]:
+                _shards_owned.discard(shard)
+                _shards_releasing.add(shard)
+            for i in range(WA_QUEUE_SHARDS):
+                shard = (offset + i) % WA_QUEUE_SHARDS
+                if len(_shards_owned) >= fair:
+                    break
+                if shard in _shards_owned or shard in _shards_releasing:
                     continue
+                if await _redis.set(_lease_key(shard), WA_CONSUMER, nx=True, ex=WA_SHARD_LEASE_SECS):
+                    _shards_owned.add(shard)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("Redis lease error:", e)
+        metric_set("wa.shards_owned", len(_shards_owned))
+        await asyncio.sleep(WA_SHARD_LEASE_SECS / 3)
+
+async def _read_owned_shard(shard: int, key: str):
+    # Lo que dejó a medias el dueño anterior va primero (como pendiente propio), luego lo nuevo
+    await _claim_orphans(key, 0)
+    start = "0"
+    next_claim = time.monotonic() + WA_SHARD_LEASE_SECS
+    while shard in _shards_owned:
+        await _drain_mem_queue(shard)
+        if time.monotonic() >= next_claim:
+            # Leído por un proceso que perdió el lease antes de despacharlo
+            await _dispatch_entries(key, await _claim_orphans(key, WA_CLAIM_IDLE_MS))
+            next_claim = time.monotonic() + WA_SHARD_LEASE_SECS
+        entries = await _redis_entries(key, start)
+        if shard not in _shards_owned and shard not in _shards_releasing:
+            return   # lease perdido mientras leíamos: lo procesa el nuevo dueño
+        if start != ">":
+            # Pendientes: avanzar el cursor (siguen sin ACK hasta terminar de procesarse)
+            if not entries:
+                start = ">"
+                continue
+            start = entries[-1][0]
+        await _dispatch_entries(key, entries)
 
-                # ===== Blindaje contra clics viejos de BOATS fuera de su paso =====
-                if rid.startswith("BOAT_") and state.get("step") != "boat_cat":
-                    if state.get("step") != "menu":
-                        reset_to_menu(state, user)
-                    h,b,btn,rows = main_menu_list(state.get("lang","EN"), state.get("city"))
-                    wa_send_list(user, h, b, btn, rows)
-                    continue
+async def _shard_worker_redis(shard: int):
+    key = _qkey(shard)
+    try:
+        await _redis.xgroup_create(key, WA_QUEUE_GROUP, id="0", mkstream=True)
+    except Exception as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+    while True:
+        await _drain_mem_queue(shard)
+        if shard in _shards_owned:
+            await _read_owned_shard(shard, key)
+        elif shard in _shards_releasing:
+            # Soltar el lease recién cuando terminó lo despachado => el nuevo dueño no se solapa
+            if not SHARD_DEPTH[shard]:
+                await _release_shard(shard)
+            await asyncio.sleep(0.2)
+        else:
+            await asyncio.sleep(1)
 
-                # ===== 0) Idioma =====
-                if state["step"] == "lang":
-                    if rid == "LANG_ES" or "español" in low_txt or low_txt == "es":
-                        state["lang"] = "ES"
-                    else:
-                        state["lang"] = "EN"
-                    state["step"] = "contact_name"
-                    set_session(user, state)
-                    wa_send_text(user, human_intro(state["lang"]))
-                    continue
+async def _shard_worker_mem(shard: int):
+    q = _mem_queues[shard]
+    while True:
+        m = await q.get()
+        q.task_done()
+        await dispatch(m)
 
-                # ===== 1) Nombre =====
-                if state["step"] == "contact_name":
-                    if not valid_name(txt_raw):
-                        wa_send_text(user, ask_fullname(state["lang"]))
-                        continue
-                    state["name"] = normalize_name(txt_raw)
-                    state["step"] = "contact_email_choice"
-                    # Crear contacto y deal tan pronto tengamos nombre + teléfono
-                    try:
-                        if not state.get("contact_id"):
-                            state["contact_id"] = hubspot_find_or_create_contact(
-                                state["name"], "", user, state.get("lang")
-                            )
-                        if state.get("contact_id") and not state.get("early_deal_id"):
-                            early_deal_id = hubspot_create_deal(
-                                contact_id=state["contact_id"],
-                                owner_id=HUBSPOT_OWNER_RAY,
-                                title=f"{state['name']} — WhatsApp Lead",
-                                desc=f"Early lead captured. Phone: {user}. Lang: {state.get('lang','-')}",
-                            )
-                            state["early_deal_id"] = early_deal_id
-                            print(f"✅ Early deal creado al capturar nombre: {early_deal_id}")
-                    except Exception as e:
-                        print("❌ Error creando early deal:", e)
-                    set_session(user, state)
-                    wa_send_text(user, ask_email(state["lang"]))
-                    wa_send_buttons(user, " ", email_buttons(state["lang"]))
-                    continue
+async def _shard_worker(shard: int):
+    while True:
+        try:
+            if _redis:
+                await _shard_worker_redis(shard)
+            else:
+                await _shard_worker_mem(shard)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Redis caído u otro error del loop: drenar memoria un rato y reintentar
+            print(f"Shard worker {shard} error:", e)
+            await _drain_mem_queue(shard)
+            await asyncio.sleep(2)
 
-                # ===== 2) Email (choice) =====
-                if state["step"] == "contact_email_choice":
-                    # Permitir teclear email en este paso
-                    typed_email = extract_first_email(txt_raw)
-                    if typed_email:
-                        clean = sanitize_email_input(typed_email)
-                        if EMAIL_RE.match(clean):
-                            state["email"] = clean
-                            state["contact_id"] = hubspot_find_or_create_contact(
-                                state.get("name"), clean, user, state.get("lang")
-                            )
-                            state["step"] = "city"
-                            set_session(user, state)
-                            wa_send_text(
-                                user,
-                                "¡Perfecto! Registré tu correo. Continuemos 👉" if is_es(state["lang"]) else
-                                "Saved your email. Let’s continue 👉"
-                            )
-                            h,b,btn,rows = city_list(state["lang"])
-                            wa_send_list(user, h, b, btn, rows)
-                            continue
+@app.on_event("startup")
+async def start_queue_workers():
+    if _redis:
+        _queue_workers.append(asyncio.create_task(_shard_leases(), name="wa-shard-leases"))
+    for i in range(WA_QUEUE_SHARDS):
+        _queue_workers.append(asyncio.create_task(_shard_worker(i), name=f"wa-shard-{i}"))
+    print(f"BOOT> {WA_QUEUE_SHARDS} queue workers ({'redis' if _redis else 'memory'})")
+
+@app.on_event("shutdown")
+async def stop_queue_workers():
+    for t in _queue_workers:
+        t.cancel()
+    await asyncio.gather(*_queue_workers, return_exceptions=True)
+    _queue_workers.clear()
+    # Dejar terminar lo que ya estaba en curso (sin ACK en Redis => se reintenta al volver)
+    if _lane_tasks:
+        await asyncio.wait(list(_lane_tasks.values()), timeout=10)
+    if _effect_tails:
+        await asyncio.wait(list(_effect_tails.values()), timeout=5)
+    if _compactions:
+        await asyncio.wait(list(_compactions.values()), timeout=5)
+    # Los shards quedan libres ya, sin esperar a que venza el lease
+    if _redis:
+        for shard in sorted(_shards_owned | _shards_releasing):
+            await _release_shard(shard)
+        try:
+            await _redis.zrem(WA_WORKERS_KEY, WA_CONSUMER)
+        except Exception as e:
+            print("Redis zrem error:", e)
+
+@app.get("/admin/queue")
+async def admin_queue(request: Request):
+    denied = admin_denied(request)
+    if denied:
+        return denied
+    out = {"backend": "redis" if _redis else "memory", "shards": {}, "inflight": {}, "dlq": len(DLQ_MEM),
+           "owned": sorted(_shards_owned)}
+    for i in range(WA_QUEUE_SHARDS):
+        out["inflight"][i] = SHARD_DEPTH[i]
+        depth = _mem_queues[i].qsize()
+        if _redis:
+            try:
+                depth += await _redis.xlen(_qkey(i))
+            except Exception as e:
+                print("Redis xlen error:", e)
+        out["shards"][i] = depth
+    if _redis:
+        try:
+            out["dlq"] += await _redis.llen(WA_DLQ_KEY)
+        except Exception as e:
+            print("Redis llen error:", e)
+    out["hubspot_pending"] = await _hs_pending_len()
+    return out
+
+@app.get("/admin/metrics")
+async def admin_metrics(request: Request):
+    denied = admin_denied(request)
+    if denied:
+        return denied
+    return metrics_snapshot()
+
+# ==================== DEDUP DE MENSAJES ====================
+# SET NX EX por message id (compartido entre workers/nodos); LRU con TTL si no hay Redis.
+MSG_DEDUP_PREFIX = "two_travel:wa:mid:"
+_seen_msgids = collections.OrderedDict()   # msg_id -> expira (monotonic)
+
+def _seen_local(msg_id: str) -> bool:
+    now = time.monotonic()
+    exp = _seen_msgids.get(msg_id)
+    if exp is not None and exp > now:
+        return True
+    _seen_msgids[msg_id] = now + MSG_DEDUP_TTL_SECS
+    _seen_msgids.move_to_end(msg_id)
+    # Acotado: se van primero los más viejos
+    while len(_seen_msgids) > MSG_DEDUP_MAX:
+        _seen_msgids.popitem(last=False)
+    return False
+
+async def seen_message(msg_id: str) -> bool:
+    """True si el id ya se recibió dentro de la ventana (y lo marca si es nuevo)."""
+    if _redis:
+        try:
+            first = await _redis.set(MSG_DEDUP_PREFIX + msg_id, "1", nx=True, ex=MSG_DEDUP_TTL_SECS)
+            return not first
+        except Exception as e:
+            print("Dedup Redis error:", e)
+    return _seen_local(msg_id)
 
-                    # Texto libre: aceptar saltar/skip/omitir
-                    if txt_raw and is_skip_text(txt_raw):
-                        state["email"] = ""
-                        state["contact_id"] = hubspot_find_or_create_contact(
-                            state.get("name"), "", user, state.get("lang")
-                        )
-                        state["step"] = "city"
-                        set_session(user, state)
-                        h,b,btn,rows = city_list(state["lang"])
-                        wa_send_list(user, h, b, btn, rows)
-                        continue
-
-                    # Texto libre equivalente al botón "Usar mi WhatsApp"
-                    if norm(txt_raw) in {"usar mi whatsapp","use my whatsapp","usar whatsapp"}:
-                        state["email"] = f"{user}@whatsapp"
-                        state["contact_id"] = hubspot_find_or_create_contact(
-                            state.get("name"), state["email"], user, state.get("lang")
-                        )
-                        state["step"] = "city"
-                        set_session(user, state)
-                        h,b,btn,rows = city_list(state["lang"])
-                        wa_send_list(user, h, b, btn, rows)
-                        continue
-
-                    if rid == "EMAIL_ENTER":
-                        state["step"] = "contact_email_enter"
-                        set_session(user, state)
-                        wa_send_text(
-                            user,
-                            "Escribe tu correo (ej. nombre@dominio.com)." if is_es(state["lang"]) else
-                            "Type your email (e.g., name@domain.com)."
-                        )
-                        continue
-
-                    if rid == "EMAIL_USE_WA":
-                        state["email"] = f"{user}@whatsapp"
-                        state["contact_id"] = hubspot_find_or_create_contact(
-                            state.get("name"), state["email"], user, state.get("lang")
-                        )
-                        state["step"] = "city"
-                        set_session(user, state)
-                        h,b,btn,rows = city_list(state["lang"])
-                        wa_send_list(user, h, b, btn, rows)
-                        continue
-
-                    if rid == "EMAIL_SKIP":
-                        state["email"] = ""
-                        state["contact_id"] = hubspot_find_or_create_contact(
-                            state.get("name"), "", user, state.get("lang")
-                        )
-                        state["step"] = "city"
-                        set_session(user, state)
-                        h,b,btn,rows = city_list(state["lang"])
-                        wa_send_list(user, h, b, btn, rows)
-                        continue
-
-                    wa_send_buttons(user, " ", email_buttons(state["lang"]))
-                    continue
+async def forget_message(msg_id: str):
+    """Libera el id si no se pudo encolar, para que la reentrega de Meta sí entre."""
+    _seen_msgids.pop(msg_id, None)
+    if _redis:
+        try:
+            await _redis.delete(MSG_DEDUP_PREFIX + msg_id)
+        except Exception as e:
+            print("Dedup Redis error:", e)
 
-                # ===== 2b) Email (enter) =====
-                if state["step"] == "contact_email_enter":
-                    # Permitir saltar desde texto libre
-                    if txt_raw and is_skip_text(txt_raw):
-                        state["email"] = ""
-                        state["contact_id"] = hubspot_find_or_create_contact(
-                            state.get("name"), "", user, state.get("lang")
-                        )
-                        state["step"] = "city"
-                        set_session(user, state)
-                        h,b,btn,rows = city_list(state["lang"])
-                        wa_send_list(user, h, b, btn, rows)
-                        continue
-
-                    candidate = sanitize_email_input(txt_raw)
-                    if not EMAIL_RE.match(candidate or ""):
-                        embedded = extract_first_email(txt_raw)
-                        if embedded:
-                            candidate = sanitize_email_input(embedded)
-
-                    if EMAIL_RE.match(candidate or ""):
-                        state["email"] = candidate
-                        state["contact_id"] = hubspot_find_or_create_contact(
-                            state.get("name"), candidate, user, state.get("lang")
-                        )
-                        state["step"] = "city"
-                        set_session(user, state)
-                        wa_send_text(
-                            user,
-                            "¡Perfecto! Registré tu correo. Continuemos 👉" if is_es(state["lang"]) else
-                            "Saved your email. Let’s continue 👉"
-                        )
-                        h,b,btn,rows = city_list(state["lang"])
-                        wa_send_list(user, h, b, btn, rows)
-                        continue
-
-                    # Fallback -> botones otra vez
-                    wa_send_buttons(user, " ", email_buttons(state["lang"]))
-                    state["step"] = "contact_email_choice"
-                    set_session(user, state)
-                    continue
+# ==================== WEBHOOK RECEIVER (POST) ====================
+@app.post("/wa-webhook")
+async def incoming(req: Request):
+    try:
+        data = await req.json()
+    except Exception:
+        return JSONResponse({"error": "invalid json"}, status_code=400)
+    print("Incoming:", data)
+    if not isinstance(data, dict):
+        return JSONResponse({"error": "invalid payload"}, status_code=400)
 
-                # ===== 3) CIUDAD =====
-                if state["step"] == "city":
-                    city_map = {
-                        "CITY_CARTAGENA":"cartagena",
-                        "CITY_MEDELLIN":"medellín",
-                        "CITY_TULUM":"tulum",
-                        "CITY_MXCITY":"mexico city",
-                    }
-                    city = city_map.get(rid)
-                    if not city:
-                        h,b,btn,rows = city_list(state["lang"])
-                        wa_send_list(user, h, b, btn, rows)
-                        continue
-                    state["city"] = city
-                    state["step"] = "menu"
-                    set_session(user, state)
-                    h,b,btn,rows = main_menu_list(state["lang"], city)
-                    wa_send_list(user, h, b, btn, rows)
-                    continue
+    queued = 0
+    for entry in data.get("entry") or []:
+        for change in (entry or {}).get("changes") or []:
+            value = (change or {}).get("value") or {}
 
-                # ===== 4) MENÚ DE SERVICIOS =====
-                if state["step"] == "menu":
-                    svc_map = {
-                        "SVC_VILLAS":"villas",
-                        "SVC_BOATS":"boats",
-                        "SVC_ISLANDS":"islands",
-                        "SVC_WEDDINGS":"weddings",
-                        "SVC_CONCIERGE":"concierge",
-                        "SVC_TEAM":"team",
-                    }
-                    if rid not in svc_map:
-                        h,b,btn,rows = main_menu_list(state["lang"], state["city"])
-                        wa_send_list(user, h, b, btn, rows)
-                        continue
-
-                    state["service_type"] = svc_map[rid]
-
-                    # ==== VILLAS ====
-                    if state["service_type"] == "villas":
-                        state["step"] = "villa_pax"
-                        set_session(user, state)
-                        h,b,btn,rows = pax_list(state["lang"])
-                        wa_send_list(user, h, b, btn, rows)
-                        continue
-
-                    # ==== BOATS ====
-                    if state["service_type"] == "boats":
-                        state["step"] = "boat_cat"
-                        set_session(user, state)
-                        wa_send_text(user, "Perfecto, veamos tipos de bote…" if is_es(state["lang"]) else "Great, let’s pick a boat type…")
-                        h,b,btn,rows = boat_categories(state["lang"])
-                        wa_send_list(user, h, b, btn, rows)
-                        continue
-
-                    # ==== ISLANDS ====
-                    if state["service_type"] == "islands":
-                        top = filter_catalog("islands", state["city"], 0, None)
-                        state["last_top"] = top
-                        state["step"] = "post_results"
-                        set_session(user, state)
-                        lbl = "día" if is_es(state["lang"]) else "day"
-                        wa_send_text(user, format_results(state["lang"], top, lbl, service_type="islands", city=state["city"]))
-                        owner_name, owner_id, cal_url, pretty_city, wa_num = owner_for_city(state["city"])
-                        notify_sales("Lead Islands", state, user, cal_url=cal_url, owner_name=owner_name, pretty_city=pretty_city)
-                        try:
-                            if not state.get("contact_id"):
-                                state["contact_id"] = hubspot_find_or_create_contact(
-                                    state.get("name"), state.get("email",""), user, state.get("lang")
-                                )
-                                set_session(user, state)
-                            if state.get("contact_id"):
-                                hubspot_upsert_deal(state, deal_title_from_state(state), f"Lead Islands from WhatsApp. Lang: {state.get('lang','-')}", phone=user)
-                                print("✅ Deal upsert para Islands")
-                            else:
-                                print("⚠️ No hay contact_id; se omite creación de Deal")
-                        except Exception as e:
-                            print("❌ Error creando el Deal:", e)
-                        wa_send_buttons(
-                            user,
-                            "¿Cómo podemos seguir ayudándote?" if is_es(state["lang"]) else "How can we keep helping?",
-                            after_results_buttons(state["lang"])
-                        )
-                        continue
-
-                    # ==== WEDDINGS ====
-                    if state["service_type"] == "weddings":
-                        state["step"] = "wed_guests"
-                        set_session(user, state)
-                        h,b,btn,rows = weddings_guests_list(state["lang"])
-                        wa_send_list(user, h, b, btn, rows)
-                        continue
-
-                    # ==== CONCIERGE / TEAM ====
-                    if state["service_type"] in ("concierge","team"):
-                        owner_name, owner_id, cal_url, pretty_city, wa_num = owner_for_city(state["city"])
-                        msg = handoff_full_message(state, owner_name, wa_num, cal_url, pretty_city)
-                        wa_send_text(user, msg)
-                        notify_sales(f"Lead {state['service_type'].title()}", state, user, cal_url=cal_url, owner_name=owner_name, pretty_city=pretty_city)
-                        try:
-                            if not state.get("contact_id"):
-                                state["contact_id"] = hubspot_find_or_create_contact(
-                                    state.get("name"), state.get("email",""), user, state.get("lang")
-                                )
-                                set_session(user, state)
-                            if state.get("contact_id"):
-                                hubspot_upsert_deal(state, deal_title_from_state(state), f"Lead {state['service_type'].title()} from WhatsApp. Lang: {state.get('lang','-')}", phone=user)
-                                print(f"✅ Deal upsert para {state['service_type']}")
-                            else:
-                                print("⚠️ No hay contact_id; se omite creación de Deal")
-                        except Exception as e:
-                            print("❌ Error creando el Deal:", e)
-                        continue
-
-                # ===== BOATS → categoría =====
-                if state["step"] == "boat_cat":
-                    valid = ("BOAT_SPEED","BOAT_YACHT","BOAT_CAT","BOAT_ALL","BOAT_UNSURE")
-                    if rid not in valid:
-                        h,b,btn,rows = boat_categories(state["lang"])
-                        wa_send_list(user, h, b, btn, rows)
-                        continue
-
-                    # NO SÉ → conectar directo con Ray
-                    if rid == "BOAT_UNSURE":
-                        owner_name, owner_id, cal_url, pretty_city, wa_num = owner_for_city(state["city"])
-                        msg = handoff_full_message(state, owner_name, wa_num, cal_url, pretty_city)
-                        wa_send_text(user, msg)
-                        notify_sales("Lead Boats (unsure)", state, user, cal_url=cal_url, owner_name=owner_name, pretty_city=pretty_city)
-                        try:
-                            if not state.get("contact_id"):
-                                state["contact_id"] = hubspot_find_or_create_contact(
-                                    state.get("name"), state.get("email",""), user, state.get("lang")
-                                )
-                                set_session(user, state)
-                            if state.get("contact_id"):
-                                hubspot_upsert_deal(state, deal_title_from_state(state), f"Lead Boats (unsure type) from WhatsApp. Lang: {state.get('lang','-')}", phone=user)
-                                print("✅ Deal upsert para Boats (unsure)")
-                            else:
-                                print("⚠️ No hay contact_id; se omite creación de Deal")
-                        except Exception as e:
-                            print("❌ Error creando el Deal:", e)
-                        wa_send_buttons(
-                            user,
-                            "¿Qué más necesitas?" if is_es(state["lang"]) else "What else do you need?",
-                            [
-                                {"id":"POST_ADD_SERVICE","title":"Añadir otro servicio" if is_es(state["lang"]) else "Add another service"},
-                                {"id":"POST_MENU","title":"Volver al menú" if is_es(state["lang"]) else "Back to menu"},
-                            ]
-                        )
-                        continue
-
-                    # El resto sigue normal
-                    state["category_tag"] = {
-                        "BOAT_SPEED":"type_speedboat",
-                        "BOAT_YACHT":"type_yacht",
-                        "BOAT_CAT":"type_catamaran",
-                        "BOAT_ALL":None,
-                    }[rid]
-
-                    state["step"] = "boat_pax"
-                    set_session(user, state)
-                    h,b,btn,rows = pax_list(state["lang"])
-                    wa_send_list(user, h, b, btn, rows)
-                    continue
+            # Ignorar callbacks de estado (delivered/read/etc.)
+            if value.get("statuses"):
+                continue
 
-                # ===== BOATS → PAX =====
-                if state["step"] == "boat_pax":
-                    if not rid or not rid.startswith("PAX_"):
-                        h,b,btn,rows = pax_list(state["lang"])
-                        wa_send_list(user, h, b, btn, rows)
-                        continue
-                    state["pax"] = pax_from_reply(rid)
-                    state["step"] = "date"
-                    state["pending_service"] = "boats"
-                    set_session(user, state)
-                    wa_send_text(user, ask_date(state["lang"]))
+            for m in value.get("messages") or []:
+                if not isinstance(m, dict) or not m.get("from"):
                     continue
-
-                # ===== VILLAS → PAX =====
-                if state["step"] == "villa_pax":
-                    if not rid or not rid.startswith("PAX_"):
-                        h,b,btn,rows = pax_list(state["lang"])
-                        wa_send_list(user, h, b, btn, rows)
-                        continue
-                    state["pax"] = pax_from_reply(rid)
-                    state["step"] = "villa_cat"
-                    set_session(user, state)
-                    h,b,btn,rows = villa_categories(state["lang"])
-                    wa_send_list(user, h, b, btn, rows)
+                msg_id = m.get("id")
+                if msg_id and await seen_message(msg_id):
+                    metric_inc("wa.duplicates")
                     continue
+                try:
+                    await enqueue_message(m)
+                except Exception:
+                    if msg_id:
+                        await forget_message(msg_id)
+                    raise
+                queued += 1
+
+    return {"ok": True, "queued": queued}
+
+# ==================== UI PRECONSTRUIDA ====================
+# Menús, listas y botones fijos: el cuerpo JSON de Graph se arma y serializa una vez por
+# (plantilla, idioma, ciudad) al arrancar; al enviar solo se antepone el destinatario.
+UI_TEMPLATES = {   # nombre -> (constructor(lang, city), depende de la ciudad)
+    "welcome":     (lambda lang, city: ("buttons", welcome_text(), opener_buttons()), False),
+    "email":       (lambda lang, city: ("buttons", " ", email_buttons(lang)), False),
+    "cities":      (lambda lang, city: ("list", *city_list(lang)), False),
+    "menu":        (lambda lang, city: ("list", *main_menu_list(lang, city)), True),
+    "pax":         (lambda lang, city: ("list", *pax_list(lang)), False),
+    "villa_cats":  (lambda lang, city: ("list", *villa_categories(lang)), False),
+    "boat_cats":   (lambda lang, city: ("list", *boat_categories(lang)), False),
+    "wed_guests":  (lambda lang, city: ("list", *weddings_guests_list(lang)), False),
+    "keep_helping": (lambda lang, city: ("buttons",
+                     "¿Cómo podemos seguir ayudándote?" if is_es(lang) else "How can we keep helping?",
+                     after_results_buttons(lang)), False),
+    "add_or_team": (lambda lang, city: ("buttons",
+                    "¿Quieres añadir otro servicio o hablar con el equipo?" if is_es(lang) else "Would you like to add another service or talk to the team?",
+                    after_results_buttons(lang)), False),
+    "what_else":   (lambda lang, city: ("buttons",
+                    "¿Qué más necesitas?" if is_es(lang) else "What else do you need?",
+                    [
+                        {"id":"POST_ADD_SERVICE","title":"Añadir otro servicio" if is_es(lang) else "Add another service"},
+                        {"id":"POST_MENU","title":"Volver al menú" if is_es(lang) else "Back to menu"},
+                    ]), False),
+}
+UI_LANGS = ("EN", "ES")
+_UI_CACHE = {}   # (nombre, lang, ciudad) -> bytes del cuerpo después de "to"
+
+def _ui_key(name: str, lang: str, city: str | None) -> tuple:
+    by_city = UI_TEMPLATES[name][1]
+    return (name, "ES" if is_es(lang) else "EN", canonical_city(city or "") if by_city else None)
+
+def _ui_build(name: str, lang: str, city: str | None) -> bytes:
+    kind, *args = UI_TEMPLATES[name][0](lang, city)
+    interactive = _buttons_interactive(*args) if kind == "buttons" else _list_interactive(*args)
+    # Sin la llave inicial: se concatena detrás de {"messaging_product":…,"to":…,
+    return _wa_json({"type": "interactive", "interactive": interactive})[1:]
+
+def ui_body(to: str, name: str, lang: str, city: str | None = None) -> bytes:
+    key = _ui_key(name, lang, city)
+    tail = _UI_CACHE.get(key)
+    if tail is None:
+        tail = _UI_CACHE[key] = _ui_build(*key)
+        metric_inc("ui.cache_miss")
+    return b'{"messaging_product":"whatsapp","to":' + _wa_json(to) + b"," + tail
+
+async def wa_send_ui(to: str, name: str, lang: str, city: str | None = None):
+    return await wa_send(to, ui_body(to, name, lang, city))
 
-                # ===== VILLAS → CAT =====
-                if state["step"] == "villa_cat":
-                    valid = ("VILLA_3_6","VILLA_7_10","VILLA_11_14","VILLA_15P")
-                    if rid not in valid:
-                        h,b,btn,rows = villa_categories(state["lang"])
-                        wa_send_list(user, h, b, btn, rows)
-                        continue
-                    state["category_tag"] = {
-                        "VILLA_3_6":"bed_3_6",
-                        "VILLA_7_10":"bed_7_10",
-                        "VILLA_11_14":"bed_11_14",
-                        "VILLA_15P":"bed_15_plus",
-                    }[rid]
-                    state["step"] = "date"
-                    state["pending_service"] = "villas"
-                    set_session(user, state)
-                    wa_send_text(user, ask_date(state["lang"]))
-                    continue
+@app.on_event("startup")
+async def prebuild_ui():
+    cities = [None] + list(CITY_BY_REPLY.values())
+    for name, (_, by_city) in UI_TEMPLATES.items():
+        for lang in UI_LANGS:
+            for city in (cities if by_city else [None]):
+                key = _ui_key(name, lang, city)
+                if key not in _UI_CACHE:
+                    _UI_CACHE[key] = _ui_build(*key)
+    print(f"BOOT> UI payloads: {len(_UI_CACHE)}")
+
+def ui_action(name: str, state: dict) -> tuple:
+    return ("ui", name, state.get("lang"), state.get("city"))
+
+# ==================== MÁQUINA DE ESTADOS ====================
+# Cada paso del flujo es un handler registrado con @step. El handler actualiza el
+# estado y devuelve la lista de acciones del turno; el runtime (run_actions) las ejecuta:
+#   ("text", body) / ("buttons", body, buttons) / ("list", h, b, btn, rows)  → WhatsApp, en orden
+#   ("ui", plantilla, lang, city)                                           → WhatsApp (UI preconstruida)
+#   ("contact",) / ("early_lead",) / ("lead", ...) / ("lead_handoff",)       → CRM/avisos, diferidos
+# Las respuestas de Luna (IA) se envían en streaming desde el propio handler.
+
+STEPS = {}   # step -> (handler, pasos a los que puede transicionar)
+
+def step(name: str, to: tuple = ()):
+    def deco(fn):
+        STEPS[name] = (fn, frozenset(to) | {name})
+        return fn
+    return deco
+
+class StepCtx:
+    __slots__ = ("user", "state", "txt_raw", "low_txt", "rid")
+
+    def __init__(self, user: str, txt_raw: str, rid: str):
+        self.user = user
+        self.state = None
+        self.txt_raw = txt_raw
+        self.low_txt = txt_raw.lower()
+        self.rid = rid
+
+SEND_ACTIONS = {
+    "text": wa_send_text,
+    "buttons": wa_send_buttons,
+    "list": wa_send_list,
+    "ui": wa_send_ui,
+}
 
-                # ===== WEDDINGS → invitados =====
-                if state["step"] == "wed_guests":
-                    if rid not in ("WED_PAX_50","WED_PAX_100","WED_PAX_200","WED_PAX_201","WED_PAX_UNK"):
-                        h,b,btn,rows = weddings_guests_list(state["lang"])
-                        wa_send_list(user, h, b, btn, rows)
-                        continue
-                    state["pax"] = pax_from_reply(rid)
-                    state["step"] = "date"
-                    state["pending_service"] = "weddings"
-                    set_session(user, state)
-                    wa_send_text(user, ask_date(state["lang"]))
-                    continue
+async def _run_effect(user: str, state: dict, action: tuple):
+    kind = action[0]
+    try:
+        if kind == "contact":
+            await hubspot_sync_contact(state, user)
+        elif kind == "early_lead":
+            # Crear contacto y deal tan pronto tengamos nombre + teléfono
+            if not state.get("contact_id"):
+                await hubspot_sync_contact(state, user)
+            if not state.get("early_deal_id"):
+                await hubspot_upsert_deal(
+                    state,
+                    f"{state['name']} — WhatsApp Lead",
+                    f"Early lead captured. Phone: {user}. Lang: {state.get('lang','-')}",
+                    phone=user, with_note=False,
+                )
+        elif kind == "lead":
+            _, event, handoff, with_contact, owner_name, cal_url, pretty_city = action
+            if with_contact and not state.get("contact_id"):
+                await hubspot_sync_contact(state, user)
+            # Email + deal consolidados (debounce por usuario)
+            await lead_event(event, state, user, handoff=handoff,
+                             cal_url=cal_url, owner_name=owner_name, pretty_city=pretty_city)
+        elif kind == "lead_handoff":
+            await lead_handoff(user)
+        else:
+            print("⚠️ Acción desconocida:", kind)
+    except Exception as e:
+        print(f"❌ Error en acción {kind}:", e)
+
+# Efectos diferidos: un task por turno, encadenado al anterior del mismo usuario para
+# que el CRM reciba las operaciones en el orden de la conversación.
+_effect_tails = {}   # user -> Task con los efectos de su último turno
+
+def defer_effects(user: str, state: dict, effects: list):
+    prev = _effect_tails.get(user)
+
+    async def _run():
+        if prev:
+            await asyncio.gather(prev, return_exceptions=True)
+        t0 = time.perf_counter()
+        await asyncio.gather(*(_run_effect(user, state, a) for a in effects))
+        metric_observe("wa.effects_ms", (time.perf_counter() - t0) * 1000)
+
+    task = asyncio.create_task(_run(), name=f"wa-effects-{user}")
+    _effect_tails[user] = task
+
+    def _done(t):
+        if _effect_tails.get(user) is t:
+            del _effect_tails[user]
+    task.add_done_callback(_done)
+
+async def run_actions(user: str, state: dict, actions: list):
+    """Primero lo que ve el usuario, en orden; CRM y avisos salen después, sin bloquear el turno."""
+    effects = []
+    for action in actions:
+        if action[0] in SEND_ACTIONS:
+            await SEND_ACTIONS[action[0]](user, *action[1:])
+        else:
+            effects.append(action)
+    if effects:
+        defer_effects(user, state, effects)
+
+# ---- Acciones comunes ----
+def lead_action(state: dict, event: str, handoff: bool = False, with_contact: bool = True) -> tuple:
+    owner_name, owner_id, cal_url, pretty_city, wa_num = owner_for_city(state["city"])
+    return ("lead", event, handoff, with_contact, owner_name, cal_url, pretty_city)
+
+def handoff_action(state: dict) -> tuple:
+    owner_name, owner_id, cal_url, pretty_city, wa_num = owner_for_city(state["city"])
+    return ("text", handoff_full_message(state, owner_name, wa_num, cal_url, pretty_city))
+
+def menu_action(state: dict) -> tuple:
+    return ui_action("menu", state)
+
+# ==================== PROCESAMIENTO DE UN MENSAJE ====================
+class TurnAlreadySent(Exception):
+    """El turno falló después de mandar mensajes: repetirlo los duplicaría."""
+
+async def handle_message(m: dict):
+    """Un turno: la sesión se lee una vez y se escribe una vez al final (SessionTurn)."""
+    user = m.get("from")
+    if not user:
+        return
+    turn = SessionTurn(user)
+    token = _session_turn.set(turn)
+    try:
+        await _handle_turn(m)
+    except Exception as e:
+        if turn.sent:
+            raise TurnAlreadySent(f"{type(e).__name__}: {e}") from e
+        # Nada salió todavía: se descarta lo del turno y el reintento parte de la sesión original
+        turn.pending = None
+        raise
+    finally:
+        _session_turn.reset(token)
+        turn.closed = True
+        # Si el turno falló después de enviar, lo guardado hasta ahí queda, como antes
+        try:
+            await turn.flush()
+        finally:
+            turn.done.set()
+
+async def _handle_turn(m: dict):
+    # Los duplicados ya se filtran en el webhook (seen_message)
+
+    # Texto / respuesta
+    text, reply_id = extract_text_or_reply(m)
+    ctx = StepCtx(m.get("from"), (text or "").strip(), (reply_id or "").upper())
+
+    t0 = time.perf_counter()
+    name, actions = await _dispatch(ctx)
+    if actions:
+        await run_actions(ctx.user, ctx.state, actions)
+    metric_observe(f"wa.step.{name}_ms", (time.perf_counter() - t0) * 1000)
+
+def new_conversation_id() -> str:
+    """Id de la conversación (vive lo que la sesión): un deal de HubSpot por conversación."""
+    return os.urandom(8).hex()
+
+async def _dispatch(ctx: StepCtx):
+    """Devuelve (nombre del paso, acciones). Búsqueda O(1) del handler por state["step"]."""
+    user = ctx.user
+
+    # ===== INICIO / RESTART =====
+    if ctx.low_txt in ("hola","hello","/start","start","inicio","menu"):
+        state = ctx.state = await get_session(user) or {}
+        if state.get("welcomed"):
+            return "start", []
+        state.update({
+            "step": "lang",
+            "lang": "EN",
+            "attempts_email": 0,
+            "welcomed": True,
+            "conv": new_conversation_id(),
+        })
+        await set_session(user, state)
+        return "start", [ui_action("welcome", state)]
+
+    # ===== CARGAR SESIÓN =====
+    state = ctx.state = await get_session(user)
+    if not state:
+        # Primera vez sin /start: mostramos opener una sola vez
+        state = ctx.state = {"step":"lang","lang":"EN","attempts_email":0,"welcomed":True,"conv":new_conversation_id()}
+        await set_session(user, state)
+        return "start", [ui_action("welcome", state)]
+
+    # ===== Blindaje contra clics viejos de BOATS fuera de su paso =====
+    if ctx.rid.startswith("BOAT_") and state.get("step") != "boat_cat":
+        if state.get("step") != "menu":
+            await reset_to_menu(state, user)
+        return "guard", [menu_action(state)]
+
+    name = state.get("step")
+    entry = STEPS.get(name)
+    if entry is None:
+        return "fallback", await step_fallback(ctx)
+    handler, allowed = entry
+    actions = await handler(ctx)
+    if state.get("step") not in allowed:
+        print(f"⚠️ Transición no declarada: {name} -> {state.get('step')}")
+        metric_inc("wa.step_undeclared")
+    return name, actions
+
+# ===== 0) Idioma =====
+@step("lang", to=("contact_name",))
+async def step_lang(ctx: StepCtx):
+    state = ctx.state
+    if ctx.rid == "LANG_ES" or "español" in ctx.low_txt or ctx.low_txt == "es":
+        state["lang"] = "ES"
+    else:
+        state["lang"] = "EN"
+    state["step"] = "contact_name"
+    await set_session(ctx.user, state)
+    return [("text", human_intro(state["lang"]))]
+
+# ===== 1) Nombre =====
+@step("contact_name", to=("contact_email_choice",))
+async def step_contact_name(ctx: StepCtx):
+    state = ctx.state
+    if not valid_name(ctx.txt_raw):
+        return [("text", ask_fullname(state["lang"]))]
+    state["name"] = normalize_name(ctx.txt_raw)
+    state["step"] = "contact_email_choice"
+    await set_session(ctx.user, state)
+    return [
+        ("early_lead",),
+        ("text", ask_email(state["lang"])),
+        ui_action("email", state),
+    ]
 
-                # ===== FECHA (común) =====
-                if state["step"] == "date":
-                    skip_tokens = {"omitir","skip","no sé","nose","tbd","na","n/a","later","después","luego","aún no","no tengo","no se","todavia no","aun no"}
+# ===== 2) Email =====
+async def _email_saved(ctx: StepCtx, email: str, ack: bool = False):
+    state = ctx.state
+    state["email"] = email
+    state["step"] = "city"
+    await set_session(ctx.user, state)
+    actions = [("contact",)]
+    if ack:
+        actions.append(("text",
+            "¡Perfecto! Registré tu correo. Continuemos 👉" if is_es(state["lang"]) else
+            "Saved your email. Let’s continue 👉"
+        ))
+    actions.append(ui_action("cities", state))
+    return actions
+
+@step("contact_email_choice", to=("city", "contact_email_enter"))
+async def step_email_choice(ctx: StepCtx):
+    state, user, txt_raw, rid = ctx.state, ctx.user, ctx.txt_raw, ctx.rid
+    # Permitir teclear email en este paso
+    typed_email = extract_first_email(txt_raw)
+    if typed_email:
+        clean = sanitize_email_input(typed_email)
+        if EMAIL_RE.match(clean):
+            return await _email_saved(ctx, clean, ack=True)
+
+    # Texto libre: aceptar saltar/skip/omitir
+    if txt_raw and is_skip_text(txt_raw):
+        return await _email_saved(ctx, "")
+
+    # Texto libre equivalente al botón "Usar mi WhatsApp"
+    if norm(txt_raw) in {"usar mi whatsapp","use my whatsapp","usar whatsapp"}:
+        return await _email_saved(ctx, f"{user}@whatsapp")
+
+    if rid == "EMAIL_ENTER":
+        state["step"] = "contact_email_enter"
+        await set_session(user, state)
+        return [("text",
+            "Escribe tu correo (ej. nombre@dominio.com)." if is_es(state["lang"]) else
+            "Type your email (e.g., name@domain.com)."
+        )]
+
+    if rid == "EMAIL_USE_WA":
+        return await _email_saved(ctx, f"{user}@whatsapp")
+
+    if rid == "EMAIL_SKIP":
+        return await _email_saved(ctx, "")
+
+    return [ui_action("email", state)]
+
+@step("contact_email_enter", to=("city", "contact_email_choice"))
+async def step_email_enter(ctx: StepCtx):
+    state, txt_raw = ctx.state, ctx.txt_raw
+    # Permitir saltar desde texto libre
+    if txt_raw and is_skip_text(txt_raw):
+        return await _email_saved(ctx, "")
+
+    candidate = sanitize_email_input(txt_raw)
+    if not EMAIL_RE.match(candidate or ""):
+        embedded = extract_first_email(txt_raw)
+        if embedded:
+            candidate = sanitize_email_input(embedded)
+
+    if EMAIL_RE.match(candidate or ""):
+        return await _email_saved(ctx, candidate, ack=True)
+
+    # Fallback -> botones otra vez
+    state["step"] = "contact_email_choice"
+    await set_session(ctx.user, state)
+    return [ui_action("email", state)]
+
+# ===== 3) CIUDAD =====
+CITY_BY_REPLY = {
+    "CITY_CARTAGENA":"cartagena",
+    "CITY_MEDELLIN":"medellín",
+    "CITY_TULUM":"tulum",
+    "CITY_MXCITY":"mexico city",
+}
 
-                    if low_txt not in skip_tokens:
-                        ok_future, warn_msg = _validate_future_or_warn(txt_raw, state.get("lang"))
-                        if not ok_future:
-                            wa_send_text(user, warn_msg)
-                            wa_send_text(user, ask_date(state["lang"]))
-                            continue
+@step("city", to=("menu",))
+async def step_city(ctx: StepCtx):
+    state = ctx.state
+    city = CITY_BY_REPLY.get(ctx.rid)
+    if not city:
+        return [ui_action("cities", state)]
+    state["city"] = city
+    state["step"] = "menu"
+    await set_session(ctx.user, state)
+    return [menu_action(state)]
+
+# ===== 4) MENÚ DE SERVICIOS =====
+SERVICE_BY_REPLY = {
+    "SVC_VILLAS":"villas",
+    "SVC_BOATS":"boats",
+    "SVC_ISLANDS":"islands",
+    "SVC_WEDDINGS":"weddings",
+    "SVC_CONCIERGE":"concierge",
+    "SVC_TEAM":"team",
+}
 
-                    state["date"] = None if low_txt in skip_tokens else txt_raw
-                    svc = state.get("pending_service")
-
-                    # --- Resultado según servicio ---
-                    top = filter_catalog(svc, state["city"], state.get("pax") or 0, state.get("category_tag"))
-                    unit_es = {"villas":"noche","boats":"día","islands":"día","weddings":"evento"}
-                    unit_en = {"villas":"night","boats":"day","islands":"day","weddings":"event"}
-                    unit = unit_es[svc] if is_es(state["lang"]) else unit_en[svc]
-
-                    state["last_top"] = top
-                    append_history(state, svc)
-                    state["step"] = "post_results"
-                    set_session(user, state)
-
-                    wa_send_text(
-                        user,
-                        format_results(state["lang"], top, unit, service_type=svc, city=state["city"])
-                    )
-
-                    owner_name, owner_id, cal_url, pretty_city, wa_num = owner_for_city(state["city"])
-                    notify_sales(f"Lead {svc.title()}", state, user, cal_url=cal_url, owner_name=owner_name, pretty_city=pretty_city)
-                    try:
-                        if state.get("contact_id"):
-                            deal_title = deal_title_from_state(state)
-                            deal_desc  = build_history_lines(state) or f"Lead from WhatsApp. Lang: {state.get('lang','-')}"
-                            hubspot_upsert_deal(state, deal_title, deal_desc, phone=user)
-                            print("✅ Deal upsert asignado a Ray")
-                        else:
-                            print("⚠️ No hay contact_id; se omite creación de Deal")
-                    except Exception as e:
-                        print("❌ Error creando el Deal:", e)
-
-                    if not top:
-                        msg = handoff_full_message(state, owner_name, wa_num, cal_url, pretty_city)
-                        wa_send_text(user, msg)
-
-                    wa_send_buttons(
-                        user,
-                        "¿Cómo podemos seguir ayudándote?" if is_es(state["lang"]) else "How can we keep helping?",
-                        after_results_buttons(state["lang"])
-                    )
-                    continue
+@step("menu", to=("villa_pax", "boat_cat", "post_results", "wed_guests"))
+async def step_menu(ctx: StepCtx):
+    state, user = ctx.state, ctx.user
+    if ctx.rid not in SERVICE_BY_REPLY:
+        return [menu_action(state)]
+
+    svc = state["service_type"] = SERVICE_BY_REPLY[ctx.rid]
+
+    # ==== VILLAS ====
+    if svc == "villas":
+        state["step"] = "villa_pax"
+        await set_session(user, state)
+        return [ui_action("pax", state)]
+
+    # ==== BOATS ====
+    if svc == "boats":
+        state["step"] = "boat_cat"
+        await set_session(user, state)
+        return [
+            ("text", "Perfecto, veamos tipos de bote…" if is_es(state["lang"]) else "Great, let’s pick a boat type…"),
+            ui_action("boat_cats", state),
+        ]
 
-                # ===== POST RESULTADOS =====
-                if state["step"] == "post_results":
-                    # Entrada libre: mezcla de botes (p.ej. "1 lancha y 1 cat")
-                    if (state.get("service_type") == "boats") and txt_raw and not rid:
-                        mix = parse_boat_mix(txt_raw)
-                        if mix:
-                            state["boat_mix"] = mix
-                            set_session(user, state)
-                            es = is_es(state.get("lang"))
-                            parts_es, parts_en = [], []
-                            if mix.get("speedboat"):
-                                parts_es.append(f"{mix['speedboat']} lancha")
-                                parts_en.append(f"{mix['speedboat']} speedboat")
-                            if mix.get("catamaran"):
-                                parts_es.append(f"{mix['catamaran']} catamarán")
-                                parts_en.append(f"{mix['catamaran']} catamaran")
-                            if mix.get("yacht"):
-                                parts_es.append(f"{mix['yacht']} yate")
-                                parts_en.append(f"{mix['yacht']} yacht")
-                            ack = ("Perfecto — mix solicitado: " + ", ".join(parts_es)
-                                   if es else
-                                   "Got it — requested mix: " + ", ".join(parts_en))
-                            wa_send_text(user, ack)
-
-                            owner_name, owner_id, cal_url, pretty_city, wa_num = owner_for_city(state["city"])
-                            msg = handoff_full_message(state, owner_name, wa_num, cal_url, pretty_city)
-                            wa_send_text(user, msg)
-
-                            wa_send_buttons(
-                                user,
-                                "¿Qué más necesitas?" if es else "What else do you need?",
-                                [
-                                    {"id":"POST_ADD_SERVICE","title":"Añadir otro servicio" if es else "Add another service"},
-                                    {"id":"POST_MENU","title":"Volver al menú" if es else "Back to menu"},
-                                ]
-                            )
-                            continue
+    # ==== ISLANDS ====
+    if svc == "islands":
+        # En frío puede tener que descargar el sheet: al thread pool
+        top = await asyncio.to_thread(filter_catalog, "islands", state["city"], 0, None)
+        state["last_top"] = top_ref(top)
+        append_history(state, "islands")
+        state["step"] = "post_results"
+        await set_session(user, state)
+        lbl = "día" if is_es(state["lang"]) else "day"
+        return [
+            ("text", format_results(state["lang"], top, lbl, service_type="islands", city=state["city"])),
+            lead_action(state, "Lead Islands"),
+            ui_action("keep_helping", state),
+        ]
 
-                    if rid == "POST_ADD_SERVICE":
-                        reset_to_menu(state, user)
-                        h,b,btn,rows = main_menu_list(state["lang"], state["city"])
-                        wa_send_list(user, h, b, btn, rows)
-                        continue
-
-                    if rid == "POST_TALK_TEAM":
-                        owner_name, owner_id, cal_url, pretty_city, wa_num = owner_for_city(state["city"])
-                        msg = handoff_full_message(state, owner_name, wa_num, cal_url, pretty_city)
-                        wa_send_text(user, msg)
-                        wa_send_buttons(
-                            user,
-                            "¿Qué más necesitas?" if is_es(state["lang"]) else "What else do you need?",
-                            [
-                                {"id":"POST_ADD_SERVICE","title":"Añadir otro servicio" if is_es(state["lang"]) else "Add another service"},
-                                {"id":"POST_MENU","title":"Volver al menú" if is_es(state["lang"]) else "Back to menu"},
-                            ]
-                        )
-                        continue
-
-                    if rid == "POST_MENU":
-                        reset_to_menu(state, user)
-                        h,b,btn,rows = main_menu_list(state["lang"], state["city"])
-                        wa_send_list(user, h, b, btn, rows)
-                        continue
-
-                    # Texto libre en post_results → respuesta con IA
-                    if txt_raw and not rid:
-                        ai_reply = luna_ai_reply(txt_raw, state)
-                        if ai_reply:
-                            wa_send_text(user, ai_reply)
-                        wa_send_buttons(
-                            user,
-                            "¿Quieres añadir otro servicio o hablar con el equipo?" if is_es(state["lang"]) else "Would you like to add another service or talk to the team?",
-                            after_results_buttons(state["lang"])
-                        )
-                        continue
-
-                    wa_send_buttons(
-                        user,
-                        "¿Quieres añadir otro servicio o hablar con el equipo?" if is_es(state["lang"]) else "Would you like to add another service or talk to the team?",
-                        after_results_buttons(state["lang"])
-                    )
-                    continue
+    # ==== WEDDINGS ====
+    if svc == "weddings":
+        state["step"] = "wed_guests"
+        await set_session(user, state)
+        return [ui_action("wed_guests", state)]
+
+    # ==== CONCIERGE / TEAM ====
+    append_history(state, svc)
+    await set_session(user, state)
+    # Handoff: se notifica ya, junto con lo que venía navegando
+    return [handoff_action(state), lead_action(state, f"Lead {svc.title()}", handoff=True)]
+
+# ===== BOATS → categoría =====
+BOAT_TAG_BY_REPLY = {
+    "BOAT_SPEED":"type_speedboat",
+    "BOAT_YACHT":"type_yacht",
+    "BOAT_CAT":"type_catamaran",
+    "BOAT_ALL":None,
+}
 
-                # ===== FALLBACK con IA =====
-                # Si llegamos aquí sin haber hecho continue, el usuario escribió algo inesperado
-                if txt_raw and not rid:
-                    ai_reply = luna_ai_reply(txt_raw, state)
-                    if ai_reply:
-                        wa_send_text(user, ai_reply)
-                    continue
+@step("boat_cat", to=("boat_pax",))
+async def step_boat_cat(ctx: StepCtx):
+    state, rid = ctx.state, ctx.rid
+    # NO SÉ → conectar directo con Ray
+    if rid == "BOAT_UNSURE":
+        return [
+            handoff_action(state),
+            lead_action(state, "Lead Boats (unsure)", handoff=True),
+            ui_action("what_else", state),
+        ]
+    if rid not in BOAT_TAG_BY_REPLY:
+        return [ui_action("boat_cats", state)]
+
+    # El resto sigue normal
+    state["category_tag"] = BOAT_TAG_BY_REPLY[rid]
+    state["step"] = "boat_pax"
+    await set_session(ctx.user, state)
+    return [ui_action("pax", state)]
+
+# ===== BOATS / WEDDINGS → PAX =====
+async def _pax_to_date(ctx: StepCtx, service: str):
+    state = ctx.state
+    state["pax"] = pax_from_reply(ctx.rid)
+    state["step"] = "date"
+    state["pending_service"] = service
+    await set_session(ctx.user, state)
+    return [("text", ask_date(state["lang"]))]
+
+@step("boat_pax", to=("date",))
+async def step_boat_pax(ctx: StepCtx):
+    if not ctx.rid.startswith("PAX_"):
+        return [ui_action("pax", ctx.state)]
+    return await _pax_to_date(ctx, "boats")
+
+# ===== VILLAS → PAX =====
+@step("villa_pax", to=("villa_cat",))
+async def step_villa_pax(ctx: StepCtx):
+    state = ctx.state
+    if not ctx.rid.startswith("PAX_"):
+        return [ui_action("pax", state)]
+    state["pax"] = pax_from_reply(ctx.rid)
+    state["step"] = "villa_cat"
+    await set_session(ctx.user, state)
+    return [ui_action("villa_cats", state)]
+
+# ===== VILLAS → CAT =====
+VILLA_TAG_BY_REPLY = {
+    "VILLA_3_6":"bed_3_6",
+    "VILLA_7_10":"bed_7_10",
+    "VILLA_11_14":"bed_11_14",
+    "VILLA_15P":"bed_15_plus",
+}
 
-    return {"ok": True}
+@step("villa_cat", to=("date",))
+async def step_villa_cat(ctx: StepCtx):
+    state = ctx.state
+    if ctx.rid not in VILLA_TAG_BY_REPLY:
+        return [ui_action("villa_cats", state)]
+    state["category_tag"] = VILLA_TAG_BY_REPLY[ctx.rid]
+    state["step"] = "date"
+    state["pending_service"] = "villas"
+    await set_session(ctx.user, state)
+    return [("text", ask_date(state["lang"]))]
+
+# ===== WEDDINGS → invitados =====
+@step("wed_guests", to=("date",))
+async def step_wed_guests(ctx: StepCtx):
+    if ctx.rid not in ("WED_PAX_50","WED_PAX_100","WED_PAX_200","WED_PAX_201","WED_PAX_UNK"):
+        return [ui_action("wed_guests", ctx.state)]
+    return await _pax_to_date(ctx, "weddings")
+
+# ===== FECHA (común) =====
+DATE_SKIP_TOKENS = {"omitir","skip","no sé","nose","tbd","na","n/a","later","después","luego","aún no","no tengo","no se","todavia no","aun no"}
+UNIT_ES = {"villas":"noche","boats":"día","islands":"día","weddings":"evento"}
+UNIT_EN = {"villas":"night","boats":"day","islands":"day","weddings":"event"}
+
+@step("date", to=("post_results",))
+async def step_date(ctx: StepCtx):
+    state, txt_raw, low_txt = ctx.state, ctx.txt_raw, ctx.low_txt
+    if low_txt not in DATE_SKIP_TOKENS:
+        ok_future, warn_msg = _validate_future_or_warn(txt_raw, state.get("lang"))
+        if not ok_future:
+            return [("text", warn_msg), ("text", ask_date(state["lang"]))]
+
+    state["date"] = None if low_txt in DATE_SKIP_TOKENS else txt_raw
+    svc = state.get("pending_service")
+
+    # --- Resultado según servicio ---
+    # En frío puede tener que descargar el sheet: al thread pool
+    top = await asyncio.to_thread(filter_catalog, svc, state["city"], state.get("pax") or 0, state.get("category_tag"))
+    unit = UNIT_ES[svc] if is_es(state["lang"]) else UNIT_EN[svc]
+
+    state["last_top"] = top_ref(top)
+    append_history(state, svc)
+    state["step"] = "post_results"
+    await set_session(ctx.user, state)
+
+    actions = [
+        ("text", format_results(state["lang"], top, unit, service_type=svc, city=state["city"])),
+        lead_action(state, f"Lead {svc.title()}", with_contact=False),
+    ]
+    if not top:
+        actions.append(handoff_action(state))
+    actions.append(ui_action("keep_helping", state))
+    return actions
+
+# ===== POST RESULTADOS =====
+@step("post_results", to=("menu",))
+async def step_post_results(ctx: StepCtx):
+    state, user, txt_raw, rid = ctx.state, ctx.user, ctx.txt_raw, ctx.rid
+    # Entrada libre: mezcla de botes (p.ej. "1 lancha y 1 cat")
+    if (state.get("service_type") == "boats") and txt_raw and not rid:
+        mix = parse_boat_mix(txt_raw)
+        if mix:
+            state["boat_mix"] = mix
+            await set_session(user, state)
+            es = is_es(state.get("lang"))
+            parts_es, parts_en = [], []
+            if mix.get("speedboat"):
+                parts_es.append(f"{mix['speedboat']} lancha")
+                parts_en.append(f"{mix['speedboat']} speedboat")
+            if mix.get("catamaran"):
+                parts_es.append(f"{mix['catamaran']} catamarán")
+                parts_en.append(f"{mix['catamaran']} catamaran")
+            if mix.get("yacht"):
+                parts_es.append(f"{mix['yacht']} yate")
+                parts_en.append(f"{mix['yacht']} yacht")
+            ack = ("Perfecto — mix solicitado: " + ", ".join(parts_es)
+                   if es else
+                   "Got it — requested mix: " + ", ".join(parts_en))
+            return [("text", ack), handoff_action(state), ui_action("what_else", state)]
+
+    if rid in ("POST_ADD_SERVICE", "POST_MENU"):
+        await reset_to_menu(state, user)
+        return [menu_action(state)]
+
+    if rid == "POST_TALK_TEAM":
+        return [handoff_action(state), ("lead_handoff",), ui_action("what_else", state)]
+
+    # Texto libre en post_results → respuesta con IA
+    if txt_raw and not rid:
+        ai_reply = await luna_reply_to(user, txt_raw, state)
+        if ai_reply:
+            await set_session(user, state)
+
+    return [ui_action("add_or_team", state)]
+
+# ===== FALLBACK con IA =====
+async def step_fallback(ctx: StepCtx):
+    # Paso desconocido: el usuario escribió algo inesperado
+    state = ctx.state
+    if ctx.txt_raw and not ctx.rid:
+        ai_reply = await luna_reply_to(ctx.user, ctx.txt_raw, state)
+        if ai_reply:
+            await set_session(ctx.user, state)
+        elif _claude and state.get("lang") and state.get("city"):
+            # IA lenta o caída → volver al menú con botones
+            await reset_to_menu(state, ctx.user)
+            return [menu_action(state)]
+    return []
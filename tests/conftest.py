@@ -0,0 +1,30 @@
+import asyncio
+import os
+import sys
+
+# Sin Redis ni credenciales reales: todo corre con los fallbacks en memoria
+os.environ["REDIS_URL"] = ""
+os.environ.setdefault("HUBSPOT_TOKEN", "test-token")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import main
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    """Colas, caches y métricas vacías en cada test."""
+    main._hs_pending.clear()
+    main.HS_DEAL_IDS.clear()
+    main._contact_cache.clear()
+    main._mail_pending.clear()
+    main._mail_retry.clear()
+    main.SESSIONS.clear()
+    for bucket in main.METRICS.values():
+        bucket.clear()
+    yield
@@ -0,0 +1,179 @@
+import httpx
+import pytest
+
+import main
+from conftest import run
+
+
+class FakeResp:
+    def __init__(self, data=None, status=200):
+        self.status_code = status
+        self.is_success = status < 300
+        self._data = data or {}
+        self.content = b"{}"
+        self.text = str(self._data)
+
+    def json(self):
+        return self._data
+
+
+class FakeHubSpot:
+    """Responde los batch de HubSpot; los creates vuelven en orden inverso (HubSpot no garantiza orden)."""
+
+    def __init__(self, trace=True, fail_assoc=0):
+        self.trace = trace
+        self.fail_assoc = fail_assoc
+        self.calls = []
+
+    async def __call__(self, client, method, url, **kw):
+        path = url.split("/crm", 1)[1]
+        inputs = kw["json"]["inputs"]
+        self.calls.append((path, inputs))
+        if path.endswith("/batch/create") and "/objects/" in path:
+            prefix = "D" if "deals" in path else "C"
+            results = []
+            for i in reversed(inputs):
+                res = {"id": f"{prefix}{i['objectWriteTraceId']}", "properties": i["properties"]}
+                if self.trace:
+                    res["objectWriteTraceId"] = i["objectWriteTraceId"]
+                results.append(res)
+            return FakeResp({"results": results})
+        if "associations" in path and self.fail_assoc:
+            self.fail_assoc -= 1
+            return FakeResp(status=500)
+        return FakeResp({"results": []})
+
+    def paths(self):
+        return [p for p, _ in self.calls]
+
+
+def deal_op(uid, conv, title="Maria — WhatsApp Lead", **kw):
+    op = {"kind": "deal", "uid": uid, "phone": uid, "title": title, "desc": "", "owner_id": "",
+          "note": "", "contact_id": f"C{uid}", "deal_id": "", "conv": conv}
+    op.update(kw)
+    return op
+
+
+def test_match_results_uses_trace_id_not_position():
+    results = [{"id": "D2", "objectWriteTraceId": "222"}, {"id": "D1", "objectWriteTraceId": "111"}]
+    assert main._match_results(["111", "222"], results) == {"111": "D1", "222": "D2"}
+
+
+def test_match_results_untraced_ambiguous_property_is_left_unmatched():
+    results = [{"id": "D2", "properties": {"dealname": "Maria"}}, {"id": "D1", "properties": {"dealname": "Maria"}}]
+    out = main._match_results(["111", "222"], results, prop="dealname", values={"111": "Maria", "222": "Maria"})
+    assert out == {}
+
+
+def test_match_results_untraced_unique_property():
+    results = [{"id": "D2", "properties": {"dealname": "Bob"}}, {"id": "D1", "properties": {"dealname": "Ana"}}]
+    out = main._match_results(["111", "222"], results, prop="dealname", values={"111": "ana", "222": "BOB"})
+    assert out == {"111": "D1", "222": "D2"}
+
+
+def test_same_dealname_creates_go_to_their_own_customer(monkeypatch):
+    hs = FakeHubSpot()
+    monkeypatch.setattr(main, "http_request", hs)
+
+    async def go():
+        await main.hubspot_enqueue(deal_op("111", "c1"))
+        await main.hubspot_enqueue(deal_op("222", "c2"))
+        await main.hubspot_flush()
+        return await main._hs_deal_ids_get(["c1", "c2"])
+
+    assert run(go()) == {"c1": ("D111", ""), "c2": ("D222", "")}
+    assoc = [i for p, inputs in hs.calls if "associations" in p for i in inputs]
+    assert {(a["from"]["id"], a["to"]["id"]) for a in assoc} == {("D111", "C111"), ("D222", "C222")}
+
+
+def test_unmatched_creates_are_requeued_not_misassigned(monkeypatch):
+    monkeypatch.setattr(main, "http_request", FakeHubSpot(trace=False))
+
+    async def go():
+        await main.hubspot_enqueue(deal_op("111", "c1"))
+        await main.hubspot_enqueue(deal_op("222", "c2"))
+        await main.hubspot_flush()
+        return await main._hs_deal_ids_get(["c1", "c2"])
+
+    assert run(go()) == {}
+    assert [(op["uid"], op["attempts"]) for op in main._hs_pending] == [("111", 1), ("222", 1)]
+
+
+def test_failed_association_is_reissued_on_retry(monkeypatch):
+    hs = FakeHubSpot(fail_assoc=1)
+    monkeypatch.setattr(main, "http_request", hs)
+
+    async def go():
+        await main.hubspot_enqueue(deal_op("111", "c1"))
+        await main.hubspot_flush()
+        pending = await main._hs_deal_ids_get(["c1"])
+        await main.hubspot_flush()
+        return pending, await main._hs_deal_ids_get(["c1"])
+
+    pending, done = run(go())
+    assert pending == {"c1": ("D111", "C111")}
+    assert done == {"c1": ("D111", "")}
+    # El reintento actualiza (no duplica el deal) y vuelve a pedir la asociación
+    assert hs.paths() == [
+        "/v3/objects/deals/batch/create",
+        "/v4/associations/deals/contacts/batch/create",
+        "/v3/objects/deals/batch/update",
+        "/v4/associations/deals/contacts/batch/create",
+    ]
+
+
+def test_failed_flush_requeues_until_max_attempts(monkeypatch):
+    async def down(client, method, url, **kw):
+        return FakeResp(status=500)
+    monkeypatch.setattr(main, "http_request", down)
+
+    async def go():
+        await main.hubspot_enqueue(deal_op("111", "c1", deal_id="D1"))
+        for _ in range(main.HUBSPOT_MAX_ATTEMPTS):
+            await main.hubspot_flush()
+
+    run(go())
+    assert main._hs_pending == []
+    assert main.METRICS["counters"]["hubspot.flush_errors"] == main.HUBSPOT_MAX_ATTEMPTS
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    waits = []
+
+    async def fake_sleep(secs):
+        waits.append(secs)
+    monkeypatch.setattr(main.asyncio, "sleep", fake_sleep)
+    return waits
+
+
+def _client(responses: list):
+    hits = []
+
+    def handler(request):
+        hits.append(request.method)
+        return responses[min(len(hits), len(responses)) - 1]
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler)), hits
+
+
+def test_http_request_retries_429_honoring_retry_after(sleeps):
+    client, hits = _client([httpx.Response(429, headers={"Retry-After": "2"}), httpx.Response(200)])
+    r = run(main.http_request(client, "POST", "https://api.hubapi.com/x"))
+    assert r.status_code == 200
+    assert hits == ["POST", "POST"]
+    assert sleeps == [2.0]
+
+
+def test_http_request_does_not_retry_post_on_500(sleeps):
+    client, hits = _client([httpx.Response(500), httpx.Response(200)])
+    r = run(main.http_request(client, "POST", "https://api.hubapi.com/x"))
+    assert r.status_code == 500
+    assert hits == ["POST"]
+
+
+def test_http_request_backoff_is_capped(sleeps):
+    client, hits = _client([httpx.Response(503)])
+    r = run(main.http_request(client, "PATCH", "https://api.hubapi.com/x"))
+    assert r.status_code == 503
+    assert len(hits) == main.HTTP_MAX_RETRIES + 1
+    assert all(0 <= w <= main.HTTP_BACKOFF_MAX_SECS for w in sleeps)
@@ -0,0 +1,27 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def state(request, monkeypatch):
+    # Umbral bajo: que lo que decida sea el chequeo de números/negaciones/plurales, no el coseno
+    monkeypatch.setattr(main, "LUNA_CACHE_MIN_SIM", 0.5)
+    # Un contexto (ciudad) por test: lo cacheado en otro test no cuenta
+    return {"lang": "EN", "city": f"test-{request.node.name}"}
+
+
+@pytest.mark.parametrize("cached, asked", [
+    ("villas with a pool for 10 people", "villas with a pool for 20 people"),
+    ("is breakfast included", "is breakfast not included"),
+    ("is breakfast included", "isn't breakfast included"),
+    ("can I bring my dog", "can I bring my dogs"),
+])
+def test_similar_question_with_different_meaning_misses(state, cached, asked):
+    main.luna_cache_put(cached, state, "R:" + cached)
+    assert main.luna_cache_get(asked, state) == ""
+
+
+def test_typo_still_hits(state):
+    main.luna_cache_put("do you have villas with pool?", state, "R")
+    assert main.luna_cache_get("do you have vilas with pool", state) == "R"
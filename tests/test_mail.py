@@ -0,0 +1,81 @@
+import pytest
+
+import main
+from conftest import run
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def smtp(monkeypatch):
+    sent = []
+    state = {"up": False}
+
+    def fake_send(subject, body):
+        if state["up"]:
+            sent.append(subject)
+        return state["up"]
+    monkeypatch.setattr(main, "send_sales_email", fake_send)
+    return state, sent
+
+
+def test_failed_send_backs_off_instead_of_retrying_at_once(clock, smtp):
+    state, sent = smtp
+
+    async def go():
+        await main.mail_enqueue({"subject": "Lead", "body": "..."})
+        main._mail_wakeup.clear()
+        assert await main.mail_flush() == 0
+        assert not main._mail_wakeup.is_set()
+        item = main._mail_retry[0]
+        assert item["attempts"] == 1
+        assert item["next_at"] == clock[0] + main.MAIL_FLUSH_SECS * 2
+
+        # Antes de vencer no se toma
+        clock[0] += main.MAIL_FLUSH_SECS
+        assert await main.mail_flush() == 0
+        assert main._mail_retry == [item] and item["attempts"] == 1
+
+        # Vencido: se reintenta y vuelve a fallar, ahora con el doble de espera
+        clock[0] += main.MAIL_FLUSH_SECS
+        assert await main.mail_flush() == 0
+        assert item["attempts"] == 2
+        assert item["next_at"] == clock[0] + main.MAIL_FLUSH_SECS * 4
+
+        state["up"] = True
+        clock[0] = item["next_at"]
+        assert await main.mail_flush() == 1
+
+    run(go())
+    assert sent == ["Lead"]
+    assert main._mail_retry == [] and main._mail_pending == []
+
+
+def test_due_retries_go_before_new_mail(clock, smtp):
+    async def go():
+        await main.mail_enqueue({"subject": "old", "body": ""})
+        await main.mail_flush()
+        await main.mail_enqueue({"subject": "new", "body": ""})
+        clock[0] = main._mail_retry[0]["next_at"]
+        return await main._mail_take(10)
+
+    assert [it["subject"] for it in run(go())] == ["old", "new"]
+
+
+def test_mail_dropped_after_max_attempts(clock, smtp):
+    async def go():
+        await main.mail_enqueue({"subject": "Lead", "body": ""})
+        for _ in range(main.MAIL_MAX_ATTEMPTS):
+            await main.mail_flush()
+            if main._mail_retry:
+                clock[0] = main._mail_retry[0]["next_at"]
+
+    run(go())
+    assert main._mail_retry == [] and main._mail_pending == []
+    assert main.METRICS["counters"]["mail.dropped"] == 1
+    assert main.METRICS["counters"]["mail.errors"] == main.MAIL_MAX_ATTEMPTS
@@ -0,0 +1,82 @@
+import pytest
+
+import main
+from conftest import run
+
+USER = "573001112233"
+
+
+async def _turn_with_concurrent_patch():
+    """Un turno lee la sesión, mientras tanto el flush de HubSpot escribe contact_id, y el turno
+    cierra con su propio cambio: al escribir no debe pisar lo que llegó en el medio."""
+    await main.set_session(USER, {"step": "ask_name", "name": "Ana"})
+    turn = main.SessionTurn(USER)
+    token = main._session_turn.set(turn)
+    try:
+        state = await main.get_session(USER)
+        await main.patch_session(USER, {"contact_id": "C1"})
+        state["step"] = "ask_dates"
+        await main.set_session(USER, state)
+        await turn.flush()
+    finally:
+        main._session_turn.reset(token)
+    return await main.get_session(USER)
+
+
+def test_turn_flush_merges_concurrent_patch():
+    final = run(_turn_with_concurrent_patch())
+    assert final["step"] == "ask_dates"
+    assert final["contact_id"] == "C1"
+    assert final["name"] == "Ana"
+    assert main.METRICS["counters"]["session.conflicts"] == 1
+
+
+def test_patch_session_respects_match():
+    async def go():
+        await main.set_session(USER, {"conv": "c2"})
+        await main.patch_session(USER, {"early_deal_id": "D1"}, match={"conv": "c1"})
+        return await main.get_session(USER)
+
+    assert "early_deal_id" not in run(go())
+
+
+@pytest.fixture
+def redis_sessions(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    import redis.asyncio as aioredis
+    monkeypatch.setattr(main, "aioredis", aioredis, raising=False)   # sin REDIS_URL no se importa
+    server = fakeredis.FakeServer()
+    db = main.SessionBackend(fakeredis.FakeAsyncRedis(server=server))
+    monkeypatch.setattr(main, "_sessions_db", db)
+    return fakeredis.FakeRedis(server=server)   # "otro proceso" escribiendo la misma clave
+
+
+def test_cas_retries_on_watch_conflict(redis_sessions):
+    other = redis_sessions
+    calls = []
+
+    def fn(cur):
+        calls.append(dict(cur))
+        if len(calls) == 1:
+            # Otra réplica escribe entre el GET y el EXEC => WatchError y se vuelve a leer
+            raced = dict(cur, contact_id="C1", _v=cur["_v"] + 1)
+            other.set(main._rkey(USER), main.encode_session(raced))
+        return dict(cur, step="ask_dates")
+
+    async def go():
+        await main.set_session(USER, {"step": "ask_name"})
+        await main._cas_session(USER, fn)
+        return main.decode_session(await main._sessions_db.client.get(main._rkey(USER)))
+
+    final = run(go())
+    assert len(calls) == 2
+    assert calls[1]["contact_id"] == "C1"
+    assert final["step"] == "ask_dates" and final["contact_id"] == "C1"
+    assert final["_v"] == 3
+    assert main.METRICS["counters"]["session.cas_retries"] == 1
+
+
+def test_turn_flush_merges_over_redis(redis_sessions):
+    final = run(_turn_with_concurrent_patch())
+    assert final["step"] == "ask_dates" and final["contact_id"] == "C1"
+    assert main.METRICS["counters"]["session.conflicts"] == 1